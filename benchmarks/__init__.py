@@ -0,0 +1 @@
+# Harness de benchmark (ver benchmarks/run.py).
@@ -0,0 +1,72 @@
+# benchmarks/corpus.py
+# Corpus sintético de decisões judiciais em PDF, de vários tamanhos.
+#
+# Cada decisão tem cabeçalho e rodapé repetidos em todas as páginas, número de
+# página, bloco de assinatura, relatório/fundamentação com valores e um dispositivo
+# no fim, para exercitar a extração, a recuperação e a montagem do prompt.
+# A semente muda o texto (e portanto o hash), para não acertar na cache de resultados.
+
+import random
+from typing import Dict, List
+
+import fitz  # PyMuPDF
+
+SIZES: Dict[str, int] = {"small": 2, "medium": 10, "large": 40}
+
+BANNER = "PODER JUDICIÁRIO - TRIBUNAL DE JUSTIÇA DO ESTADO - COMARCA DA CAPITAL"
+SUBJECTS = ["contrato de empréstimo consignado", "tarifa bancária", "cartão de crédito",
+            "cédula de crédito bancário", "negativação indevida", "conta corrente"]
+SENTENCES = [
+    "A parte autora alega que não reconhece a contratação de {subject}.",
+    "O réu, em contestação, sustenta a regularidade da {subject} e junta documentos.",
+    "É pacífico o entendimento de que a relação é regida pelo Código de Defesa do Consumidor.",
+    "A prova documental não demonstra a anuência do consumidor com os termos apresentados.",
+    "O valor da causa foi fixado em R$ {value},00.",
+    "Foi deferida a tutela de urgência para suspender os descontos, sob pena de multa diária de R$ {fine},00.",
+    "Não há litispendência ou coisa julgada a reconhecer.",
+    "Os documentos juntados não comprovam a disponibilização do crédito na conta do autor.",
+    "A jurisprudência do Tribunal orienta-se no mesmo sentido, conforme precedentes citados.",
+    "O dano moral, no caso, decorre do próprio fato, dispensando prova do prejuízo.",
+]
+
+
+def decision_text(pages: int, seed: int) -> List[str]:
+    """Texto de cada página da decisão."""
+    rng = random.Random(seed)
+    subject = rng.choice(SUBJECTS)
+    process = f"{rng.randint(1000000, 9999999)}-{rng.randint(10, 99)}.2024.8.26.{rng.randint(1000, 9999)}"
+    texts = []
+    for page in range(1, pages + 1):
+        lines = [BANNER, f"Processo nº {process}", ""]
+        if page == 1:
+            lines += [f"Autor: Fulano de Tal {seed}", "Réu: Banco S.A.", f"Ação declaratória sobre {subject}", "", "RELATÓRIO", ""]
+        for _ in range(14):
+            sentence = rng.choice(SENTENCES).format(subject=subject, value=rng.randint(1, 90) * 1000,
+                                                    fine=rng.randint(1, 10) * 100)
+            lines.append(sentence)
+        if page == pages:
+            lines += ["", f"Ante o exposto, JULGO PROCEDENTE o pedido e condeno o réu ao pagamento de "
+                          f"R$ {rng.randint(1, 20) * 1000},00 a título de danos morais.", "P.R.I."]
+        lines += ["", f"Página {page} de {pages}",
+                  "Documento assinado digitalmente conforme MP nº 2.200-2/2001 e Lei 11.419/2006."]
+        texts.append("\n".join(lines))
+    return texts
+
+
+def decision_pdf(pages: int, seed: int) -> bytes:
+    doc = fitz.open()
+    for text in decision_text(pages, seed):
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(50, 50, page.rect.width - 50, page.rect.height - 50), text, fontsize=9)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def build_corpus(count: int, sizes: List[str], seed: int = 0) -> List[Dict]:
+    """Lista de {'name', 'size', 'content'} alternando pelos tamanhos pedidos."""
+    corpus = []
+    for i in range(count):
+        size = sizes[i % len(sizes)]
+        corpus.append({"name": f"decisao_{size}_{i}.pdf", "size": size, "content": decision_pdf(SIZES[size], seed + i)})
+    return corpus
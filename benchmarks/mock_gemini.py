@@ -0,0 +1,68 @@
+# benchmarks/mock_gemini.py
+# Servidor Gemini de simulação para os benchmarks (apontado por GEMINI_API_BASE).
+#
+# Responde a generateContent com um JSON que segue o responseSchema do pedido e
+# um usageMetadata estimado, após uma latência configurável, e devolve erros
+# (429/5xx) com a probabilidade pedida, para exercitar as repetições do cliente.
+
+import json
+import uuid
+import random
+import asyncio
+from dataclasses import dataclass
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+@dataclass
+class MockGeminiConfig:
+    latency_ms: float = 800.0
+    jitter_ms: float = 200.0
+    error_rate: float = 0.0
+    error_status: int = 503
+    seed: int = 0
+
+
+def _prompt_chars(body: dict) -> int:
+    parts = [part for content in body.get("contents", []) for part in content.get("parts", [])]
+    parts += body.get("systemInstruction", {}).get("parts", [])
+    return sum(len(part.get("text", "")) for part in parts)
+
+
+def create_mock_gemini_app(config: MockGeminiConfig) -> FastAPI:
+    app = FastAPI(title="Mock Gemini")
+    rng = random.Random(config.seed)
+    app.state.requests = 0
+    app.state.errors = 0
+
+    async def simulate_latency():
+        delay = max(0.0, rng.gauss(config.latency_ms, config.jitter_ms)) / 1000
+        await asyncio.sleep(delay)
+
+    @app.post("/v1beta/models/{model_action}")
+    async def generate_content(model_action: str, request: Request):
+        body = await request.json()
+        app.state.requests += 1
+        await simulate_latency()
+        if rng.random() < config.error_rate:
+            app.state.errors += 1
+            return JSONResponse({"error": {"code": config.error_status, "message": "Erro simulado."}},
+                                status_code=config.error_status)
+        properties = body.get("generationConfig", {}).get("responseSchema", {}).get("properties", {})
+        data = {name: "Não consta na decisão" for name in properties}
+        prompt_tokens = _prompt_chars(body) // 4
+        response_tokens = len(json.dumps(data, ensure_ascii=False)) // 4
+        return {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": json.dumps(data, ensure_ascii=False)}]},
+                            "finishReason": "STOP"}],
+            "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": response_tokens,
+                              "totalTokenCount": prompt_tokens + response_tokens},
+        }
+
+    @app.post("/v1beta/cachedContents")
+    async def create_cached_content(request: Request):
+        body = await request.json()
+        return {"name": f"cachedContents/{uuid.uuid4().hex}", "model": body.get("model"), "ttl": body.get("ttl")}
+
+    return app
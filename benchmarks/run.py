@@ -0,0 +1,490 @@
+# benchmarks/run.py
+# Harness de benchmark dos três serviços, executados no mesmo processo.
+#
+# Arranca um servidor Gemini de simulação (latência e erros configuráveis), o
+# gerador, o serviço de treinamento e a API com uvicorn em threads, numa pasta de
+# trabalho temporária (bases de dados, spool, índice e output isolados do projeto).
+# Envia um corpus sintético de decisões em PDF e mede, por endpoint, o débito e as
+# latências p50/p95/p99, os tempos por estágio (histogramas de metrics.py) e o pico
+# de memória (RSS). O resultado pode ser gravado como baseline JSON e comparado
+# com uma baseline anterior.
+#
+# Uso:
+#   python -m benchmarks.run --requests 40 --concurrency 8 --stub-converter \
+#       --output benchmarks/baselines/local.json
+#   python -m benchmarks.run --compare benchmarks/baselines/local.json --max-regression 15
+#
+# --stub-converter substitui o LibreOffice por um conversor mínimo e --fake-embeddings
+# substitui o modelo de embeddings por vetores determinísticos, para medir o
+# pipeline sem essas dependências (os números deixam de incluir esses custos).
+
+import os
+import sys
+import json
+import time
+import stat
+import socket
+import shutil
+import asyncio
+import hashlib
+import argparse
+import resource
+import platform
+import tempfile
+import threading
+import subprocess
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+import uvicorn
+
+from benchmarks.corpus import SIZES, build_corpus
+from benchmarks.mock_gemini import MockGeminiConfig, create_mock_gemini_app
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHARED_FILES = ("templates", "Política Recursal.pdf")
+STATUS_POLL_INTERVAL = 0.05
+FINISHED = ("ready", "failed")
+
+STUB_CONVERTER = """#!{python}
+# Conversor mínimo com a interface de 'soffice --convert-to pdf --outdir DIR FICHEIRO'.
+import os, sys
+import fitz
+args = sys.argv[1:]
+outdir, source = args[args.index("--outdir") + 1], args[-1]
+doc = fitz.open()
+doc.new_page().insert_text((72, 72), os.path.basename(source))
+doc.save(os.path.join(outdir, os.path.splitext(os.path.basename(source))[0] + ".pdf"))
+"""
+
+
+# --- Servidores em threads ---
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class BackgroundServer:
+    """Um app ASGI servido pelo uvicorn numa thread própria (com o seu event loop)."""
+
+    def __init__(self, name: str, app, port: int):
+        self.name = name
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True, name=f"bench-{name}")
+
+    def start(self, timeout: float = 60):
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if not self.thread.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError(f"O servidor '{self.name}' não arrancou.")
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=30)
+
+
+# --- Dependências substituíveis ---
+
+class HashEmbeddings:
+    """Embeddings determinísticos (hash do texto), com a interface do HuggingFaceEmbeddings."""
+
+    def __init__(self, model_name: Optional[str] = None, **kwargs):
+        self.model_name = model_name
+
+    def embed_query(self, text: str) -> List[float]:
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        return [byte / 255 for byte in digest]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+def install_fake_embeddings():
+    import langchain_community.embeddings as embeddings_module
+    embeddings_module.HuggingFaceEmbeddings = HashEmbeddings
+
+
+def install_stub_converter(workdir: str) -> str:
+    path = os.path.join(workdir, "soffice-stub")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(STUB_CONVERTER.format(python=sys.executable))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def prepare_workdir(workdir: str):
+    for name in SHARED_FILES:
+        source = os.path.join(REPO_ROOT, name)
+        if os.path.exists(source):
+            os.symlink(source, os.path.join(workdir, name))
+
+
+# --- Medições ---
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Percentil por nearest-rank sobre valores já ordenados."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, min(len(sorted_values), int(round(q / 100 * len(sorted_values) + 0.5))))
+    return sorted_values[rank - 1]
+
+
+class Recorder:
+    """Latências e erros por endpoint, e a janela temporal em que foram medidos."""
+
+    def __init__(self):
+        self.samples: Dict[str, List[Tuple[float, bool]]] = {}
+        self.windows: Dict[str, List[float]] = {}
+
+    def record(self, endpoint: str, started: float, ok: bool):
+        finished = time.perf_counter()
+        self.samples.setdefault(endpoint, []).append((finished - started, ok))
+        window = self.windows.setdefault(endpoint, [started, finished])
+        window[0] = min(window[0], started)
+        window[1] = max(window[1], finished)
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        results = {}
+        for endpoint, samples in self.samples.items():
+            latencies = sorted(seconds for seconds, ok in samples if ok)
+            window = self.windows[endpoint][1] - self.windows[endpoint][0]
+            results[endpoint] = {
+                "requests": len(samples),
+                "errors": sum(1 for _, ok in samples if not ok),
+                "throughput_rps": round(len(latencies) / window, 3) if window > 0 else 0.0,
+                "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+                "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+                "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+                "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            }
+        return results
+
+
+def histogram_quantile(buckets: Tuple[float, ...], counts: List[int], q: float) -> float:
+    """Quantil aproximado de um histograma (interpolação linear dentro do bucket, como no Prometheus)."""
+    total = sum(counts)
+    if not total:
+        return 0.0
+    target = q * total
+    cumulative = 0
+    lower = 0.0
+    for bound, count in zip(buckets + (float("inf"),), counts):
+        if cumulative + count >= target:
+            if bound == float("inf"):
+                return lower
+            return lower + (bound - lower) * ((target - cumulative) / count if count else 0)
+        cumulative += count
+        lower = bound
+    return lower
+
+
+def stage_snapshot() -> Dict[str, Any]:
+    from metrics import STAGE_SECONDS
+    with STAGE_SECONDS.lock:
+        return {key[0]: (list(counts), total, count) for key, (counts, total, count) in STAGE_SECONDS.series.items()}
+
+
+def stage_summary(before: Dict[str, Any], after: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Tempos por estágio observados entre dois snapshots (exclui o aquecimento)."""
+    from metrics import STAGE_SECONDS
+    results = {}
+    for stage, (counts, total, count) in sorted(after.items()):
+        base_counts, base_total, base_count = before.get(stage, ([0] * len(counts), 0.0, 0))
+        delta_counts = [a - b for a, b in zip(counts, base_counts)]
+        delta_count = count - base_count
+        if not delta_count:
+            continue
+        results[stage] = {
+            "count": delta_count,
+            "mean_ms": round((total - base_total) / delta_count * 1000, 2),
+            "p50_ms": round(histogram_quantile(STAGE_SECONDS.buckets, delta_counts, 0.50) * 1000, 2),
+            "p95_ms": round(histogram_quantile(STAGE_SECONDS.buckets, delta_counts, 0.95) * 1000, 2),
+        }
+    return results
+
+
+def peak_rss_mb() -> Dict[str, float]:
+    # ru_maxrss vem em KB no Linux e em bytes no macOS.
+    scale = 1024 * 1024 if platform.system() == "Darwin" else 1024
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1),
+    }
+
+
+# --- Cenários ---
+
+async def analyse(client: httpx.AsyncClient, api: str, document: Dict, form_type: str,
+                  recorder: Recorder, timeout: float) -> Optional[str]:
+    """Submete um PDF e espera pelo resultado; devolve o job_id se ficou 'ready'."""
+    started = time.perf_counter()
+    files = {"file": (document["name"], document["content"], "application/pdf")}
+    response = await client.post(f"{api}/api/v1/analysis", files=files, data={"form_type": form_type})
+    recorder.record("POST /api/v1/analysis", started, response.status_code == 202)
+    if response.status_code != 202:
+        recorder.record(f"analysis end-to-end ({document['size']})", started, False)
+        return None
+    job_id = response.json()["job_id"]
+    deadline = time.monotonic() + timeout
+    status = None
+    while time.monotonic() < deadline:
+        poll_started = time.perf_counter()
+        response = await client.get(f"{api}/api/v1/analysis/{job_id}/status")
+        recorder.record("GET /api/v1/analysis/{job_id}/status", poll_started, response.status_code == 200)
+        status = response.json().get("status") if response.status_code == 200 else None
+        if status in FINISHED:
+            break
+        await asyncio.sleep(STATUS_POLL_INTERVAL)
+    recorder.record(f"analysis end-to-end ({document['size']})", started, status == "ready")
+    return job_id if status == "ready" else None
+
+
+async def generate(client: httpx.AsyncClient, api: str, job_id: str, index: int, recorder: Recorder):
+    # Dados diferentes por pedido, para não medir só a deduplicação do gerador.
+    payload = {"job_id": job_id, "form_data": {"npj": f"bench-{index}"}, "original_data": {"npj": ""}}
+    started = time.perf_counter()
+    response = await client.post(f"{api}/api/v1/generate", json=payload)
+    recorder.record("POST /api/v1/generate", started, response.status_code == 200)
+
+
+async def export(client: httpx.AsyncClient, training: str, recorder: Recorder) -> int:
+    started = time.perf_counter()
+    size = 0
+    async with client.stream("GET", f"{training}/api/v1/training-data", params={"compress": "true"}) as response:
+        async for chunk in response.aiter_raw():
+            size += len(chunk)
+    recorder.record("GET /api/v1/training-data", started, response.status_code in (200, 404))
+    return size
+
+
+async def gather_limited(concurrency: int, coroutines) -> List[Any]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(limited(coroutine) for coroutine in coroutines))
+
+
+async def run_scenarios(args, urls: Dict[str, str], corpus: List[Dict], warmup: List[Dict]) -> Dict[str, Any]:
+    recorder = Recorder()
+    timeout = httpx.Timeout(args.request_timeout, connect=10.0)
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        if warmup:
+            await gather_limited(args.concurrency, [analyse(client, urls["api"], document, args.form_type, Recorder(),
+                                                            args.request_timeout) for document in warmup])
+        before = stage_snapshot()
+
+        job_ids = await gather_limited(args.concurrency, [
+            analyse(client, urls["api"], document, args.form_type, recorder, args.request_timeout) for document in corpus
+        ])
+        ready = [job_id for job_id in job_ids if job_id]
+        if args.generation:
+            await gather_limited(args.concurrency, [
+                generate(client, urls["api"], job_id, index, recorder) for index, job_id in enumerate(ready)
+            ])
+            # O feedback é gravado em lote pela API; espera pela escrita antes de exportar.
+            await asyncio.sleep(1.0)
+        export_sizes = await gather_limited(args.concurrency, [
+            export(client, urls["training"], recorder) for _ in range(args.exports)
+        ])
+        after = stage_snapshot()
+
+    return {
+        "endpoints": recorder.summary(),
+        "stages": stage_summary(before, after),
+        "export_bytes": max(export_sizes, default=0),
+    }
+
+
+# --- Baselines ---
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], max_regression: float) -> List[str]:
+    """Imprime as variações por endpoint e devolve as regressões de p95 acima do limite (%)."""
+    regressions = []
+    print(f"\nComparação com a baseline {baseline.get('commit') or '?'} ({baseline.get('created_at', '?')}):")
+    for endpoint, result in current["results"]["endpoints"].items():
+        previous = baseline.get("results", {}).get("endpoints", {}).get(endpoint)
+        if not previous:
+            continue
+        deltas = {}
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps"):
+            if previous[metric]:
+                deltas[metric] = (result[metric] - previous[metric]) / previous[metric] * 100
+        print(f"  {endpoint:45} " + "  ".join(f"{metric} {delta:+.1f}%" for metric, delta in deltas.items()))
+        if deltas.get("p95_ms", 0.0) > max_regression:
+            regressions.append(f"{endpoint}: p95 {previous['p95_ms']}ms -> {result['p95_ms']}ms ({deltas['p95_ms']:+.1f}%)")
+    return regressions
+
+
+def print_report(report: Dict[str, Any]):
+    results = report["results"]
+    print(f"\n{'Endpoint':45} {'pedidos':>8} {'erros':>6} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for endpoint, result in results["endpoints"].items():
+        print(f"{endpoint:45} {result['requests']:>8} {result['errors']:>6} {result['throughput_rps']:>8} "
+              f"{result['p50_ms']:>9} {result['p95_ms']:>9} {result['p99_ms']:>9}")
+    print(f"\n{'Estágio':45} {'n':>8} {'média ms':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    for stage, result in results["stages"].items():
+        print(f"{stage:45} {result['count']:>8} {result['mean_ms']:>9} {result['p50_ms']:>9} {result['p95_ms']:>9}")
+    rss = results["peak_rss_mb"]
+    print(f"\nPico de RSS: {rss['self']} MB (processo), {rss['children']} MB (processos filhos)")
+    gemini = results["mock_gemini"]
+    print(f"Gemini (simulação): {gemini['requests']} pedidos, {gemini['errors']} erros simulados")
+
+
+# --- Execução ---
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark da API, do gerador e do serviço de treinamento.")
+    parser.add_argument("--requests", type=int, default=30, help="Número de PDFs analisados.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Pedidos em simultâneo.")
+    parser.add_argument("--sizes", default="small,medium,large", help=f"Tamanhos do corpus ({', '.join(SIZES)}).")
+    parser.add_argument("--form-type", default="dispensa")
+    parser.add_argument("--warmup", type=int, default=2, help="Análises de aquecimento (não contam).")
+    parser.add_argument("--exports", type=int, default=5, help="Exportações de dados de treinamento.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--gemini-latency-ms", type=float, default=800.0)
+    parser.add_argument("--gemini-jitter-ms", type=float, default=200.0)
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0, help="Probabilidade de erro por chamada (0-1).")
+    parser.add_argument("--gemini-error-status", type=int, default=503)
+    parser.add_argument("--stub-converter", action="store_true", help="Substitui o LibreOffice por um conversor mínimo.")
+    parser.add_argument("--fake-embeddings", action="store_true", help="Substitui o modelo de embeddings por vetores de hash.")
+    parser.add_argument("--no-generation", dest="generation", action="store_false", help="Não mede a geração de documentos.")
+    parser.add_argument("--request-timeout", type=float, default=300.0)
+    parser.add_argument("--ready-timeout", type=float, default=900.0, help="Espera máxima pelo índice da política.")
+    parser.add_argument("--output", help="Grava o resultado (baseline) neste ficheiro JSON.")
+    parser.add_argument("--compare", help="Baseline JSON com que comparar.")
+    parser.add_argument("--max-regression", type=float, default=20.0, help="Regressão máxima de p95 (%%) aceite com --compare.")
+    parser.add_argument("--keep-workdir", action="store_true")
+    args = parser.parse_args(argv)
+    args.sizes = [size.strip() for size in args.sizes.split(",") if size.strip()]
+    unknown = [size for size in args.sizes if size not in SIZES]
+    if unknown:
+        parser.error(f"Tamanhos desconhecidos: {', '.join(unknown)}")
+    return args
+
+
+def wait_ready(url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            response = httpx.get(f"{url}/health/ready", timeout=5)
+        except httpx.HTTPError:
+            response = None
+        if response is not None:
+            if response.status_code == 200:
+                return
+            # Falha no carregamento do índice: não há nada a esperar até ao timeout.
+            try:
+                index = response.json().get("index") or {}
+            except ValueError:
+                index = {}
+            if index.get("state") == "failed":
+                raise RuntimeError(f"O índice da política falhou ao carregar: {index.get('error')}")
+        time.sleep(0.5)
+    raise RuntimeError(f"A API não ficou pronta em {timeout:.0f}s.")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="recanalysis-bench-")
+    prepare_workdir(workdir)
+    ports = {name: free_port() for name in ("gemini", "generator", "training", "api")}
+    urls = {name: f"http://127.0.0.1:{port}" for name, port in ports.items()}
+
+    # A configuração dos serviços é lida na importação: definir o ambiente antes.
+    os.environ.update({
+        "GEMINI_API_BASE": urls["gemini"],
+        "GEMINI_API_KEY": os.getenv("GEMINI_API_KEY") or "benchmark",
+        "GENERATOR_SERVICE_URL": urls["generator"],
+        "POLICY_INDEX_DIR": os.path.join(workdir, "policy_index"),
+    })
+    if args.stub_converter:
+        os.environ["SOFFICE_BIN"] = install_stub_converter(workdir)
+    if args.fake_embeddings:
+        install_fake_embeddings()
+    if args.generation and not args.stub_converter and not shutil.which(os.getenv("SOFFICE_BIN", "soffice")):
+        print("LibreOffice não encontrado: a geração não é medida (use --stub-converter).")
+        args.generation = False
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    servers: List[BackgroundServer] = []
+    try:
+        import conversion_pool
+        if args.stub_converter:
+            conversion_pool.UNO_AVAILABLE = False
+        import generator_service
+        import training_service
+        import main as api_service
+
+        mock_config = MockGeminiConfig(args.gemini_latency_ms, args.gemini_jitter_ms, args.gemini_error_rate,
+                                       args.gemini_error_status, args.seed)
+        mock_app = create_mock_gemini_app(mock_config)
+        for name, app in (("gemini", mock_app), ("generator", generator_service.app),
+                          ("training", training_service.app), ("api", api_service.app)):
+            server = BackgroundServer(name, app, ports[name])
+            server.start()
+            servers.append(server)
+        started = time.perf_counter()
+        wait_ready(urls["api"], args.ready_timeout)
+        print(f"API pronta em {time.perf_counter() - started:.1f}s; a gerar o corpus...")
+
+        corpus = build_corpus(args.requests, args.sizes, seed=args.seed)
+        warmup = build_corpus(args.warmup, args.sizes, seed=args.seed + 1_000_000)
+        print(f"A analisar {len(corpus)} PDFs com concorrência {args.concurrency}...")
+        results = asyncio.run(run_scenarios(args, urls, corpus, warmup))
+        results["mock_gemini"] = {"requests": mock_app.state.requests, "errors": mock_app.state.errors}
+    finally:
+        for server in reversed(servers):
+            server.stop()
+        os.chdir(cwd)
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    results["peak_rss_mb"] = peak_rss_mb()
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "compare", "keep_workdir")}
+    report = {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "config": config,
+        "results": results,
+    }
+    print_report(report)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nBaseline gravada em '{args.output}'.")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(json.load(f), report, args.max_regression)
+        if regressions:
+            print(f"\nRegressões de p95 acima de {args.max_regression:.0f}%:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
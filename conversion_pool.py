@@ -0,0 +1,313 @@
+# conversion_pool.py
+# Pool de instâncias LibreOffice persistentes para a conversão DOCX -> PDF.
+#
+# Cada worker tem o seu próprio diretório de perfil (-env:UserInstallation), pelo que
+# conversões concorrentes deixam de disputar o mesmo perfil do utilizador. Quando o
+# módulo 'uno' está disponível, cada worker mantém um 'soffice --headless' vivo e
+# converte via socket/UNO, eliminando o arranque a frio por pedido. Sem 'uno', cada
+# conversão corre um 'soffice --convert-to' sobre o perfil já inicializado do worker.
+
+import os
+import sys
+import time
+import queue
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import Future
+from pathlib import Path
+
+# --- Configuração ---
+SOFFICE_BIN = os.getenv("SOFFICE_BIN", "soffice")
+POOL_SIZE = int(os.getenv("CONVERSION_POOL_SIZE", str(os.cpu_count() or 1)))
+QUEUE_MAX_SIZE = int(os.getenv("CONVERSION_QUEUE_MAX", "32"))
+MAX_CONVERSIONS_PER_WORKER = int(os.getenv("CONVERSION_MAX_PER_WORKER", "200"))
+CONVERSION_TIMEOUT = float(os.getenv("CONVERSION_TIMEOUT", "60"))
+HEALTH_CHECK_INTERVAL = float(os.getenv("CONVERSION_HEALTH_INTERVAL", "15"))
+PROFILE_ROOT = os.getenv("CONVERSION_PROFILE_ROOT", os.path.join(tempfile.gettempdir(), "recanalysis_lo_profiles"))
+BASE_PORT = int(os.getenv("CONVERSION_BASE_PORT", "2002"))
+# Na imagem python:3.11-slim o pacote python3-uno do Debian fica fora do sys.path.
+LIBREOFFICE_PYTHONPATH = os.getenv("LIBREOFFICE_PYTHONPATH", "/usr/lib/python3/dist-packages")
+
+try:
+    import uno
+    from com.sun.star.beans import PropertyValue
+    UNO_AVAILABLE = True
+except ImportError:
+    if LIBREOFFICE_PYTHONPATH and os.path.isdir(LIBREOFFICE_PYTHONPATH):
+        sys.path.append(LIBREOFFICE_PYTHONPATH)
+    try:
+        import uno
+        from com.sun.star.beans import PropertyValue
+        UNO_AVAILABLE = True
+    except ImportError:
+        UNO_AVAILABLE = False
+
+
+# --- Erros ---
+class ConversionError(Exception):
+    """Falha genérica na conversão para PDF."""
+
+class ConversionTimeout(ConversionError):
+    """A conversão excedeu CONVERSION_TIMEOUT."""
+
+class PoolSaturated(ConversionError):
+    """A fila do pool está cheia (back-pressure)."""
+
+class SofficeNotFound(ConversionError):
+    """O binário do LibreOffice não existe neste ambiente."""
+
+
+def _props(**kwargs):
+    return tuple(PropertyValue(Name=name, Value=value) for name, value in kwargs.items())
+
+
+class LibreOfficeWorker:
+    """Uma instância soffice headless com perfil e porta próprios."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.port = BASE_PORT + index
+        self.profile_dir = os.path.join(PROFILE_ROOT, f"worker_{index}")
+        self.process: subprocess.Popen | None = None
+        self.desktop = None
+        self.conversions = 0
+        self.busy_since: float | None = None
+        self.lock = threading.Lock()
+
+    @property
+    def profile_url(self) -> str:
+        return Path(self.profile_dir).resolve().as_uri()
+
+    def start(self):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        if not UNO_AVAILABLE:
+            return
+        command = [
+            SOFFICE_BIN, "--headless", "--invisible", "--nologo", "--norestore", "--nodefault",
+            f"-env:UserInstallation={self.profile_url}",
+            f"--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext",
+        ]
+        try:
+            self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except FileNotFoundError:
+            raise SofficeNotFound(SOFFICE_BIN)
+        self.desktop = self._connect()
+
+    def _connect(self):
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local_context
+        )
+        deadline = time.monotonic() + CONVERSION_TIMEOUT
+        while True:
+            try:
+                context = resolver.resolve(
+                    f"uno:socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext"
+                )
+                return context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
+            except Exception:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    raise ConversionError(f"Worker LibreOffice {self.index} não arrancou.")
+                time.sleep(0.25)
+
+    def stop(self):
+        if self.desktop is not None:
+            try:
+                self.desktop.terminate()
+            except Exception:
+                pass
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+        self.desktop = None
+
+    def restart(self):
+        self.stop()
+        self.conversions = 0
+        self.start()
+
+    def is_healthy(self) -> bool:
+        if not UNO_AVAILABLE:
+            return True
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            self.desktop.getComponents()
+            return True
+        except Exception:
+            return False
+
+    def kill(self):
+        """Termina à força uma conversão presa; o worker é reiniciado no próximo pedido."""
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+
+    def convert(self, docx_path: str, output_dir: str) -> str:
+        pdf_path = os.path.join(output_dir, Path(docx_path).stem + ".pdf")
+        if UNO_AVAILABLE:
+            self._convert_uno(docx_path, pdf_path)
+        else:
+            self._convert_subprocess(docx_path, output_dir)
+        self.conversions += 1
+        return pdf_path
+
+    def _convert_uno(self, docx_path: str, pdf_path: str):
+        source_url = uno.systemPathToFileUrl(os.path.abspath(docx_path))
+        target_url = uno.systemPathToFileUrl(os.path.abspath(pdf_path))
+        try:
+            document = self.desktop.loadComponentFromURL(source_url, "_blank", 0, _props(Hidden=True))
+        except Exception as e:
+            raise ConversionError(f"Falha ao abrir o DOCX no LibreOffice: {e}")
+        try:
+            document.storeToURL(target_url, _props(FilterName="writer_pdf_Export"))
+        except Exception as e:
+            raise ConversionError(f"Falha ao exportar o PDF: {e}")
+        finally:
+            try:
+                document.close(True)
+            except Exception:
+                pass
+
+    def _convert_subprocess(self, docx_path: str, output_dir: str):
+        try:
+            subprocess.run(
+                [SOFFICE_BIN, "--headless", f"-env:UserInstallation={self.profile_url}",
+                 "--convert-to", "pdf", "--outdir", output_dir, docx_path],
+                check=True,
+                timeout=CONVERSION_TIMEOUT,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        except FileNotFoundError:
+            raise SofficeNotFound(SOFFICE_BIN)
+        except subprocess.CalledProcessError as e:
+            raise ConversionError(str(e))
+        except subprocess.TimeoutExpired:
+            raise ConversionTimeout()
+
+
+class ConversionPool:
+    """
+    Fila limitada partilhada por POOL_SIZE workers LibreOffice.
+    Os workers são verificados antes de cada conversão e reciclados após
+    MAX_CONVERSIONS_PER_WORKER conversões; um supervisor mata conversões presas.
+    """
+
+    def __init__(self, size: int = POOL_SIZE, queue_max_size: int = QUEUE_MAX_SIZE):
+        self.size = max(1, size)
+        self.tasks: queue.Queue = queue.Queue(maxsize=queue_max_size)
+        self.workers = [LibreOfficeWorker(i) for i in range(self.size)]
+        self.threads: list[threading.Thread] = []
+        self.stopping = threading.Event()
+        self.started = False
+        self.stats = {"conversions": 0, "failures": 0, "timeouts": 0, "rejected": 0, "recycled": 0}
+
+    def start(self):
+        if self.started:
+            return
+        self.stopping.clear()
+        for worker in self.workers:
+            thread = threading.Thread(target=self._run_worker, args=(worker,), daemon=True,
+                                      name=f"lo-worker-{worker.index}")
+            thread.start()
+            self.threads.append(thread)
+        supervisor = threading.Thread(target=self._supervise, daemon=True, name="lo-supervisor")
+        supervisor.start()
+        self.threads.append(supervisor)
+        self.started = True
+        mode = "UNO/socket" if UNO_AVAILABLE else "subprocess com perfil dedicado"
+        print(f"Pool de conversão iniciado com {self.size} workers ({mode}).")
+
+    def shutdown(self):
+        self.stopping.set()
+        for _ in self.workers:
+            try:
+                self.tasks.put_nowait(None)
+            except queue.Full:
+                break
+        for worker in self.workers:
+            worker.stop()
+        self.threads.clear()
+        self.started = False
+
+    def submit(self, docx_path: str, output_dir: str) -> Future:
+        if not self.started:
+            self.start()
+        future: Future = Future()
+        try:
+            self.tasks.put_nowait((docx_path, output_dir, future))
+        except queue.Full:
+            self.stats["rejected"] += 1
+            raise PoolSaturated()
+        return future
+
+    def convert(self, docx_path: str, output_dir: str, timeout: float = CONVERSION_TIMEOUT) -> str:
+        """Converte um DOCX em PDF no pool e devolve o caminho do PDF gerado."""
+        future = self.submit(docx_path, output_dir)
+        try:
+            # Margem para o tempo de espera na fila além da conversão em si.
+            return future.result(timeout=timeout * 2)
+        except TimeoutError:
+            future.cancel()
+            self.stats["timeouts"] += 1
+            raise ConversionTimeout()
+
+    def status(self) -> dict:
+        return {
+            "mode": "uno" if UNO_AVAILABLE else "subprocess",
+            "workers": self.size,
+            "queue_depth": self.tasks.qsize(),
+            "queue_max_size": self.tasks.maxsize,
+            "busy": sum(1 for w in self.workers if w.busy_since is not None),
+            **self.stats,
+        }
+
+    def _ensure_ready(self, worker: LibreOfficeWorker):
+        if worker.conversions >= MAX_CONVERSIONS_PER_WORKER:
+            self.stats["recycled"] += 1
+            worker.restart()
+        elif not worker.is_healthy():
+            worker.restart()
+
+    def _run_worker(self, worker: LibreOfficeWorker):
+        try:
+            worker.start()
+        except ConversionError as e:
+            print(f"Worker LibreOffice {worker.index} não iniciou: {e}")
+        while not self.stopping.is_set():
+            task = self.tasks.get()
+            if task is None:
+                break
+            docx_path, output_dir, future = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            with worker.lock:
+                worker.busy_since = time.monotonic()
+                try:
+                    self._ensure_ready(worker)
+                    result = worker.convert(docx_path, output_dir)
+                    self.stats["conversions"] += 1
+                    future.set_result(result)
+                except Exception as e:
+                    self.stats["failures"] += 1
+                    future.set_exception(e if isinstance(e, ConversionError) else ConversionError(str(e)))
+                    # Um worker que falhou é reiniciado antes do próximo pedido.
+                    worker.conversions = MAX_CONVERSIONS_PER_WORKER
+                finally:
+                    worker.busy_since = None
+        worker.stop()
+
+    def _supervise(self):
+        while not self.stopping.wait(HEALTH_CHECK_INTERVAL):
+            now = time.monotonic()
+            for worker in self.workers:
+                busy_since = worker.busy_since
+                if busy_since is not None and now - busy_since > CONVERSION_TIMEOUT:
+                    print(f"Worker LibreOffice {worker.index} preso há {now - busy_since:.0f}s; a terminar.")
+                    worker.kill()
+
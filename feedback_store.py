@@ -0,0 +1,372 @@
+# feedback_store.py
+# Armazenamento do feedback dos analistas, partilhado pela API e pelo serviço de treinamento.
+#
+# - Uma ligação SQLite em modo WAL por thread, reutilizada entre pedidos.
+# - Escrita diferida: a API põe o feedback numa fila e uma thread grava-o em lotes,
+#   numa única transação por lote, fora do caminho do pedido.
+# - Migrações de esquema versionadas por PRAGMA user_version.
+# - Timestamps numéricos (epoch) e respostas JSON comprimidas com zlib.
+#
+# Apenas biblioteca padrão: o serviço de treinamento não instala dependências extra.
+
+import os
+import json
+import time
+import zlib
+import queue
+import sqlite3
+import datetime
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+FEEDBACK_BATCH_SIZE = int(os.getenv("FEEDBACK_BATCH_SIZE", "200"))
+FEEDBACK_FLUSH_INTERVAL = float(os.getenv("FEEDBACK_FLUSH_INTERVAL", "0.5"))
+FEEDBACK_QUEUE_MAX_SIZE = int(os.getenv("FEEDBACK_QUEUE_MAX_SIZE", "10000"))
+# Campos preenchidos pelo próprio sistema (o frontend substitui sempre o valor extraído):
+# a diferença não é uma correção do analista e não entra nas taxas por campo.
+SYSTEM_FILLED_FIELDS = frozenset({"escritorio_advogado_contato"})
+
+
+def pack_json(value: Any) -> bytes:
+    return zlib.compress(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+
+
+def unpack_json(value: Any) -> Any:
+    # Linhas anteriores à migração guardavam o JSON como texto.
+    if isinstance(value, (bytes, memoryview)):
+        value = zlib.decompress(value).decode("utf-8")
+    return json.loads(value)
+
+
+def pack_text(value: Optional[str]) -> Optional[bytes]:
+    return zlib.compress(value.encode("utf-8")) if value is not None else None
+
+
+def unpack_text(value: Any) -> Optional[str]:
+    if isinstance(value, (bytes, memoryview)):
+        return zlib.decompress(value).decode("utf-8")
+    return value
+
+
+def parse_timestamp(value: str, end_of_day: bool = False) -> float:
+    """Converte uma data (AAAA-MM-DD) ou data/hora ISO em epoch."""
+    if len(value) == 10:
+        day = datetime.date.fromisoformat(value)
+        if end_of_day:
+            day += datetime.timedelta(days=1)
+        return datetime.datetime.combine(day, datetime.time()).timestamp()
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def _migrate_v1(conn: sqlite3.Connection):
+    """Timestamps ISO -> epoch, respostas comprimidas e índices por form_type e timestamp."""
+    conn.execute("""
+    CREATE TABLE feedback_v1 (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp REAL NOT NULL,
+        form_type TEXT NOT NULL,
+        rag_context BLOB,
+        original_response BLOB NOT NULL,
+        corrected_response BLOB NOT NULL
+    )
+    """)
+    legacy = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'feedback'").fetchone()
+    if legacy:
+        cursor = conn.execute(
+            "SELECT id, timestamp, form_type, rag_context, original_response, corrected_response FROM feedback ORDER BY id"
+        )
+        while True:
+            rows = cursor.fetchmany(FEEDBACK_BATCH_SIZE)
+            if not rows:
+                break
+            conn.executemany(
+                "INSERT INTO feedback_v1 (id, timestamp, form_type, rag_context, original_response, corrected_response) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (row[0], parse_timestamp(row[1]), row[2], pack_text(row[3]),
+                     pack_json(json.loads(row[4])), pack_json(json.loads(row[5])))
+                    for row in rows
+                ],
+            )
+        conn.execute("DROP TABLE feedback")
+    conn.execute("ALTER TABLE feedback_v1 RENAME TO feedback")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_feedback_form_type_timestamp ON feedback (form_type, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_feedback_timestamp ON feedback (timestamp)")
+
+
+def _day(timestamp: float) -> str:
+    return datetime.date.fromtimestamp(timestamp).isoformat()
+
+
+def _normalize_value(value: Any) -> Any:
+    # Espaços à volta e campos vazios/ausentes não contam como correção.
+    if value is None:
+        return ""
+    return value.strip() if isinstance(value, str) else value
+
+
+def field_corrections(original: Dict[str, Any], corrected: Dict[str, Any],
+                      fields: Optional[List[str]] = None) -> Dict[str, bool]:
+    """Para cada campo revisto, indica se o analista alterou o valor extraído."""
+    if fields is None:
+        fields = sorted(set(original) | set(corrected))
+    return {field: _normalize_value(original.get(field)) != _normalize_value(corrected.get(field))
+            for field in fields if field not in SYSTEM_FILLED_FIELDS}
+
+
+def _update_field_stats(conn: sqlite3.Connection, reviews: List[Tuple[float, str, Dict[str, bool]]]):
+    """Soma um lote de revisões (timestamp, form_type, correções por campo) aos agregados diários."""
+    totals: Dict[Tuple[str, str], List[int]] = {}
+    fields: Dict[Tuple[str, str, str], List[int]] = {}
+    for timestamp, form_type, corrections in reviews:
+        day = _day(timestamp)
+        total = totals.setdefault((form_type, day), [0, 0])
+        total[0] += 1
+        total[1] += any(corrections.values())
+        for field, was_corrected in corrections.items():
+            counts = fields.setdefault((form_type, day, field), [0, 0])
+            counts[0] += 1
+            counts[1] += was_corrected
+    conn.executemany(
+        """INSERT INTO feedback_daily_totals (form_type, day, reviews, corrected_reviews) VALUES (?, ?, ?, ?)
+        ON CONFLICT (form_type, day) DO UPDATE SET
+            reviews = reviews + excluded.reviews, corrected_reviews = corrected_reviews + excluded.corrected_reviews""",
+        [(*key, *counts) for key, counts in totals.items()],
+    )
+    conn.executemany(
+        """INSERT INTO feedback_field_stats (form_type, day, field, reviewed, corrected) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (form_type, day, field) DO UPDATE SET
+            reviewed = reviewed + excluded.reviewed, corrected = corrected + excluded.corrected""",
+        [(*key, *counts) for key, counts in fields.items()],
+    )
+
+
+def _migrate_v2(conn: sqlite3.Connection):
+    """Agregados diários de correções por form_type e campo, preenchidos a partir do feedback existente."""
+    conn.execute("""
+    CREATE TABLE feedback_daily_totals (
+        form_type TEXT NOT NULL,
+        day TEXT NOT NULL,
+        reviews INTEGER NOT NULL,
+        corrected_reviews INTEGER NOT NULL,
+        PRIMARY KEY (form_type, day)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("""
+    CREATE TABLE feedback_field_stats (
+        form_type TEXT NOT NULL,
+        day TEXT NOT NULL,
+        field TEXT NOT NULL,
+        reviewed INTEGER NOT NULL,
+        corrected INTEGER NOT NULL,
+        PRIMARY KEY (form_type, day, field)
+    ) WITHOUT ROWID
+    """)
+    # Até aqui só se guardavam as revisões com alterações: o histórico entra sem as revisões aceites tal como vieram.
+    # field_corrections ignora SYSTEM_FILLED_FIELDS, nos campos e no total de revisões corrigidas.
+    cursor = conn.execute("SELECT timestamp, form_type, original_response, corrected_response FROM feedback ORDER BY id")
+    while True:
+        rows = cursor.fetchmany(FEEDBACK_BATCH_SIZE)
+        if not rows:
+            break
+        _update_field_stats(conn, [
+            (row[0], row[1], field_corrections(unpack_json(row[2]), unpack_json(row[3])))
+            for row in rows
+        ])
+
+
+# Cada migração leva o esquema da versão i à versão i + 1.
+MIGRATIONS = [_migrate_v1, _migrate_v2]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+class FeedbackStore:
+    """Acesso ao feedback: leituras diretas e escritas em lote por uma thread dedicada."""
+
+    def __init__(self, path: str, batch_size: int = FEEDBACK_BATCH_SIZE,
+                 flush_interval: float = FEEDBACK_FLUSH_INTERVAL, max_queue_size: int = FEEDBACK_QUEUE_MAX_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self.pending: "queue.Queue[Optional[Tuple]]" = queue.Queue(maxsize=max_queue_size)
+        self.writer: Optional[threading.Thread] = None
+        self.counters = {"enqueued": 0, "written": 0, "batches": 0, "write_errors": 0}
+        self.migrate()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def migrate(self) -> int:
+        """Aplica as migrações em falta; devolve a versão final do esquema."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for index in range(version, SCHEMA_VERSION):
+                MIGRATIONS[index](conn)
+                print(f"Base de dados de feedback '{self.path}' migrada para a versão {index + 1} do esquema.")
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return SCHEMA_VERSION
+
+    # --- Escrita ---
+
+    def start(self):
+        if self.writer is None:
+            self.writer = threading.Thread(target=self._write_loop, daemon=True, name="feedback-writer")
+            self.writer.start()
+
+    def close(self):
+        """Grava o que estiver na fila e termina a thread de escrita."""
+        if self.writer is not None:
+            self.pending.put(None)
+            self.writer.join()
+            self.writer = None
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def enqueue(self, form_type: str, rag_context: Optional[str], original: Dict[str, Any], corrected: Dict[str, Any],
+                fields: Optional[List[str]] = None) -> bool:
+        """
+        Põe uma revisão na fila de escrita; devolve False se a fila estiver cheia.
+        Todas as revisões contam para os agregados por campo; só as alteradas ficam na tabela de feedback.
+        """
+        record = (time.time(), form_type, rag_context, original, corrected, fields)
+        try:
+            self.pending.put_nowait(record)
+        except queue.Full:
+            return False
+        self.counters["enqueued"] += 1
+        return True
+
+    def insert(self, form_type: str, rag_context: Optional[str], original: Dict[str, Any], corrected: Dict[str, Any],
+               fields: Optional[List[str]] = None):
+        """Escrita síncrona, para quando a fila está cheia."""
+        self.insert_many([(time.time(), form_type, rag_context, original, corrected, fields)])
+
+    def insert_many(self, records: List[Tuple]):
+        """Grava (timestamp, form_type, rag_context, original, corrected, fields) e os agregados numa única transação."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO feedback (timestamp, form_type, rag_context, original_response, corrected_response) VALUES (?, ?, ?, ?, ?)",
+                [(ts, form_type, pack_text(rag_context), pack_json(original), pack_json(corrected))
+                 for ts, form_type, rag_context, original, corrected, _ in records if original != corrected],
+            )
+            _update_field_stats(conn, [
+                (ts, form_type, field_corrections(original, corrected, fields))
+                for ts, form_type, _, original, corrected, fields in records
+            ])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self.counters["written"] += len(records)
+        self.counters["batches"] += 1
+
+    def _write_loop(self):
+        stopping = False
+        while not stopping:
+            record = self.pending.get()
+            if record is None:
+                break
+            batch = [record]
+            # Junta o que chegar durante flush_interval (até batch_size) num único commit.
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.pending.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if record is None:
+                    stopping = True
+                    break
+                batch.append(record)
+            try:
+                self.insert_many(batch)
+            except Exception as e:
+                self.counters["write_errors"] += 1
+                print(f"ERRO ao guardar {len(batch)} registos de feedback na base de dados: {e}")
+
+    # --- Leitura ---
+
+    def max_id(self, clauses: List[str], params: List[Any]) -> Optional[int]:
+        where = " AND ".join(clauses) or "1"
+        return self._conn().execute(f"SELECT MAX(id) FROM feedback WHERE {where}", params).fetchone()[0]
+
+    def iter_pages(self, clauses: List[str], params: List[Any], max_id: int, page_size: int) -> Iterator[List[Dict[str, Any]]]:
+        """Percorre o feedback por chave (id > último id), uma página de cada vez, já descomprimido."""
+        last_id = 0
+        where = " AND ".join(clauses + ["id > ?", "id <= ?"])
+        while True:
+            rows = self._conn().execute(
+                f"SELECT * FROM feedback WHERE {where} ORDER BY id LIMIT ?", (*params, last_id, max_id, page_size)
+            ).fetchall()
+            if not rows:
+                return
+            yield [
+                {
+                    "id": row["id"],
+                    "timestamp": row["timestamp"],
+                    "form_type": row["form_type"],
+                    "rag_context": unpack_text(row["rag_context"]),
+                    "original_response": unpack_json(row["original_response"]),
+                    "corrected_response": unpack_json(row["corrected_response"]),
+                }
+                for row in rows
+            ]
+            last_id = rows[-1]["id"]
+
+    def field_stats(self, form_type: Optional[str] = None, start_day: Optional[str] = None,
+                    end_day: Optional[str] = None, period: str = "month") -> List[Dict[str, Any]]:
+        """
+        Taxas de correção por campo, lidas dos agregados (sem percorrer o feedback).
+        period: 'day', 'month' ou 'total'.
+        """
+        period_expr = {"day": "day", "month": "substr(day, 1, 7)", "total": "'total'"}[period]
+        clauses, params = [], []
+        if form_type:
+            clauses.append("form_type = ?")
+            params.append(form_type)
+        if start_day:
+            clauses.append("day >= ?")
+            params.append(start_day)
+        if end_day:
+            clauses.append("day <= ?")
+            params.append(end_day)
+        where = " AND ".join(clauses) or "1"
+        conn = self._conn()
+        groups: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        for row in conn.execute(
+            f"SELECT form_type, {period_expr} AS period, SUM(reviews) AS reviews, SUM(corrected_reviews) AS corrected_reviews "
+            f"FROM feedback_daily_totals WHERE {where} GROUP BY form_type, period ORDER BY form_type, period", params
+        ):
+            groups[(row["form_type"], row["period"])] = {
+                "form_type": row["form_type"], "period": row["period"],
+                "reviews": row["reviews"], "corrected_reviews": row["corrected_reviews"], "fields": {},
+            }
+        for row in conn.execute(
+            f"SELECT form_type, {period_expr} AS period, field, SUM(reviewed) AS reviewed, SUM(corrected) AS corrected "
+            f"FROM feedback_field_stats WHERE {where} GROUP BY form_type, period, field", params
+        ):
+            groups[(row["form_type"], row["period"])]["fields"][row["field"]] = {
+                "reviewed": row["reviewed"], "corrected": row["corrected"],
+                "correction_rate": round(row["corrected"] / row["reviewed"], 4) if row["reviewed"] else 0.0,
+            }
+        return list(groups.values())
+
+    def stats(self) -> Dict[str, Any]:
+        return {"queue_depth": self.pending.qsize(), "schema_version": SCHEMA_VERSION, **self.counters}
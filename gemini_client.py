@@ -0,0 +1,177 @@
+# gemini_client.py
+# Cliente HTTP partilhado para a API Gemini.
+#
+# Uma única ligação (HTTP/2 keep-alive quando o pacote 'h2' está instalado) durante
+# toda a vida da aplicação, com limite de concorrência, token bucket opcional para a
+# taxa de pedidos e repetições com backoff exponencial + jitter em 429/5xx.
+# GEMINI_API_BASE permite apontar para um servidor Gemini de simulação local.
+
+import os
+import time
+import random
+import asyncio
+from typing import Any, Dict, Optional
+
+import httpx
+
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com")
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "120"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_RATE_PER_SECOND = float(os.getenv("GEMINI_RATE_PER_SECOND", "0"))  # 0 = sem limite de taxa
+GEMINI_RATE_BURST = int(os.getenv("GEMINI_RATE_BURST", "5"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "5"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "1.0"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "30"))
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Limita a taxa média de pedidos, permitindo rajadas até 'burst'."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> float:
+        """Consome um token; devolve o tempo de espera em segundos."""
+        waited = 0.0
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+                waited += delay
+                await asyncio.sleep(delay)
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class GeminiClient:
+    """Cliente de longa duração, partilhado por todas as análises do processo."""
+
+    def __init__(self):
+        self.client: Optional[httpx.AsyncClient] = None
+        self.semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+        self.bucket = TokenBucket(GEMINI_RATE_PER_SECOND, GEMINI_RATE_BURST) if GEMINI_RATE_PER_SECOND > 0 else None
+        self.in_flight = 0
+        self.waiting = 0
+        self.stats_counters: Dict[str, Any] = {
+            "requests": 0,
+            "successes": 0,
+            "failures": 0,
+            "retries": 0,
+            "retries_by_status": {},
+            "concurrency_wait_seconds": 0.0,
+            "rate_limit_wait_seconds": 0.0,
+            "backoff_wait_seconds": 0.0,
+            "prompt_tokens": 0,
+            "response_tokens": 0,
+            "cached_tokens": 0,
+            "cache_creations": 0,
+            "cache_creation_failures": 0,
+        }
+
+    async def start(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                http2=_http2_available(),
+                timeout=GEMINI_TIMEOUT,
+                limits=httpx.Limits(max_connections=GEMINI_MAX_CONCURRENCY, max_keepalive_connections=GEMINI_MAX_CONCURRENCY),
+            )
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _backoff(self, attempt: int, response: Optional[httpx.Response]) -> float:
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            return min(GEMINI_BACKOFF_MAX, float(response.headers["Retry-After"]))
+        # Backoff exponencial com "full jitter"
+        return random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * (2 ** attempt)))
+
+    def _count_retry(self, reason: str):
+        self.stats_counters["retries"] += 1
+        by_status = self.stats_counters["retries_by_status"]
+        by_status[reason] = by_status.get(reason, 0) + 1
+
+    def _count_tokens(self, usage: Dict[str, Any]):
+        self.stats_counters["prompt_tokens"] += usage.get("promptTokenCount", 0)
+        self.stats_counters["response_tokens"] += usage.get("candidatesTokenCount", 0)
+        self.stats_counters["cached_tokens"] += usage.get("cachedContentTokenCount", 0)
+
+    async def generate_content(self, url: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """POST generateContent com limite de concorrência/taxa e repetições em 429/5xx."""
+        await self.start()
+        self.stats_counters["requests"] += 1
+        self.waiting += 1
+        started_wait = time.monotonic()
+        async with self.semaphore:
+            self.waiting -= 1
+            self.stats_counters["concurrency_wait_seconds"] += time.monotonic() - started_wait
+            self.in_flight += 1
+            try:
+                for attempt in range(GEMINI_MAX_RETRIES + 1):
+                    if self.bucket is not None:
+                        self.stats_counters["rate_limit_wait_seconds"] += await self.bucket.acquire()
+                    response: Optional[httpx.Response] = None
+                    try:
+                        response = await self.client.post(url, json=payload)
+                    except (httpx.TimeoutException, httpx.TransportError) as e:
+                        if attempt == GEMINI_MAX_RETRIES:
+                            raise
+                        self._count_retry(type(e).__name__)
+                    else:
+                        if response.status_code not in RETRYABLE_STATUS_CODES or attempt == GEMINI_MAX_RETRIES:
+                            response.raise_for_status()
+                            self.stats_counters["successes"] += 1
+                            result = response.json()
+                            self._count_tokens(result.get("usageMetadata") or {})
+                            return result
+                        self._count_retry(str(response.status_code))
+                    delay = self._backoff(attempt, response)
+                    self.stats_counters["backoff_wait_seconds"] += delay
+                    await asyncio.sleep(delay)
+            except Exception:
+                self.stats_counters["failures"] += 1
+                raise
+            finally:
+                self.in_flight -= 1
+
+    async def create_cached_content(self, url: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        POST cachedContents, sem repetições (quem chama volta a tentar mais tarde). Contado à
+        parte: não entra nos pedidos/sucessos de generateContent nem no limite de concorrência.
+        """
+        await self.start()
+        try:
+            if self.bucket is not None:
+                await self.bucket.acquire()
+            response = await self.client.post(url, json=payload)
+            response.raise_for_status()
+            result = response.json()
+        except Exception:
+            self.stats_counters["cache_creation_failures"] += 1
+            raise
+        self.stats_counters["cache_creations"] += 1
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        counters = dict(self.stats_counters)
+        for key in ("concurrency_wait_seconds", "rate_limit_wait_seconds", "backoff_wait_seconds"):
+            counters[key] = round(counters[key], 3)
+        return {"in_flight": self.in_flight, "waiting": self.waiting, **counters}
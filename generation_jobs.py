@@ -0,0 +1,237 @@
+# generation_jobs.py
+# Trabalhos de geração de documentos com deduplicação e ciclo de vida dos ficheiros.
+#
+# Os artefactos são endereçados pelo conteúdo: o mesmo (form_type, form_data,
+# versão do template) gera sempre os mesmos '{form_type}_{hash}.docx/.pdf'. Pedidos
+# idênticos em curso partilham o mesmo trabalho e pedidos repetidos reutilizam os
+# ficheiros já gerados. Um janitor aplica TTL e quota de disco à pasta 'output/'.
+
+import os
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Optional
+
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", str(os.cpu_count() or 1)))
+GENERATION_JOB_RETENTION = float(os.getenv("GENERATION_JOB_RETENTION", "3600"))
+OUTPUT_TTL_SECONDS = float(os.getenv("OUTPUT_TTL_SECONDS", str(7 * 24 * 3600)))
+OUTPUT_MAX_BYTES = int(os.getenv("OUTPUT_MAX_BYTES", str(1024 * 1024 * 1024)))
+OUTPUT_JANITOR_INTERVAL = float(os.getenv("OUTPUT_JANITOR_INTERVAL", "300"))
+# Artefactos gerados ou reutilizados há menos tempo do que isto não são removidos pelo janitor.
+OUTPUT_REUSE_GRACE = float(os.getenv("OUTPUT_REUSE_GRACE", "600"))
+
+
+class GenerationError(Exception):
+    """Falha na geração, com o código HTTP a devolver ao cliente."""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def generation_key(form_type: str, form_data: Dict[str, Any], template_version: str) -> str:
+    canonical = json.dumps({"form_type": form_type, "form_data": form_data, "template": template_version},
+                           sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+
+def artifact_filenames(form_type: str, key: str) -> Dict[str, str]:
+    base = f"{form_type}_{key}"
+    return {"docx_filename": f"{base}.docx", "pdf_filename": f"{base}.pdf"}
+
+
+class GenerationJob:
+    def __init__(self, key: str, form_type: str, trace_id: Optional[str] = None):
+        self.key = key
+        self.form_type = form_type
+        self.trace_id = trace_id
+        self.status = "queued"  # queued -> running -> ready | failed
+        self.result: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+        self.error_status_code: Optional[int] = None
+        self.future: Optional[Future] = None
+        self.deduplicated = False
+        self.finished_at: Optional[float] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.key,
+            "status": self.status,
+            "form_type": self.form_type,
+            "deduplicated": self.deduplicated,
+            "error": self.error,
+            "error_status_code": self.error_status_code,
+            "trace_id": self.trace_id,
+            **artifact_filenames(self.form_type, self.key),
+            **self.result,
+        }
+
+
+class GenerationJobManager:
+    """Executa as gerações num pool de threads, partilhando trabalhos idênticos."""
+
+    def __init__(self, output_folder: str, generate: Callable[[str, str, Dict[str, Any]], Dict[str, Any]],
+                 form_types: Iterable[str], workers: int = GENERATION_WORKERS):
+        self.output_folder = output_folder
+        self.generate = generate
+        # Tipos de formulário possíveis: os nomes dos artefactos de uma chave derivam deles.
+        self.form_types = list(form_types)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="generation")
+        self.jobs: Dict[str, GenerationJob] = {}
+        self.lock = threading.Lock()
+        self.counters = {"submitted": 0, "deduplicated_in_flight": 0, "reused_artifacts": 0, "generated": 0, "failed": 0}
+
+    def _artifacts_exist(self, form_type: str, key: str) -> bool:
+        names = artifact_filenames(form_type, key)
+        return all(os.path.exists(os.path.join(self.output_folder, name)) for name in names.values())
+
+    def _touch(self, form_type: str, key: str):
+        # Renova o TTL dos artefactos reutilizados.
+        for name in artifact_filenames(form_type, key).values():
+            try:
+                os.utime(os.path.join(self.output_folder, name))
+            except OSError:
+                pass
+
+    def _forget_old_jobs(self):
+        cutoff = time.time() - GENERATION_JOB_RETENTION
+        for key in [k for k, job in self.jobs.items() if job.finished_at and job.finished_at < cutoff]:
+            del self.jobs[key]
+
+    def submit(self, key: str, form_type: str, form_data: Dict[str, Any], trace_id: Optional[str] = None) -> GenerationJob:
+        with self.lock:
+            self.counters["submitted"] += 1
+            self._forget_old_jobs()
+            job = self.jobs.get(key)
+            if job is not None and job.status in ("queued", "running"):
+                self.counters["deduplicated_in_flight"] += 1
+                job.deduplicated = True
+                return job
+            if self._artifacts_exist(form_type, key):
+                self.counters["reused_artifacts"] += 1
+                self._touch(form_type, key)
+                job = GenerationJob(key, form_type, trace_id)
+                job.status = "ready"
+                job.deduplicated = True
+                job.finished_at = time.time()
+                self.jobs[key] = job
+                return job
+            job = GenerationJob(key, form_type, trace_id)
+            self.jobs[key] = job
+            job.future = self.executor.submit(self._run, job, form_data)
+            return job
+
+    def _run(self, job: GenerationJob, form_data: Dict[str, Any]):
+        job.status = "running"
+        try:
+            job.result = self.generate(job.key, job.form_type, form_data)
+            job.status = "ready"
+            self.counters["generated"] += 1
+        except GenerationError as e:
+            job.status, job.error, job.error_status_code = "failed", e.detail, e.status_code
+            self.counters["failed"] += 1
+        except Exception as e:
+            job.status, job.error, job.error_status_code = "failed", str(e), 500
+            self.counters["failed"] += 1
+            print(f"ERRO na geração {job.key} (trace {job.trace_id}): {e}")
+        finally:
+            job.finished_at = time.time()
+        return job
+
+    def get(self, key: str) -> Optional[GenerationJob]:
+        job = self.jobs.get(key)
+        if job is not None:
+            return job
+        # Trabalho concluído por outro processo (ou antes de um reinício): os artefactos bastam.
+        # Verifica só os nomes possíveis da chave, sem listar a pasta (chamado a cada long-poll).
+        for form_type in self.form_types:
+            if self._artifacts_exist(form_type, key):
+                job = GenerationJob(key, form_type)
+                job.status = "ready"
+                job.finished_at = time.time()
+                return job
+        return None
+
+    def protected_files(self) -> set:
+        """Artefactos em curso e os gerados ou reutilizados recentemente (já entregues a clientes)."""
+        cutoff = time.time() - OUTPUT_REUSE_GRACE
+        with self.lock:
+            return {
+                name
+                for job in self.jobs.values()
+                if job.status in ("queued", "running") or (job.finished_at or 0) >= cutoff
+                for name in artifact_filenames(job.form_type, job.key).values()
+            }
+
+    def stats(self) -> Dict[str, Any]:
+        in_flight = sum(1 for job in self.jobs.values() if job.status in ("queued", "running"))
+        return {"in_flight": in_flight, **self.counters}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class OutputJanitor:
+    """Remove periodicamente os artefactos expirados e aplica a quota de disco de 'output/'."""
+
+    def __init__(self, output_folder: str, manager: GenerationJobManager):
+        self.output_folder = output_folder
+        self.manager = manager
+        self.stopping = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.last_run: Dict[str, Any] = {}
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, daemon=True, name="output-janitor")
+            self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def _loop(self):
+        while not self.stopping.is_set():
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"ERRO na limpeza da pasta '{self.output_folder}': {e}")
+            self.stopping.wait(OUTPUT_JANITOR_INTERVAL)
+
+    def sweep(self) -> Dict[str, Any]:
+        now = time.time()
+        protected = self.manager.protected_files()
+        files = []
+        for entry in os.scandir(self.output_folder):
+            if entry.is_file() and entry.name not in protected:
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        removed, freed = 0, 0
+        kept = []
+        for mtime, size, path in files:
+            if now - mtime > OUTPUT_TTL_SECONDS:
+                removed, freed = removed + self._remove(path), freed + size
+            else:
+                kept.append((mtime, size, path))
+
+        # Acima da quota, remove primeiro os artefactos mais antigos.
+        total = sum(size for _, size, _ in kept)
+        for mtime, size, path in sorted(kept):
+            if total <= OUTPUT_MAX_BYTES:
+                break
+            removed, freed = removed + self._remove(path), freed + size
+            total -= size
+
+        self.last_run = {"at": now, "removed_files": removed, "freed_bytes": freed, "used_bytes": total}
+        return self.last_run
+
+    @staticmethod
+    def _remove(path: str) -> int:
+        try:
+            os.remove(path)
+            return 1
+        except OSError:
+            return 0
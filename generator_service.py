@@ -9,28 +9,57 @@
 # 4. Execute no seu terminal: uvicorn generator_service:app --reload
 
 import os
-import uuid
-import subprocess
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+import re
+import shutil
+import tempfile
+import asyncio
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
-from docxtpl import DocxTemplate
+from conversion_pool import ConversionPool, ConversionError, ConversionTimeout, PoolSaturated, SofficeNotFound
+from template_cache import TemplateCache
+from metrics import instrument_app, stage_timer, track_queues, current_trace_id
+from generation_jobs import GenerationError, GenerationJobManager, OutputJanitor, artifact_filenames, generation_key
 
 # --- Inicialização da Aplicação FastAPI ---
 app = FastAPI(
     title="recANALYSIS Document Generator",
     description="Serviço para gerar documentos .docx e .pdf a partir de templates.",
-    version="1.1.0"
+    version="1.3.0"
 )
 
+# --- Métricas (/metrics) e trace ids opcionais (TRACE_IDS=1) ---
+instrument_app(app)
+
 # --- Configuração de Pastas ---
 TEMPLATE_FOLDER = "templates"
 OUTPUT_FOLDER = "output"
 os.makedirs(TEMPLATE_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
+# --- Pool de Conversão LibreOffice ---
+# Instâncias soffice persistentes, uma por núcleo, cada uma com o seu perfil.
+conversion_pool = ConversionPool()
+
+# --- Configuração dos Trabalhos de Geração ---
+# Tempo máximo que um pedido síncrono ou de long-polling espera por um trabalho.
+GENERATION_WAIT_TIMEOUT = float(os.getenv("GENERATION_WAIT_TIMEOUT", "90"))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+@app.on_event("startup")
+def startup_event():
+    conversion_pool.start()
+    template_cache.warm(TEMPLATE_MAPPING.values())
+    output_janitor.start()
+
+@app.on_event("shutdown")
+def shutdown_event():
+    output_janitor.stop()
+    generation_jobs.shutdown()
+    conversion_pool.shutdown()
+
 # --- Modelos de Dados (Pydantic) ---
 class GenerationPayload(BaseModel):
     form_type: str
@@ -43,73 +72,209 @@ TEMPLATE_MAPPING = {
     "autorizacao": "13.4.1. Súmula de Autorização para Interposição de Recurso.docx"
 }
 
+# --- Cache de Templates ---
+# Templates lidos e compilados uma única vez; recarregados quando o ficheiro muda.
+template_cache = TemplateCache(TEMPLATE_FOLDER)
+
 # --- Endpoints da API ---
 
 @app.get("/")
 def read_root():
     return {"message": "Serviço de Geração de Documentos está ativo."}
 
-@app.post("/api/v1/generate-document", status_code=201)
-def create_document(payload: GenerationPayload):
+def generate_artifacts(key: str, form_type: str, form_data: Dict[str, Any]) -> Dict[str, Any]:
     """
-    Gera um ficheiro .docx e um .pdf a partir de dados e um tipo de formulário.
+    Gera o .docx e o .pdf de um trabalho; os nomes dos ficheiros derivam da chave de conteúdo.
     """
-    template_name = TEMPLATE_MAPPING.get(payload.form_type)
-    if not template_name:
-        raise HTTPException(status_code=400, detail="Tipo de formulário inválido.")
-
-    template_path = os.path.join(TEMPLATE_FOLDER, template_name)
-    if not os.path.exists(template_path):
-        raise HTTPException(status_code=500, detail=f"Ficheiro de template não encontrado: {template_name}")
-
-    unique_id = str(uuid.uuid4())
-    docx_filename = f"{payload.form_type}_{unique_id}.docx"
+    template_name = TEMPLATE_MAPPING[form_type]
+    docx_filename = artifact_filenames(form_type, key)["docx_filename"]
     docx_filepath = os.path.join(OUTPUT_FOLDER, docx_filename)
 
     # O contexto são os dados do formulário recebidos diretamente.
     # As chaves no seu template .docx devem corresponder às chaves no form_data.
     # Ex: {{ data_publicacao }}, {{ numero_processo }}, etc.
-    context = payload.form_data
-
     try:
-        doc = DocxTemplate(template_path)
-        doc.render(context)
-        doc.save(docx_filepath)
+        with stage_timer("docx_render"):
+            docx_bytes, render_ms = template_cache.render(template_name, form_data)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Falha ao renderizar o template DOCX: {e}")
+        raise GenerationError(500, f"Falha ao renderizar o template DOCX: {e}")
+    # Única escrita em disco: o DOCX final, que é também a entrada do LibreOffice.
+    # Escrito num ficheiro temporário e renomeado, para nunca expor um DOCX incompleto.
+    temp_filepath = f"{docx_filepath}.{os.getpid()}.tmp"
+    with open(temp_filepath, "wb") as f:
+        f.write(docx_bytes)
+    os.replace(temp_filepath, docx_filepath)
 
-    # Converte o DOCX gerado para PDF usando LibreOffice
+    # Converte o DOCX gerado para PDF no pool de instâncias LibreOffice, numa pasta temporária:
+    # o PDF só aparece em 'output/' (onde a sua existência marca o trabalho como concluído)
+    # depois de escrito por completo.
+    conversion_dir = tempfile.mkdtemp(prefix=".convert-", dir=OUTPUT_FOLDER)
     try:
-        subprocess.run(
-            ["soffice", "--headless", "--convert-to", "pdf", "--outdir", OUTPUT_FOLDER, docx_filepath],
-            check=True,
-            timeout=60
-        )
+        with stage_timer("pdf_conversion"):
+            temp_pdf_filepath = conversion_pool.convert(docx_filepath, conversion_dir)
+        if not os.path.exists(temp_pdf_filepath):
+            raise GenerationError(500, "Ficheiro PDF não foi criado após a conversão.")
+        os.replace(temp_pdf_filepath, os.path.join(OUTPUT_FOLDER, artifact_filenames(form_type, key)["pdf_filename"]))
+    except PoolSaturated:
+        raise GenerationError(503, "Serviço de conversão sobrecarregado. Tente novamente dentro de instantes.")
+    except SofficeNotFound:
+        raise GenerationError(500, "Comando 'soffice' (LibreOffice) não encontrado. Este serviço deve ser executado num ambiente com LibreOffice instalado.")
+    except ConversionTimeout:
+        raise GenerationError(500, "A conversão para PDF demorou demasiado tempo (timeout).")
+    except ConversionError as e:
+        raise GenerationError(500, f"Falha na conversão para PDF: {e}")
+    finally:
+        shutil.rmtree(conversion_dir, ignore_errors=True)
+
+    return {"render_ms": round(render_ms, 2)}
+
+# --- Trabalhos de Geração ---
+# Pedidos idênticos partilham o mesmo trabalho e os mesmos artefactos em 'output/';
+# o janitor aplica TTL e quota de disco aos artefactos que não estão em curso.
+generation_jobs = GenerationJobManager(OUTPUT_FOLDER, generate_artifacts, TEMPLATE_MAPPING)
+output_janitor = OutputJanitor(OUTPUT_FOLDER, generation_jobs)
+track_queues(lambda: {
+    "conversion": conversion_pool.status()["queue_depth"],
+    "generation_jobs": generation_jobs.stats()["in_flight"],
+})
+
+def submit_generation(payload: GenerationPayload):
+    template_name = TEMPLATE_MAPPING.get(payload.form_type)
+    if not template_name:
+        raise HTTPException(status_code=400, detail="Tipo de formulário inválido.")
+
+    try:
+        template = template_cache.get(template_name)
     except FileNotFoundError:
-        raise HTTPException(status_code=500, detail="Comando 'soffice' (LibreOffice) não encontrado. Este serviço deve ser executado num ambiente com LibreOffice instalado.")
-    except subprocess.CalledProcessError as e:
-        raise HTTPException(status_code=500, detail=f"Falha na conversão para PDF: {e}")
-    except subprocess.TimeoutExpired:
-        raise HTTPException(status_code=500, detail="A conversão para PDF demorou demasiado tempo (timeout).")
-
-    pdf_filename = docx_filename.replace(".docx", ".pdf")
-    pdf_filepath = os.path.join(OUTPUT_FOLDER, pdf_filename)
-
-    if not os.path.exists(pdf_filepath):
-         raise HTTPException(status_code=500, detail="Ficheiro PDF não foi criado após a conversão.")
-
-    return {
-        "message": "Documentos gerados com sucesso.",
-        "docx_filename": docx_filename,
-        "pdf_filename": pdf_filename
-    }
+        raise HTTPException(status_code=500, detail=f"Ficheiro de template não encontrado: {template_name}")
+
+    # A versão do template entra na chave: editar o template gera novos artefactos.
+    key = generation_key(payload.form_type, payload.form_data, str(template.mtime))
+    return generation_jobs.submit(key, payload.form_type, payload.form_data, trace_id=current_trace_id())
+
+def generation_response(job) -> Dict[str, Any]:
+    if job.status == "failed":
+        headers = {"Retry-After": "5"} if job.error_status_code == 503 else None
+        raise HTTPException(status_code=job.error_status_code or 500, detail=job.error, headers=headers)
+    return {"message": "Documentos gerados com sucesso.", **job.to_dict()}
+
+@app.post("/api/v1/generate-document", status_code=201)
+def create_document(payload: GenerationPayload):
+    """
+    Gera um ficheiro .docx e um .pdf a partir de dados e um tipo de formulário e espera pelo resultado.
+    """
+    job = submit_generation(payload)
+    if job.future is not None:
+        try:
+            job.future.result(timeout=GENERATION_WAIT_TIMEOUT)
+        except TimeoutError:
+            raise HTTPException(status_code=504, detail="A geração dos documentos demorou demasiado tempo.")
+    return generation_response(job)
+
+@app.post("/api/v1/generation-jobs", status_code=202)
+def create_generation_job(payload: GenerationPayload):
+    """
+    Submete a geração como trabalho e devolve imediatamente o seu identificador (o hash do conteúdo).
+    """
+    return submit_generation(payload).to_dict()
+
+@app.get("/api/v1/generation-jobs/{job_id}")
+async def get_generation_job(job_id: str, wait: float = 0):
+    """
+    Estado de um trabalho de geração. Com 'wait' (segundos), espera pela conclusão (long-polling).
+    """
+    job = generation_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabalho de geração não encontrado.")
+    if wait > 0 and job.future is not None and not job.future.done():
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(job.future)), min(wait, GENERATION_WAIT_TIMEOUT))
+        except asyncio.TimeoutError:
+            pass
+    return job.to_dict()
+
+@app.get("/api/v1/generation-jobs")
+def get_generation_stats():
+    """
+    Contadores dos trabalhos de geração (deduplicação, reutilização) e a última limpeza de 'output/'.
+    """
+    return {**generation_jobs.stats(), "janitor": output_janitor.last_run}
+
+@app.get("/api/v1/conversion-pool")
+def get_conversion_pool_status():
+    """
+    Estado do pool de conversão: profundidade da fila, workers ocupados e contadores.
+    """
+    return conversion_pool.status()
+
+@app.get("/api/v1/templates/stats")
+def get_template_stats():
+    """
+    Tempos de renderização por template e número de partes Jinja2 compiladas em cache.
+    """
+    return template_cache.stats()
+
+def parse_range(range_header: str, size: int) -> Optional[tuple]:
+    """Interpreta um cabeçalho 'Range: bytes=início-fim' (um único intervalo)."""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Intervalo pedido inválido.", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+def iter_file(file_path: str, start: int, length: int):
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(DOWNLOAD_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
 
 @app.get("/download/{file_name}")
-def download_file(file_name: str):
+def download_file(file_name: str, request: Request):
     """
-    Endpoint para fazer o download dos ficheiros gerados.
+    Endpoint para fazer o download dos ficheiros gerados, em streaming, com suporte a Range e ETag.
     """
+    # Nomes ocultos ('.', '..', pastas temporárias da conversão) e diretórios nunca são servidos.
+    if os.path.basename(file_name) != file_name or file_name.startswith("."):
+        raise HTTPException(status_code=404, detail="Ficheiro não encontrado.")
     file_path = os.path.join(OUTPUT_FOLDER, file_name)
-    if os.path.exists(file_path):
-        return FileResponse(path=file_path, filename=file_name, media_type='application/octet-stream')
-    raise HTTPException(status_code=404, detail="Ficheiro não encontrado.")
+    if not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="Ficheiro não encontrado.")
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Ficheiro não encontrado.")
+
+    # Os artefactos são endereçados pelo conteúdo, mas a conversão pode reescrever o
+    # ficheiro: o ETag acompanha também o tamanho e o mtime.
+    etag = f'"{os.path.splitext(file_name)[0]}-{stat.st_size:x}-{int(stat.st_mtime):x}"'
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f'attachment; filename="{file_name}"',
+    }
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    start, end, status_code = 0, stat.st_size - 1, 200
+    range_header = request.headers.get("range")
+    # Com If-Range, o intervalo só é respeitado se o ficheiro não tiver mudado.
+    if range_header and request.headers.get("if-range", etag) == etag:
+        byte_range = parse_range(range_header, stat.st_size)
+        if byte_range is not None:
+            start, end = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+    length = end - start + 1
+    headers["Content-Length"] = str(length)
+    return StreamingResponse(iter_file(file_path, start, length), status_code=status_code,
+                             media_type="application/octet-stream", headers=headers)
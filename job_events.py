@@ -0,0 +1,43 @@
+# job_events.py
+# Canal de eventos dos trabalhos de análise (push em vez de polling).
+#
+# Cada transição de estágio (extracting, retrieving, calling_model, ready, failed)
+# é publicada para os subscritores do trabalho neste processo. Trabalhos tratados
+# por outro worker uvicorn são acompanhados pelo endpoint SSE relendo o job store.
+
+import asyncio
+from typing import Any, Dict, Set
+
+
+class JobEventBroker:
+    """Pub/sub em memória, com uma fila por subscritor."""
+
+    def __init__(self, max_queue_size: int = 100):
+        self.max_queue_size = max_queue_size
+        self.subscribers: Dict[str, Set[asyncio.Queue]] = {}
+
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self.subscribers.setdefault(job_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(job_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.subscribers[job_id]
+
+    def publish(self, job_id: str, event: Dict[str, Any]):
+        for queue in self.subscribers.get(job_id, ()):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Subscritor lento: descarta o evento mais antigo (o último estado é o que importa).
+                queue.get_nowait()
+                queue.put_nowait(event)
+
+    @property
+    def subscriber_count(self) -> int:
+        return sum(len(queues) for queues in self.subscribers.values())
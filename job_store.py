@@ -0,0 +1,366 @@
+# job_store.py
+# Armazenamento durável dos trabalhos de análise e fila de execução limitada.
+#
+# O backend é escolhido por JOB_STORE_URL:
+#   sqlite:///jobs.db        (padrão) SQLite em modo WAL, partilhável entre workers uvicorn
+#   redis://host:6379/0      qualquer servidor compatível com Redis (requer o pacote 'redis')
+
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import sqlite3
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+FINISHED_STATUSES = ("ready", "failed")
+PENDING_STATUSES = ("queued", "processing")
+
+# Campos guardados como JSON (dados extraídos e contagens de tokens da API).
+JSON_FIELDS = ("data", "usage")
+
+# Identifica o processo dono de um trabalho (para a recuperação no arranque): host e pid
+# servem para verificar se o dono está vivo; o nonce distingue um processo reiniciado que
+# herdou o mesmo host e pid (p. ex. pid 1 num contentor reiniciado).
+WORKER_HOST = socket.gethostname()
+WORKER_PID = os.getpid()
+WORKER_ID = f"{WORKER_HOST}:{WORKER_PID}:{uuid.uuid4().hex}"
+
+
+def _is_orphan(owner: Optional[str], lease_until: Any, updated_at: Any, now: float, lease_seconds: float) -> bool:
+    """Dono morto, ou lease expirada (a única forma de detetar donos mortos noutros hosts)."""
+    if not _owner_is_alive(owner):
+        return True
+    if not lease_until:
+        # Trabalho sem lease (criado por uma versão anterior): expira pela última atualização.
+        return float(updated_at or 0) + lease_seconds < now
+    return float(lease_until) < now
+
+
+def _owner_is_alive(owner: Optional[str]) -> bool:
+    """Verifica se o processo dono ainda existe (apenas quando corre no mesmo host)."""
+    if not owner:
+        return False
+    if owner == WORKER_ID:
+        return True
+    # 'host:pid:nonce' (ou 'host:pid' de versões anteriores).
+    host, pid, *_ = owner.split(":") + [""]
+    if host != WORKER_HOST:
+        return True
+    if pid == str(WORKER_PID):
+        # Mesmo host e pid mas outro nonce: um processo anterior que reutilizou o pid.
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobStore:
+    """Interface comum aos backends de trabalhos."""
+
+    def create(self, job_id: str, form_type: str, input_path: Optional[str] = None, status: str = "queued",
+               **fields: Any) -> None:
+        """Cria o trabalho numa única escrita; 'fields' preenche logo outras colunas (p. ex. data)."""
+        raise NotImplementedError
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def update(self, job_id: str, **fields: Any) -> None:
+        raise NotImplementedError
+
+    def claim_orphans(self, lease_seconds: float) -> List[Dict[str, Any]]:
+        """
+        Assume os trabalhos pendentes cujo dono morreu (mesmo host) ou cuja lease expirou
+        (o dono renova-a com renew_leases enquanto o trabalho espera na fila ou corre).
+        """
+        raise NotImplementedError
+
+    def renew_leases(self, job_ids: List[str], lease_seconds: float) -> None:
+        raise NotImplementedError
+
+    def evict_finished(self, ttl_seconds: float) -> int:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteJobStore(JobStore):
+    """Backend padrão: um ficheiro SQLite em modo WAL, uma ligação por thread."""
+
+    ADDED_COLUMNS = {"stage": "TEXT", "usage": "TEXT", "index_version": "TEXT", "lease_until": "REAL"}
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            stage TEXT,
+            form_type TEXT NOT NULL,
+            data TEXT,
+            rag_context TEXT,
+            usage TEXT,
+            index_version TEXT,
+            input_path TEXT,
+            owner TEXT,
+            lease_until REAL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """)
+        # Bases criadas por versões anteriores não têm as colunas mais recentes.
+        existing = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for column, definition in self.ADDED_COLUMNS.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_updated ON jobs (status, updated_at)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _row_to_job(row: sqlite3.Row) -> Dict[str, Any]:
+        job = dict(row)
+        for name in JSON_FIELDS:
+            job[name] = json.loads(job[name]) if job[name] else None
+        return job
+
+    def create(self, job_id, form_type, input_path=None, status="queued", **fields):
+        for name in JSON_FIELDS:
+            if name in fields:
+                fields[name] = json.dumps(fields[name], ensure_ascii=False) if fields[name] is not None else None
+        now = time.time()
+        row = {"job_id": job_id, "status": status, "stage": status, "form_type": form_type, "input_path": input_path,
+               "owner": WORKER_ID, "created_at": now, "updated_at": now, **fields}
+        columns = ", ".join(row)
+        placeholders = ", ".join("?" for _ in row)
+        self._conn().execute(f"INSERT INTO jobs ({columns}) VALUES ({placeholders})", tuple(row.values()))
+
+    def get(self, job_id):
+        row = self._conn().execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def update(self, job_id, **fields):
+        for name in JSON_FIELDS:
+            if name in fields:
+                fields[name] = json.dumps(fields[name], ensure_ascii=False) if fields[name] is not None else None
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        self._conn().execute(f"UPDATE jobs SET {columns} WHERE job_id = ?", (*fields.values(), job_id))
+
+    def claim_orphans(self, lease_seconds):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE status IN (?, ?) AND owner != ?", (*PENDING_STATUSES, WORKER_ID)
+            ).fetchall()
+            now = time.time()
+            claimed = [self._row_to_job(row) for row in rows if _is_orphan(row["owner"], row["lease_until"], row["updated_at"], now, lease_seconds)]
+            for job in claimed:
+                conn.execute("UPDATE jobs SET owner = ?, lease_until = ?, updated_at = ? WHERE job_id = ?",
+                             (WORKER_ID, now + lease_seconds, now, job["job_id"]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return claimed
+
+    def renew_leases(self, job_ids, lease_seconds):
+        lease_until = time.time() + lease_seconds
+        job_ids = list(job_ids)
+        for start in range(0, len(job_ids), 500):
+            chunk = job_ids[start:start + 500]
+            self._conn().execute(
+                f"UPDATE jobs SET lease_until = ? WHERE owner = ? AND job_id IN ({', '.join('?' * len(chunk))})",
+                (lease_until, WORKER_ID, *chunk),
+            )
+
+    def evict_finished(self, ttl_seconds):
+        cursor = self._conn().execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+            (*FINISHED_STATUSES, time.time() - ttl_seconds),
+        )
+        return cursor.rowcount
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class RedisJobStore(JobStore):
+    """Backend opcional para servidores compatíveis com Redis; os trabalhos concluídos expiram por TTL."""
+
+    KEY_PREFIX = "recanalysis:job:"
+    PENDING_SET = "recanalysis:jobs:pending"
+
+    def __init__(self, url: str, ttl_seconds: float):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("O backend Redis requer o pacote 'redis' (pip install redis).")
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.ttl_seconds = int(ttl_seconds)
+
+    def _key(self, job_id: str) -> str:
+        return self.KEY_PREFIX + job_id
+
+    def create(self, job_id, form_type, input_path=None, status="queued", **fields):
+        for name in JSON_FIELDS:
+            if name in fields:
+                fields[name] = json.dumps(fields[name], ensure_ascii=False) if fields[name] is not None else ""
+        now = time.time()
+        mapping = {"job_id": job_id, "status": status, "stage": status, "form_type": form_type, "input_path": input_path or "",
+                   "owner": WORKER_ID, "created_at": now, "updated_at": now,
+                   **{name: ("" if value is None else value) for name, value in fields.items()}}
+        pipe = self.client.pipeline()
+        pipe.hset(self._key(job_id), mapping=mapping)
+        if status in PENDING_STATUSES:
+            pipe.sadd(self.PENDING_SET, job_id)
+        else:
+            pipe.expire(self._key(job_id), self.ttl_seconds)
+        pipe.execute()
+
+    def get(self, job_id):
+        raw = self.client.hgetall(self._key(job_id))
+        if not raw:
+            return None
+        job: Dict[str, Any] = dict(raw)
+        for name in JSON_FIELDS:
+            job[name] = json.loads(job[name]) if job.get(name) else None
+        job["input_path"] = job.get("input_path") or None
+        job["created_at"] = float(job["created_at"])
+        job["updated_at"] = float(job["updated_at"])
+        return job
+
+    def update(self, job_id, **fields):
+        for name in JSON_FIELDS:
+            if name in fields:
+                fields[name] = json.dumps(fields[name], ensure_ascii=False) if fields[name] is not None else ""
+        fields = {name: ("" if value is None else value) for name, value in fields.items()}
+        fields["updated_at"] = time.time()
+        pipe = self.client.pipeline()
+        pipe.hset(self._key(job_id), mapping=fields)
+        if fields.get("status") in FINISHED_STATUSES:
+            pipe.srem(self.PENDING_SET, job_id)
+            pipe.expire(self._key(job_id), self.ttl_seconds)
+        pipe.execute()
+
+    def claim_orphans(self, lease_seconds):
+        claimed = []
+        now = time.time()
+        for job_id in self.client.smembers(self.PENDING_SET):
+            job = self.get(job_id)
+            if job is None or job["status"] not in PENDING_STATUSES:
+                self.client.srem(self.PENDING_SET, job_id)
+                continue
+            if job["owner"] == WORKER_ID or not _is_orphan(job["owner"], job.get("lease_until"), job["updated_at"], now, lease_seconds):
+                continue
+            # Um único processo consegue o lock de recuperação de cada trabalho.
+            if self.client.set(f"{self._key(job_id)}:claim", WORKER_ID, nx=True, ex=int(lease_seconds) or 1):
+                self.update(job_id, owner=WORKER_ID, lease_until=now + lease_seconds)
+                claimed.append(job)
+        return claimed
+
+    def renew_leases(self, job_ids, lease_seconds):
+        lease_until = time.time() + lease_seconds
+        pipe = self.client.pipeline()
+        for job_id in job_ids:
+            # Só renova trabalhos que ainda existem (HSET criaria uma chave sem os restantes campos).
+            pipe.hget(self._key(job_id), "owner")
+        owners = pipe.execute()
+        pipe = self.client.pipeline()
+        for job_id, owner in zip(job_ids, owners):
+            if owner == WORKER_ID:
+                pipe.hset(self._key(job_id), "lease_until", lease_until)
+        pipe.execute()
+
+    def evict_finished(self, ttl_seconds):
+        # A expiração é feita pelo próprio servidor (EXPIRE na conclusão).
+        return 0
+
+
+def create_job_store(url: str, ttl_seconds: float) -> JobStore:
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        return RedisJobStore(url, ttl_seconds)
+    if url.startswith("sqlite:///"):
+        return SQLiteJobStore(url[len("sqlite:///"):])
+    raise ValueError(f"JOB_STORE_URL não suportado: {url}")
+
+
+class QueueFullError(Exception):
+    """A fila de trabalhos atingiu JOB_QUEUE_MAX_SIZE."""
+
+
+class JobQueue:
+    """Fila assíncrona limitada, consumida por um número fixo de workers."""
+
+    def __init__(self, handler: Callable[[str], Awaitable[None]], concurrency: int, max_size: int):
+        self.handler = handler
+        self.concurrency = max(1, concurrency)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self.workers: List[asyncio.Task] = []
+        # Trabalhos à espera ou em execução neste processo (as suas leases são renovadas)
+        self.owned: set = set()
+
+    def start(self):
+        for _ in range(self.concurrency):
+            self.workers.append(asyncio.create_task(self._run()))
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers.clear()
+
+    def submit(self, job_id: str):
+        try:
+            self.queue.put_nowait(job_id)
+        except asyncio.QueueFull:
+            raise QueueFullError()
+        self.owned.add(job_id)
+
+    async def put(self, job_id: str):
+        """Como submit, mas espera por espaço na fila (para produtores com muitos trabalhos)."""
+        # Já é nosso enquanto espera por espaço: a lease continua a ser renovada.
+        self.owned.add(job_id)
+        try:
+            await self.queue.put(job_id)
+        except asyncio.CancelledError:
+            self.owned.discard(job_id)
+            raise
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    async def _run(self):
+        while True:
+            job_id = await self.queue.get()
+            try:
+                await self.handler(job_id)
+            except Exception as e:
+                print(f"Erro inesperado no worker da fila para o trabalho {job_id}: {e}")
+            finally:
+                self.owned.discard(job_id)
+                self.queue.task_done()
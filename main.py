@@ -3,25 +3,34 @@
 
 import asyncio
 import uuid
-import fitz  # PyMuPDF
-import httpx
+import time
 import json
 import os
-import pickle
-import sqlite3
-import datetime
-import requests
+import zipfile
+import hashlib
+import httpx
 from pydantic import BaseModel
 from functools import partial
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Dict, Any, List
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import TYPE_CHECKING, Dict, Any, List
 from dotenv import load_dotenv
 
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain.docstore.document import Document
+from job_store import create_job_store, JobQueue, QueueFullError, PENDING_STATUSES, FINISHED_STATUSES, WORKER_ID
+from job_events import JobEventBroker
+from pipeline import AnalysisPipeline
+from gemini_client import GeminiClient, GEMINI_API_BASE
+from result_cache import AnalysisCache, analysis_cache_key
+from policy_index import PolicyIndexLoader
+from feedback_store import FeedbackStore, SCHEMA_VERSION
+from prompt_builder import InstructionCache, build_prompt, usage_from_response
+from metrics import instrument_app, stage_timer, track_queues, trace_headers
+
+# O LangChain só é importado pela thread que carrega o índice (arranque rápido).
+if TYPE_CHECKING:
+    from langchain_community.vectorstores import FAISS
+    from langchain.docstore.document import Document
 
 # --- Carregar variáveis de ambiente ---
 load_dotenv()
@@ -30,22 +39,11 @@ load_dotenv()
 DB_FILE = "feedback.db"
 
 def init_db():
-    """Cria a tabela de feedback na base de dados se ela não existir. (v1.8 com rag_context)"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS feedback (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        timestamp TEXT NOT NULL,
-        form_type TEXT NOT NULL,
-        rag_context TEXT,
-        original_response TEXT NOT NULL,
-        corrected_response TEXT NOT NULL
-    )
-    """)
-    conn.commit()
-    conn.close()
-    print(f"Base de dados de feedback '{DB_FILE}' inicializada com a coluna 'rag_context'.")
+    """Abre a base de dados de feedback (aplicando as migrações em falta) e inicia a escrita em lote."""
+    global feedback_store
+    feedback_store = FeedbackStore(DB_FILE)
+    feedback_store.start()
+    print(f"Base de dados de feedback '{DB_FILE}' inicializada (esquema v{SCHEMA_VERSION}).")
 
 # --- Inicialização da Aplicação FastAPI ---
 app = FastAPI(
@@ -57,7 +55,36 @@ app = FastAPI(
 @app.on_event("startup")
 async def startup_event():
     """Função executada quando a aplicação inicia."""
+    global job_queue, analysis_pipeline, generator_client
     init_db()
+    # Em modo de arranque rápido o servidor responde de imediato e o índice carrega em segundo plano.
+    policy_index_loader.start(background=API_FAST_START)
+    analysis_pipeline = AnalysisPipeline()
+    await gemini_client.start()
+    generator_client = httpx.AsyncClient(timeout=httpx.Timeout(GENERATION_TIMEOUT, connect=10.0))
+    os.makedirs(JOB_SPOOL_DIR, exist_ok=True)
+    job_queue = JobQueue(process_job, concurrency=JOB_CONCURRENCY, max_size=JOB_QUEUE_MAX_SIZE)
+    job_queue.start()
+    recover_jobs()
+    background_tasks.append(asyncio.create_task(evict_finished_jobs()))
+    background_tasks.append(asyncio.create_task(renew_job_leases()))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in background_tasks:
+        task.cancel()
+    if job_queue is not None:
+        await job_queue.stop()
+    if analysis_pipeline is not None:
+        analysis_pipeline.shutdown()
+    policy_index_loader.stop()
+    await gemini_client.close()
+    if feedback_store is not None:
+        # Grava o feedback ainda na fila antes de terminar.
+        await asyncio.to_thread(feedback_store.close)
+    if generator_client is not None:
+        await generator_client.aclose()
+    job_store.close()
 
 
 # --- Configuração de CORS ---
@@ -69,38 +96,182 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- Métricas (/metrics) e trace ids opcionais (TRACE_IDS=1) ---
+instrument_app(app)
+
 # --- Constantes e Configurações ---
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
-GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent?key={GEMINI_API_KEY}"
+GEMINI_MODEL = "gemini-2.5-flash-preview-05-20"
+GEMINI_API_URL = f"{GEMINI_API_BASE}/v1beta/models/{GEMINI_MODEL}:generateContent?key={GEMINI_API_KEY}"
 POLICY_DOC_PATH = "Política Recursal.pdf"
-VECTOR_STORE_PATH = "vector_store.pkl"
+POLICY_INDEX_DIR = os.getenv("POLICY_INDEX_DIR", "policy_index")
+API_FAST_START = os.getenv("API_FAST_START", "1") == "1"
+# Se ativo, análises recebidas durante o carregamento ficam em fila em vez de devolver 503.
+QUEUE_WHILE_LOADING = os.getenv("QUEUE_WHILE_LOADING", "0") == "1"
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "500"))
+# Total de MB que um lote pode gravar no spool (somando os PDFs, incluindo os extraídos de .zip)
+BATCH_MAX_TOTAL_MB = float(os.getenv("BATCH_MAX_TOTAL_MB", "2048"))
+# Tamanho máximo de cada PDF enviado (os uploads são gravados no spool por blocos, sem passar pela memória)
+ANALYSIS_MAX_UPLOAD_MB = float(os.getenv("ANALYSIS_MAX_UPLOAD_MB", "100"))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 EMBEDDING_MODEL = "rufimelo/Legal-BERTimbau-sts-large"
-GENERATOR_SERVICE_URL = "http://generator:8001"
+GENERATOR_SERVICE_URL = os.getenv("GENERATOR_SERVICE_URL", "http://generator:8001")
+# Tempo total de espera por um trabalho de geração e duração de cada pedido de long-polling.
+GENERATION_TIMEOUT = float(os.getenv("GENERATION_TIMEOUT", "90"))
+GENERATION_POLL_WAIT = float(os.getenv("GENERATION_POLL_WAIT", "30"))
+JOB_STORE_URL = os.getenv("JOB_STORE_URL", "sqlite:///jobs.db")
+JOB_SPOOL_DIR = os.getenv("JOB_SPOOL_DIR", "job_spool")
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "4"))
+JOB_QUEUE_MAX_SIZE = int(os.getenv("JOB_QUEUE_MAX_SIZE", "100"))
+JOB_TTL_SECONDS = float(os.getenv("JOB_TTL_SECONDS", str(24 * 3600)))
+JOB_EVICTION_INTERVAL = float(os.getenv("JOB_EVICTION_INTERVAL", "300"))
+# Lease dos trabalhos pendentes: renovada por este processo a cada terço do prazo; expirada,
+# o trabalho é recuperado por outro worker (também noutros hosts).
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "120"))
+# Intervalo máximo sem eventos antes de o stream SSE reler o job store (trabalhos de outros workers).
+JOB_EVENTS_POLL_INTERVAL = float(os.getenv("JOB_EVENTS_POLL_INTERVAL", "5"))
+
+# --- Armazenamento Durável de Trabalhos ---
+# Partilhado entre workers uvicorn; a fila local limita a concorrência deste processo.
+job_store = create_job_store(JOB_STORE_URL, JOB_TTL_SECONDS)
+job_queue: JobQueue | None = None
+# Notifica as transições de estágio aos clientes ligados ao stream de eventos
+job_events = JobEventBroker()
+# Pools de processos/threads para os estágios CPU-bound (criados no arranque)
+analysis_pipeline: AnalysisPipeline | None = None
+# Cliente HTTP partilhado (keep-alive, limite de concorrência e repetições) para a API Gemini
+gemini_client = GeminiClient()
+# Instruções fixas do prompt numa cache de contexto do Gemini (opcional, GEMINI_CONTEXT_CACHE=1)
+instruction_cache = InstructionCache(GEMINI_API_BASE, GEMINI_API_KEY, GEMINI_MODEL)
+# Feedback dos analistas: escrito em lote por uma thread, fora do caminho do pedido (aberto no arranque)
+feedback_store: FeedbackStore | None = None
+# Cliente assíncrono partilhado para o serviço de geração (criado no arranque)
+generator_client: httpx.AsyncClient | None = None
+# Cache de resultados por conteúdo (hash do PDF + form_type + versão do prompt + versão do índice)
+analysis_cache = AnalysisCache()
+
+track_queues(lambda: {
+    "analysis_jobs": job_queue.depth if job_queue else 0,
+    "gemini_waiting": gemini_client.waiting,
+    "feedback_writes": feedback_store.pending.qsize() if feedback_store else 0,
+})
+
+def cache_key_for(content_sha256: bytes, form_type: str, index_version: str | None = None) -> str | None:
+    index_version = index_version or policy_index_loader.version
+    if index_version is None:
+        return None
+    return analysis_cache_key(content_sha256, form_type, PROMPT_VERSION, index_version)
+
+def file_sha256(path: str) -> bytes:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+background_tasks: List[asyncio.Task] = []
+
+def update_job(job_id: str, **fields: Any):
+    """Atualiza o trabalho e, se o estágio mudou, avisa os subscritores do canal de eventos."""
+    if "status" in fields and "stage" not in fields:
+        fields["stage"] = fields["status"]
+    job_store.update(job_id, **fields)
+    if "stage" in fields:
+        job_events.publish(job_id, {"job_id": job_id, "stage": fields["stage"]})
+
+def remove_spool_file(path: str | None):
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+async def process_job(job_id: str):
+    """Executa um trabalho retirado da fila a partir do PDF guardado no spool."""
+    job = job_store.get(job_id)
+    if not job:
+        return
+    cancelled = False
+    try:
+        await run_job(job_id, job)
+    except asyncio.CancelledError:
+        # Encerramento do processo: o PDF fica no spool para a recuperação por outro worker.
+        cancelled = True
+        raise
+    finally:
+        if not cancelled:
+            remove_spool_file(job["input_path"])
+
+async def run_job(job_id: str, job: Dict[str, Any]):
+    # Trabalhos cancelados (p. ex. lote interrompido) ou já concluídos noutro worker.
+    if job["status"] not in PENDING_STATUSES:
+        return
+    try:
+        # O PDF fica no spool: só o hash é calculado aqui, a extração lê as páginas do ficheiro.
+        content_sha256 = await asyncio.to_thread(file_sha256, job["input_path"])
+    except (OSError, TypeError) as e:
+        update_job(job_id, status="failed", data={"error": f"Ficheiro do trabalho indisponível: {e}"})
+        return
+    if not policy_index_loader.ready:
+        update_job(job_id, stage="waiting_for_index")
+    try:
+        # A versão ativa é fixada aqui: uma troca do índice a meio não afeta este trabalho.
+        index = await policy_index_loader.wait_ready()
+    except RuntimeError as e:
+        update_job(job_id, status="failed", data={"error": str(e)})
+        return
+    update_job(job_id, status="processing", owner=WORKER_ID, index_version=index.version)
+    await rag_ai_processing(job_id, job["form_type"], job["input_path"], index.vector_store,
+                            cache_key=cache_key_for(content_sha256, job["form_type"], index.version))
+
+def recover_jobs():
+    """Volta a colocar na fila os trabalhos pendentes de processos que terminaram ou sem lease válida."""
+    recovered = 0
+    for job in job_store.claim_orphans(JOB_LEASE_SECONDS):
+        try:
+            job_queue.submit(job["job_id"])
+            recovered += 1
+        except QueueFullError:
+            update_job(job["job_id"], status="failed", data={"error": "Fila cheia durante a recuperação."})
+    if recovered:
+        print(f"{recovered} trabalho(s) pendente(s) recuperado(s) de workers terminados.")
+
+async def renew_job_leases():
+    """Renova as leases dos trabalhos deste processo e recupera os de donos mortos ou sem lease."""
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            await asyncio.to_thread(job_store.renew_leases, list(job_queue.owned), JOB_LEASE_SECONDS)
+            recover_jobs()
+        except Exception as e:
+            print(f"ERRO ao renovar as leases dos trabalhos: {e}")
 
-# --- "Banco de Dados" em Memória para Jobs ---
-jobs: Dict[str, Dict[str, Any]] = {}
+async def evict_finished_jobs():
+    """Remove periodicamente os trabalhos concluídos há mais de JOB_TTL_SECONDS."""
+    while True:
+        await asyncio.sleep(JOB_EVICTION_INTERVAL)
+        try:
+            evicted = job_store.evict_finished(JOB_TTL_SECONDS)
+            if evicted:
+                print(f"{evicted} trabalho(s) concluído(s) removido(s) do armazenamento.")
+            analysis_cache.evict()
+        except Exception as e:
+            print(f"ERRO ao remover trabalhos expirados: {e}")
 
 # --- Lógica de RAG ---
-def get_vector_store():
-    if os.path.exists(VECTOR_STORE_PATH):
-        with open(VECTOR_STORE_PATH, "rb") as f: return pickle.load(f)
-    with fitz.open(POLICY_DOC_PATH) as doc:
-        policy_text = "".join(page.get_text() for page in doc)
-    docs = [Document(page_content=policy_text)]
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-    chunks = text_splitter.split_documents(docs)
-    embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
-    vector_store = FAISS.from_documents(chunks, embedding=embeddings)
-    with open(VECTOR_STORE_PATH, "wb") as f: pickle.dump(vector_store, f)
-    return vector_store
-
-vector_store = get_vector_store()
+# Índice FAISS nativo (mmap) + sidecar de chunks; reconstruído só se a política ou o modelo mudarem.
+# É carregado no arranque (ver startup_event), não na importação do módulo.
+policy_index_loader = PolicyIndexLoader(POLICY_DOC_PATH, EMBEDDING_MODEL, POLICY_INDEX_DIR)
 
 # --- Modelos de Dados (Pydantic) ---
 class Job(BaseModel):
     job_id: str
     status: str
+    stage: str | None = None
     data: Dict[str, Any] | None = None
+    usage: Dict[str, Any] | None = None
+    index_version: str | None = None
 
 class GenerationRequest(BaseModel):
     job_id: str
@@ -114,71 +285,408 @@ class GenerationRequest(BaseModel):
 def read_root():
     return {"message": "Bem-vindo à API do recANALYSIS v1.7!"}
 
+@app.get("/health/live")
+def liveness():
+    """O processo está a responder (não depende do modelo nem do índice)."""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+def readiness():
+    """Pronto para análises apenas quando o modelo de embeddings e o índice estão carregados."""
+    status = policy_index_loader.status()
+    if not policy_index_loader.ready:
+        return JSONResponse(status_code=503, content={"ready": False, "index": status})
+    return {"ready": True, "index": status}
+
+def ensure_index_available():
+    """Recusa novas análises (503) enquanto o índice carrega, salvo em modo QUEUE_WHILE_LOADING."""
+    if not policy_index_loader.ready and not (QUEUE_WHILE_LOADING and policy_index_loader.state == "loading"):
+        raise HTTPException(
+            status_code=503,
+            detail=f"O índice da política ainda está a carregar ({policy_index_loader.stage or policy_index_loader.state}).",
+            headers={"Retry-After": "10"},
+        )
+
+def spool_upload(source, name: str) -> tuple[str, bytes]:
+    """
+    Copia um upload (ou uma entrada de um .zip) para o spool por blocos, calculando o
+    sha256 pelo caminho. Devolve (caminho temporário, sha256); 413 acima do limite.
+    """
+    max_bytes = int(ANALYSIS_MAX_UPLOAD_MB * 1024 * 1024)
+    path = os.path.join(JOB_SPOOL_DIR, f"upload-{uuid.uuid4().hex}.tmp")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, "wb") as f:
+            for chunk in iter(lambda: source.read(UPLOAD_CHUNK_SIZE), b""):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"O ficheiro '{name}' excede o máximo de {ANALYSIS_MAX_UPLOAD_MB:g} MB.")
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, digest.digest()
+
+def create_analysis_job(spooled_path: str, content_sha256: bytes, form_type: str) -> tuple[str, bool]:
+    """
+    Cria o trabalho de análise de um PDF já gravado no spool. Devolve (job_id, pendente):
+    um trabalho servido pela cache de resultados já nasce 'ready' e não precisa de ser processado.
+    """
+    job_id = str(uuid.uuid4())
+
+    # Reenvio da mesma decisão: o resultado sai da cache sem chamar a API Gemini.
+    cache_key = cache_key_for(content_sha256, form_type)
+    cached = analysis_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        os.remove(spooled_path)
+        extracted_data, rag_context = cached
+        # Uma só escrita: o trabalho nunca é visível como 'ready' sem os dados.
+        job_store.create(job_id, form_type, status="ready", data=extracted_data, rag_context=rag_context,
+                         index_version=policy_index_loader.version)
+        return job_id, False
+
+    input_path = os.path.join(JOB_SPOOL_DIR, f"{job_id}.pdf")
+    os.replace(spooled_path, input_path)
+    # A lease nasce com o trabalho: se este processo morrer antes da primeira renovação,
+    # outro worker recupera-o quando expirar.
+    job_store.create(job_id, form_type, input_path=input_path, lease_until=time.time() + JOB_LEASE_SECONDS)
+    return job_id, True
+
 @app.post("/api/v1/analysis", status_code=202)
 async def start_analysis(file: UploadFile = File(...), form_type: str = Form(...)):
     if not file.content_type == "application/pdf":
         raise HTTPException(status_code=400, detail="Tipo de arquivo inválido.")
-    job_id = str(uuid.uuid4())
-    jobs[job_id] = {"status": "processing", "data": None, "form_type": form_type}
-    file_content = await file.read()
-    asyncio.create_task(rag_ai_processing(job_id, form_type, file_content, vector_store))
+    ensure_index_available()
+    if file.size is not None and file.size > ANALYSIS_MAX_UPLOAD_MB * 1024 * 1024:
+        raise HTTPException(status_code=413, detail=f"O ficheiro excede o máximo de {ANALYSIS_MAX_UPLOAD_MB:g} MB.")
+    spooled_path, content_sha256 = await asyncio.to_thread(spool_upload, file.file, file.filename or "documento.pdf")
+    job_id, pending = create_analysis_job(spooled_path, content_sha256, form_type)
+    if not pending:
+        return {"job_id": job_id}
+    try:
+        job_queue.submit(job_id)
+    except QueueFullError:
+        job = job_store.get(job_id)
+        os.remove(job["input_path"])
+        update_job(job_id, status="failed", data={"error": "Fila de análise cheia."})
+        raise HTTPException(status_code=503, detail="Fila de análise cheia. Tente novamente dentro de instantes.", headers={"Retry-After": "10"})
     return {"job_id": job_id}
 
-@app.get("/api/v1/analysis/{job_id}/status", response_model=Job)
-def get_analysis_status(job_id: str):
-    job = jobs.get(job_id)
-    if not job:
-        raise HTTPException(status_code=404, detail="Trabalho não encontrado.")
+def parse_batch_form_types(form_types: str, filenames: List[str]) -> List[str]:
+    """
+    'form_types' aceita um único tipo para todos os ficheiros, uma lista JSON alinhada
+    com os ficheiros ou um objeto JSON {nome_do_ficheiro: tipo} (com a chave "*" como padrão).
+    """
+    value = form_types.strip()
+    if not value.startswith(("[", "{")):
+        return [value] * len(filenames)
+    try:
+        parsed = json.loads(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="'form_types' não é um JSON válido.")
+    if isinstance(parsed, list):
+        if len(parsed) != len(filenames):
+            raise HTTPException(status_code=400, detail="'form_types' deve ter um tipo por ficheiro.")
+        return [str(item) for item in parsed]
+    missing = [name for name in filenames if name not in parsed and "*" not in parsed]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Tipo de formulário em falta para: {', '.join(missing)}")
+    return [str(parsed.get(name, parsed.get("*"))) for name in filenames]
+
+def read_batch_files(files: List[UploadFile]) -> List[tuple[str, str, bytes]]:
+    """
+    Grava no spool os PDFs do lote, expandindo ficheiros .zip (apenas as entradas .pdf).
+    Devolve (nome, caminho no spool, sha256) de cada PDF; em caso de erro, apaga os já gravados.
+    """
+    documents = []
+    max_total_bytes = BATCH_MAX_TOTAL_MB * 1024 * 1024
+    total_bytes = 0
+
+    def check_limits(next_size: int = 0):
+        # Verificado antes de cada gravação: um .zip muito comprimido não chega a encher o spool.
+        if len(documents) >= BATCH_MAX_FILES:
+            raise HTTPException(status_code=413, detail=f"O lote excede o máximo de {BATCH_MAX_FILES} ficheiros.")
+        if total_bytes + next_size > max_total_bytes:
+            raise HTTPException(status_code=413, detail=f"O lote excede o máximo de {BATCH_MAX_TOTAL_MB:g} MB.")
+
+    def add_document(name: str, source):
+        nonlocal total_bytes
+        documents.append((name, *spool_upload(source, name)))
+        total_bytes += os.path.getsize(documents[-1][1])
+        if total_bytes > max_total_bytes:
+            raise HTTPException(status_code=413, detail=f"O lote excede o máximo de {BATCH_MAX_TOTAL_MB:g} MB.")
+
+    try:
+        for upload in files:
+            name = upload.filename or "documento.pdf"
+            if upload.content_type in ("application/zip", "application/x-zip-compressed") or name.lower().endswith(".zip"):
+                try:
+                    with zipfile.ZipFile(upload.file) as archive:
+                        for member in archive.infolist():
+                            if not member.is_dir() and member.filename.lower().endswith(".pdf"):
+                                check_limits(member.file_size)
+                                with archive.open(member) as source:
+                                    add_document(member.filename, source)
+                except zipfile.BadZipFile:
+                    raise HTTPException(status_code=400, detail=f"Ficheiro zip inválido: {name}")
+            elif upload.content_type == "application/pdf":
+                check_limits(upload.size or 0)
+                add_document(name, upload.file)
+            else:
+                raise HTTPException(status_code=400, detail=f"Tipo de arquivo inválido: {name}")
+    except BaseException:
+        for _, path, _ in documents:
+            os.remove(path)
+        raise
+    if not documents:
+        raise HTTPException(status_code=400, detail="Nenhum PDF encontrado no lote.")
+    return documents
+
+@app.post("/api/v1/analysis/batch")
+async def start_batch_analysis(files: List[UploadFile] = File(...), form_types: str = Form(...), format: str = "ndjson"):
+    """
+    Analisa vários PDFs (ou um .zip) numa única ligação. Cada resultado é enviado assim
+    que fica pronto, em NDJSON (padrão) ou Server-Sent Events (?format=sse); a última
+    mensagem é um resumo do lote. Os job_id devolvidos servem para /api/v1/generate.
+    Os PDFs entram na fila partilhada à medida que há espaço (JOB_QUEUE_MAX_SIZE),
+    com a mesma concorrência (JOB_CONCURRENCY) das análises individuais.
+    """
+    if format not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail="Formato inválido. Use 'ndjson' ou 'sse'.")
+    ensure_index_available()
+    documents = await asyncio.to_thread(read_batch_files, files)
+    try:
+        types = parse_batch_form_types(form_types, [name for name, _, _ in documents])
+    except HTTPException:
+        for _, path, _ in documents:
+            os.remove(path)
+        raise
+    items = []
+    for index, ((name, spooled_path, content_sha256), form_type) in enumerate(zip(documents, types)):
+        job_id, pending = create_analysis_job(spooled_path, content_sha256, form_type)
+        items.append({"index": index, "filename": name, "form_type": form_type, "job_id": job_id, "pending": pending})
+
+    def encode(event: str, payload: Dict[str, Any]) -> str:
+        body = json.dumps(payload, ensure_ascii=False)
+        return f"event: {event}\ndata: {body}\n\n" if format == "sse" else body + "\n"
+
+    async def submit_items():
+        # Espera por espaço na fila em vez de a encher: os lotes não contornam o limite.
+        for item in items:
+            if item["pending"]:
+                await job_queue.put(item["job_id"])
+                item["submitted"] = True
+
+    async def run_item(item: Dict[str, Any]) -> Dict[str, Any]:
+        job = await wait_for_job(item["job_id"]) or {"status": "failed", "data": {"error": "Trabalho não encontrado."}}
+        data = job["data"]
+        if job["status"] == "ready" and data:
+            data["rag_context"] = job.get("rag_context")
+        return {"index": item["index"], "filename": item["filename"], "form_type": item["form_type"],
+                "job_id": item["job_id"], "cached": not item["pending"], "status": job["status"], "data": data}
+
+    async def stream_results():
+        producer = asyncio.create_task(submit_items())
+        tasks = [asyncio.create_task(run_item(item)) for item in items]
+        summary = {"total": len(items), "ready": 0, "failed": 0}
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                result = await next_result
+                summary["ready" if result["status"] == "ready" else "failed"] += 1
+                yield encode("result", result)
+            yield encode("done", summary)
+        finally:
+            # Cliente desligou-se a meio do lote: os trabalhos que ainda não começaram são
+            # cancelados (os que já correm terminam e ficam disponíveis pelo job_id).
+            producer.cancel()
+            for item, task in zip(items, tasks):
+                if task.done():
+                    continue
+                task.cancel()
+                job = job_store.get(item["job_id"])
+                if not job or job["status"] != "queued":
+                    continue
+                update_job(item["job_id"], status="failed", data={"error": "Lote cancelado."})
+                # Os que já estão na fila apagam o PDF ao serem retirados (process_job).
+                if not item.get("submitted"):
+                    remove_spool_file(job["input_path"])
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(stream_results(), media_type=media_type, headers={"Cache-Control": "no-cache"})
+
+@app.get("/api/v1/pipeline/stats")
+def get_pipeline_stats():
+    """Profundidade de fila, timeouts e tempos de cada estágio do pipeline e do cliente Gemini."""
+    return {
+        "job_queue_depth": job_queue.depth if job_queue else 0,
+        "stages": analysis_pipeline.stats() if analysis_pipeline else {},
+        "process_pool_restarts": analysis_pipeline.process_pool.restarts if analysis_pipeline else 0,
+        "gemini": gemini_client.stats(),
+        "analysis_cache": analysis_cache.stats(),
+        "event_subscribers": job_events.subscriber_count,
+        "feedback_writes": feedback_store.stats() if feedback_store else {},
+    }
 
+@app.get("/api/v1/policy-index")
+def get_policy_index():
+    """Versão ativa do índice da política, versões em disco e estado da reconstrução."""
+    return policy_index_loader.status()
+
+@app.post("/api/v1/policy-index/rebuild", status_code=202)
+def rebuild_policy_index():
+    """Reconstrói o índice a partir do PDF atual em segundo plano e troca-o sem reinício."""
+    if not policy_index_loader.ready:
+        raise HTTPException(status_code=503, detail="O índice da política ainda está a carregar.", headers={"Retry-After": "10"})
+    started = policy_index_loader.rebuild()
+    return {"started": started, "version": policy_index_loader.version, "rebuild": policy_index_loader.status()["rebuild"]}
+
+@app.get("/api/v1/feedback/field-stats")
+def get_feedback_field_stats(form_type: str | None = None, start_date: str | None = None,
+                             end_date: str | None = None, period: str = "month"):
+    """
+    Taxa de correção de cada campo do esquema por form_type e período ('day', 'month' ou 'total'),
+    lida dos agregados mantidos a cada revisão. Campos nunca corrigidos aparecem com taxa zero.
+    """
+    if period not in ("day", "month", "total"):
+        raise HTTPException(status_code=400, detail="Período inválido (use 'day', 'month' ou 'total').")
+    groups = feedback_store.field_stats(form_type, start_date, end_date, period)
+    for group in groups:
+        schema_fields = get_form_fields_for_schema(group["form_type"])
+        stats = {field: group["fields"].get(field, {"reviewed": 0, "corrected": 0, "correction_rate": 0.0})
+                 for field in schema_fields}
+        group["fields"] = sorted(({"field": field, **values} for field, values in stats.items()),
+                                 key=lambda item: item["correction_rate"], reverse=True)
+    return groups
+
+async def wait_for_job(job_id: str) -> Dict[str, Any] | None:
+    """Espera que o trabalho termine (eventos deste processo ou releitura do job store)."""
+    queue = job_events.subscribe(job_id)
+    try:
+        while True:
+            job = job_store.get(job_id)
+            if job is None or job["status"] in FINISHED_STATUSES:
+                return job
+            try:
+                await asyncio.wait_for(queue.get(), timeout=JOB_EVENTS_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        job_events.unsubscribe(job_id, queue)
+
+def job_status_payload(job_id: str, job: Dict[str, Any]) -> Dict[str, Any]:
     # Anexa o contexto RAG aos dados se o trabalho estiver pronto
     response_data = job["data"]
     if job["status"] == "ready" and response_data:
          response_data["rag_context"] = job.get("rag_context")
 
-    return {"job_id": job_id, "status": job["status"], "data": response_data}
+    return {"job_id": job_id, "status": job["status"], "stage": job.get("stage"), "data": response_data,
+            "usage": job.get("usage"), "index_version": job.get("index_version") or None}
+
+@app.get("/api/v1/analysis/{job_id}/status", response_model=Job)
+def get_analysis_status(job_id: str):
+    """Consulta pontual do estado (alternativa ao stream de eventos)."""
+    job = job_store.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabalho não encontrado.")
+    return job_status_payload(job_id, job)
+
+@app.get("/api/v1/analysis/{job_id}/events")
+async def stream_analysis_events(job_id: str, request: Request):
+    """
+    Server-Sent Events com as transições do trabalho: um evento 'stage' por estágio
+    (queued, extracting, retrieving, calling_model...) e um evento final 'ready' ou
+    'failed' com os dados, após o qual o stream termina.
+    """
+    if not job_store.get(job_id):
+        raise HTTPException(status_code=404, detail="Trabalho não encontrado.")
+
+    async def event_stream():
+        queue = job_events.subscribe(job_id)
+        last_snapshot = None
+        try:
+            while not await request.is_disconnected():
+                job = job_store.get(job_id)
+                if job is None:
+                    yield f"event: failed\ndata: {json.dumps({'job_id': job_id, 'status': 'failed', 'data': {'error': 'Trabalho não encontrado.'}})}\n\n"
+                    return
+                snapshot = (job["status"], job.get("stage"))
+                if snapshot != last_snapshot:
+                    last_snapshot = snapshot
+                    finished = job["status"] in FINISHED_STATUSES
+                    payload = job_status_payload(job_id, job) if finished else {"job_id": job_id, "status": job["status"], "stage": job.get("stage")}
+                    yield f"event: {job['status'] if finished else 'stage'}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+                    if finished:
+                        return
+                try:
+                    await asyncio.wait_for(queue.get(), timeout=JOB_EVENTS_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+        finally:
+            job_events.unsubscribe(job_id, queue)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def await_generation(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Submete o trabalho de geração e espera pela conclusão por long-polling, sem ocupar threads."""
+    jobs_url = f"{GENERATOR_SERVICE_URL}/api/v1/generation-jobs"
+    deadline = asyncio.get_running_loop().time() + GENERATION_TIMEOUT
+    # O trace id do pedido segue para o gerador, para correlacionar os dois serviços.
+    response = await generator_client.post(jobs_url, json=payload, headers=trace_headers())
+    response.raise_for_status()
+    result = response.json()
+    while result["status"] in ("queued", "running"):
+        remaining = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            raise HTTPException(status_code=504, detail="A geração dos documentos demorou demasiado tempo.")
+        response = await generator_client.get(f"{jobs_url}/{result['job_id']}",
+                                              params={"wait": min(GENERATION_POLL_WAIT, remaining)},
+                                              headers=trace_headers())
+        response.raise_for_status()
+        result = response.json()
+    if result["status"] == "failed":
+        # Sobrecarga do gerador (pool de conversão saturado) chega ao cliente como 503, não 500.
+        if result.get("error_status_code") == 503:
+            raise HTTPException(status_code=503, detail=result["error"], headers={"Retry-After": "5"})
+        raise HTTPException(status_code=500, detail=f"Erro inesperado no serviço de geração: {result['error']}")
+    return result
 
 @app.post("/api/v1/generate")
-def generate_documents(request: GenerationRequest):
-    job = jobs.get(request.job_id)
+async def generate_documents(request: GenerationRequest):
+    job = job_store.get(request.job_id)
     if not job or job["status"] != "ready":
         raise HTTPException(status_code=400, detail="O trabalho não está pronto para geração.")
 
     # --- Lógica de Feedback Enriquecido ---
-    if request.original_data != request.form_data:
+    # Todas as revisões contam para as taxas de correção por campo; as que alteram
+    # a resposta da IA são guardadas com o contexto do RAG para o fine-tuning.
+    # Se a fila de escrita estiver cheia, grava de imediato.
+    fields = list(get_form_fields_for_schema(job["form_type"]))
+    feedback = (job["form_type"], request.rag_context, request.original_data, request.form_data, fields)
+    if not feedback_store.enqueue(*feedback):
         try:
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO feedback (timestamp, form_type, rag_context, original_response, corrected_response) VALUES (?, ?, ?, ?, ?)",
-                (
-                    datetime.datetime.now().isoformat(),
-                    job["form_type"],
-                    request.rag_context, # Salva o contexto do RAG
-                    json.dumps(request.original_data),
-                    json.dumps(request.form_data)
-                )
-            )
-            conn.commit()
-            conn.close()
-            print("Feedback enriquecido (com contexto RAG) salvo na base de dados.")
+            await asyncio.to_thread(feedback_store.insert, *feedback)
         except Exception as e:
             print(f"ERRO ao guardar feedback na base de dados: {e}")
 
-    # --- Lógica de Geração (sem alteração) ---
+    # --- Lógica de Geração ---
+    # Payloads idênticos são deduplicados pelo gerador e apontam para os mesmos artefactos.
     payload = {"form_type": job["form_type"], "form_data": request.form_data}
-    internal_generator_url = f"{GENERATOR_SERVICE_URL}/api/v1/generate-document"
     public_download_url = "http://127.0.0.1:8001/download"
 
     try:
-        response = requests.post(internal_generator_url, json=payload, timeout=90.0)
-        response.raise_for_status()
-        result = response.json()
+        with stage_timer("document_generation"):
+            result = await await_generation(payload)
         return {
-            "message": result["message"],
+            "message": "Documentos gerados com sucesso.",
             "docx_url": f"{public_download_url}/{result['docx_filename']}",
             "pdf_url": f"{public_download_url}/{result['pdf_filename']}"
         }
-    except requests.exceptions.RequestException as e:
+    except HTTPException:
+        raise
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=503, detail=f"Não foi possível conectar ao serviço de geração: {e}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro inesperado no serviço de geração: {str(e)}")
@@ -235,82 +743,64 @@ def get_form_fields_for_schema(form_type: str) -> Dict[str, Any]:
             schema['fundamentacao_autorizacao'] = {"type": "STRING", "description": "Expor os motivos para interpor o recurso, especialmente se for matéria de autodispensa, e demonstrar prequestionamento e repercussão geral se aplicável."}
     return schema
 
-def build_rag_prompt_text(decision_text: str, relevant_policy_docs: List[Document]) -> str:
-    policy_context = "\n\n".join([doc.page_content for doc in relevant_policy_docs])
-
-    # --- PROMPT APRIMORADO v2.5 (foco em valor e Anexo I) ---
-    return f"""
-    Você é um assistente jurídico sênior, especialista na Política Recursal da instituição. Sua tarefa é preencher um formulário com precisão absoluta, seguindo um conjunto de regras não negociáveis.
-
-    **ORDEM DE ANÁLISE OBRIGATÓRIA:**
-    Você deve seguir os seguintes passos na ordem exata. Pare no primeiro passo que se aplicar.
-
-    **PASSO 1: VERIFICAÇÃO DE EXCEÇÕES ABSOLUTAS (Prioridade Máxima)**
-    * **Regra:** Verifique se a matéria da decisão se enquadra em alguma das exceções (PASEP, FIES, MCMV, Cédula Rural, Superendividamento, matérias residuais).
-    * **Ação:** Se for uma exceção e o formulário for de 'autodispensa', preencha o campo 'fundamento_autodispensa' com: **"AVISO: VEDAÇÃO ABSOLUTA. A matéria ([nome da matéria]) não permite autodispensa."** e finalize a análise de fundamentação.
-
-    **PASSO 2: ANÁLISE DA HIPÓTESE DE VALOR (Cenário Principal para Autodispensa)**
-    * **Regra:** Se o formulário for de 'autodispensa' e o PASSO 1 não se aplicar, verifique se a **condenação patrimonial total** (excluindo juros e correção monetária) é inferior aos limites estabelecidos no "Anexo I – Hipóteses de Autodispensa Obrigatória".
-    * **Ação:** Se o valor for inferior a R$5.000,00 (Juizados Especiais) ou R$10.000,00 (Justiça Comum), sua fundamentação no campo 'fundamento_autodispensa' DEVE ser: **"Conforme 13.1.3 Anexo I, inciso [I ou II], a condenação total de R$ [valor extraído] é inferior ao limite para a presente ação, sendo a autodispensa obrigatória."**
+# Versão do prompt (faz parte da chave da cache de resultados; alterar ao mudar o prompt)
+PROMPT_VERSION = "2.8"
 
-    **PASSO 3: ANÁLISE DAS DEMAIS HIPÓTESES (Apenas se os passos 1 e 2 não se aplicarem)**
-    * **Regra da Hipótese Única:** Selecione **apenas UMA** outra hipótese do "Anexo I" que se aplique perfeitamente ao caso. Todas as justificativas para autodispensa devem, obrigatoriamente, originar-se deste anexo.
-    * **Regra da Fundamentação Direta:** Se encontrar uma hipótese, inicie a fundamentação com a citação do item (ex: "Conforme 13.1.3 Anexo I, alínea 'x'...") e explique o enquadramento.
-    * **Regra da Não-Conformação:** Se nenhuma hipótese do Anexo I se aplicar, retorne a frase exata: **"AVISO: A situação fática não se enquadra em nenhuma hipótese de autodispensa prevista no Anexo I da Política Recursal."**
+def format_policy_excerpt(doc: "Document") -> str:
+    """Trecho da política precedido da secção e das páginas, para a IA poder citar o item."""
+    meta = doc.metadata or {}
+    if not meta.get("section"):
+        return doc.page_content
+    pages = f"p. {meta['page_start']}" if meta["page_start"] == meta["page_end"] else f"p. {meta['page_start']}-{meta['page_end']}"
+    label = " | ".join(part for part in (meta["section"], meta.get("annex"), pages) if part)
+    return f"[{label}]\n{doc.page_content}"
 
-    **REGRAS GERAIS ADICIONAIS:**
-    * **Dados Ausentes:** Se uma informação factual não estiver na decisão, preencha o campo com **"Não consta na decisão"**. NÃO INVENTE DADOS.
-
-    **DOCUMENTOS PARA ANÁLISE:**
-
-    **1. CONTEXTO DA POLÍTICA RECURSAL (Fonte da Verdade para Fundamentação):**
-    ---
-    {policy_context}
-    ---
-
-    **2. DECISÃO JUDICIAL (Fonte dos Fatos):**
-    ---
-    {decision_text[:14000]}
-    ---
-
-    **TAREFA FINAL:**
-    Seguindo rigorosamente a ORDEM DE ANÁLISE OBRIGATÓRIA, analise os documentos e preencha o esquema JSON a seguir.
-    """
-
-async def rag_ai_processing(job_id: str, form_type: str, file_content: bytes, vs: FAISS):
+async def rag_ai_processing(job_id: str, form_type: str, pdf_path: str, vs: "FAISS", cache_key: str | None = None):
     try:
-        with fitz.open(stream=file_content, filetype="pdf") as doc:
-            decision_text = "".join(page.get_text() for page in doc)
+        # Estágios CPU-bound fora do event loop (pool de processos / pool de threads);
+        # só as páginas necessárias para o orçamento de texto são extraídas.
+        update_job(job_id, stage="extracting")
+        decision_text, ingestion = await analysis_pipeline.extract_text(pdf_path)
         if not decision_text.strip(): raise ValueError("PDF vazio.")
 
-        query_text = decision_text[:2000]
-        relevant_docs = vs.similarity_search(query=query_text, k=3)
+        # Várias janelas da decisão num único lote de embeddings, unidas por MMR
+        update_job(job_id, stage="retrieving")
+        relevant_docs = await analysis_pipeline.retrieve(vs, decision_text)
 
         # Captura o contexto para o feedback
         rag_context_for_feedback = "\n\n---\n\n".join([doc.page_content for doc in relevant_docs])
-        jobs[job_id]["rag_context"] = rag_context_for_feedback # Armazena no job
+        update_job(job_id, rag_context=rag_context_for_feedback) # Armazena no job
 
-        prompt_text = build_rag_prompt_text(decision_text, relevant_docs)
+        # Decisão limpa e reduzida ao orçamento de tokens; instruções fixas fora do texto do utilizador
+        policy_context = "\n\n".join([format_policy_excerpt(doc) for doc in relevant_docs])
+        with stage_timer("prompt_assembly"):
+            prompt = build_prompt(decision_text, policy_context)
 
         json_schema = get_form_fields_for_schema(form_type)
         payload = {
-            "contents": [{"parts": [{"text": prompt_text}]}],
+            "contents": [{"role": "user", "parts": [{"text": prompt["user_text"]}]}],
             "generationConfig": {
                 "responseMimeType": "application/json",
                 "responseSchema": {"type": "OBJECT", "properties": json_schema}
             }
         }
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(GEMINI_API_URL, json=payload)
-            response.raise_for_status()
-        result = response.json()
+        update_job(job_id, stage="calling_model")
+        cached_instructions = await instruction_cache.get(gemini_client)
+        if cached_instructions:
+            payload["cachedContent"] = cached_instructions
+        else:
+            payload["systemInstruction"] = {"parts": [{"text": prompt["system_instruction"]}]}
+        with stage_timer("gemini_call"):
+            result = await gemini_client.generate_content(GEMINI_API_URL, payload)
+        usage = {**usage_from_response(result), **prompt["stats"], "ingestion": ingestion}
         if 'candidates' in result and result['candidates']:
-            extracted_data = json.loads(result['candidates'][0]['content']['parts'][0]['text'])
-            jobs[job_id]["status"] = "ready"
-            jobs[job_id]["data"] = extracted_data
+            with stage_timer("response_parsing"):
+                extracted_data = json.loads(result['candidates'][0]['content']['parts'][0]['text'])
+            update_job(job_id, status="ready", data=extracted_data, usage=usage)
+            if cache_key:
+                analysis_cache.put(cache_key, extracted_data, rag_context_for_feedback)
         else:
             raise ValueError(f"Resposta inesperada da API Gemini: {result}")
     except Exception as e:
         print(f"Erro no processamento RAG do trabalho {job_id}: {e}")
-        jobs[job_id]["status"] = "failed"
-        jobs[job_id]["data"] = {"error": str(e)}
\ No newline at end of file
+        update_job(job_id, status="failed", data={"error": str(e)})
\ No newline at end of file
@@ -0,0 +1,265 @@
+# metrics.py
+# Instrumentação partilhada pelos três serviços (API, gerador e treinamento).
+#
+# Histogramas por estágio, gauges de pedidos em curso e de filas e contadores de
+# erros, expostos em /metrics no formato de texto do Prometheus. Cada processo tem
+# o seu registo (com vários workers uvicorn, o Prometheus agrega por instância).
+# Opcionalmente (TRACE_IDS=1), cada pedido recebe um trace id (cabeçalho X-Trace-Id),
+# que a API reencaminha para o gerador.
+#
+# O núcleo usa apenas a biblioteca padrão; o FastAPI só é importado por instrument_app.
+
+import os
+import time
+import uuid
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+TRACE_IDS = os.getenv("TRACE_IDS", "0") == "1"
+TRACE_HEADER = "X-Trace-Id"
+METRICS_PREFIX = "recanalysis_"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = METRICS_PREFIX + name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def _samples(self):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels: str):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str):
+        self.inc(-amount, **labels)
+
+    def _samples(self):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(self.values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Por combinação de labels: contagens por bucket (não cumulativas), soma e total.
+        self.series: Dict[LabelValues, List] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def _samples(self):
+        lines = []
+        for key, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = ("le", _format_value(bound))
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    """Métricas do processo e funções chamadas a cada leitura (p. ex. profundidade das filas)."""
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]):
+        """Regista uma função que atualiza gauges imediatamente antes de cada leitura."""
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                print(f"Erro ao recolher métricas: {e}")
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram("stage_seconds", "Duração de cada estágio de processamento.", ("stage",)))
+STAGE_IN_PROGRESS = REGISTRY.register(Gauge("stage_in_progress", "Execuções em curso de cada estágio.", ("stage",)))
+STAGE_ERRORS = REGISTRY.register(Counter("stage_errors_total", "Execuções de estágios terminadas com erro.", ("stage", "error")))
+QUEUE_DEPTH = REGISTRY.register(Gauge("queue_depth", "Itens à espera em cada fila.", ("queue",)))
+HTTP_SECONDS = REGISTRY.register(Histogram("http_request_seconds", "Duração dos pedidos HTTP.", ("method", "route", "status")))
+HTTP_IN_PROGRESS = REGISTRY.register(Gauge("http_requests_in_progress", "Pedidos HTTP em curso.", ("method",)))
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """Mede um estágio: histograma de duração, gauge em curso e contador de erros."""
+    STAGE_IN_PROGRESS.inc(stage=stage)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        STAGE_ERRORS.inc(stage=stage, error=type(e).__name__)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+        STAGE_IN_PROGRESS.dec(stage=stage)
+
+
+def track_queues(queues: Callable[[], Dict[str, float]]):
+    """Atualiza QUEUE_DEPTH a cada leitura com {nome da fila: profundidade}."""
+    def collect():
+        for name, depth in queues().items():
+            QUEUE_DEPTH.set(depth, queue=name)
+    REGISTRY.add_collector(collect)
+
+
+# --- Trace IDs ---
+
+_trace_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("trace_id", default=None)
+
+
+def current_trace_id() -> Optional[str]:
+    return _trace_id.get()
+
+
+def trace_headers() -> Dict[str, str]:
+    """Cabeçalhos a reencaminhar para outros serviços (vazio sem trace id ativo)."""
+    trace_id = _trace_id.get()
+    return {TRACE_HEADER: trace_id} if trace_id else {}
+
+
+def instrument_app(app, trace_ids: bool = TRACE_IDS):
+    """Adiciona ao app FastAPI o middleware de métricas/trace id e o endpoint /metrics."""
+    from fastapi import Request
+    from fastapi.responses import PlainTextResponse
+
+    @app.middleware("http")
+    async def metrics_middleware(request: Request, call_next):
+        token = None
+        trace_id = None
+        if trace_ids:
+            trace_id = request.headers.get(TRACE_HEADER) or uuid.uuid4().hex
+            token = _trace_id.set(trace_id)
+        method = request.method
+        HTTP_IN_PROGRESS.inc(method=method)
+        started = time.perf_counter()
+
+        def observe(status: str):
+            # O caminho do route (com {parâmetros}) evita uma série por cada job_id/ficheiro.
+            route = getattr(request.scope.get("route"), "path", None) or "unmatched"
+            HTTP_SECONDS.observe(time.perf_counter() - started, method=method, route=route, status=status)
+            HTTP_IN_PROGRESS.dec(method=method)
+
+        async def timed_body(body_iterator, status: str):
+            # Respostas em stream (SSE, NDJSON, exportações) só terminam quando o corpo acaba
+            # de ser enviado (ou o cliente se desliga), não quando os cabeçalhos saem.
+            try:
+                async for chunk in body_iterator:
+                    yield chunk
+            finally:
+                observe(status)
+
+        try:
+            response = await call_next(request)
+        except Exception:
+            observe("500")
+            raise
+        finally:
+            if token is not None:
+                _trace_id.reset(token)
+        if trace_id:
+            response.headers[TRACE_HEADER] = trace_id
+        response.body_iterator = timed_body(response.body_iterator, str(response.status_code))
+        return response
+
+    @app.get("/metrics", include_in_schema=False)
+    def get_metrics():
+        return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,318 @@
+# pipeline.py
+# Execução dos estágios CPU-bound do pipeline de análise fora do event loop.
+#
+# A extração de texto com PyMuPDF corre num pool de processos e a pesquisa
+# vetorial (embedding + FAISS) num pool de threads. Cada estágio tem o seu
+# timeout e contadores de fila, para que um PDF grande não bloqueie os
+# restantes pedidos (incluindo os de /status).
+#
+# A extração lê o PDF do spool (o conteúdo não passa pela API nem entre processos)
+# e avança por lotes de páginas em paralelo, das pontas para o meio (preâmbulo e
+# dispositivo primeiro), até reunir PDF_TEXT_BUDGET_CHARS caracteres. Os títulos de
+# secção são detetados pela formatação (negrito, corpo maior, maiúsculas) e separam
+# os blocos usados na seleção do prompt. Com PDF_OCR=1, as páginas sem camada de
+# texto passam por OCR (Tesseract, via PyMuPDF) num estágio próprio.
+
+import os
+import re
+import time
+import asyncio
+import threading
+import statistics
+import multiprocessing
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+
+import fitz  # PyMuPDF
+
+from retrieval import multi_query_search
+from metrics import stage_timer
+from prompt_builder import OMITTED_MARKER
+
+PDF_PROCESS_WORKERS = int(os.getenv("PDF_PROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+SEARCH_THREAD_WORKERS = int(os.getenv("SEARCH_THREAD_WORKERS", "2"))
+PDF_EXTRACTION_TIMEOUT = float(os.getenv("PDF_EXTRACTION_TIMEOUT", "60"))
+RETRIEVAL_TIMEOUT = float(os.getenv("RETRIEVAL_TIMEOUT", "30"))
+# Texto extraído por decisão (várias vezes o orçamento do prompt: a limpeza e a seleção reduzem-no)
+PDF_TEXT_BUDGET_CHARS = int(os.getenv("PDF_TEXT_BUDGET_CHARS", "80000"))
+# Páginas por tarefa do pool de processos; cada ronda lança uma tarefa por worker
+PDF_PAGE_BATCH = int(os.getenv("PDF_PAGE_BATCH", "4"))
+PDF_OCR = os.getenv("PDF_OCR", "0") == "1"
+PDF_OCR_LANGUAGE = os.getenv("PDF_OCR_LANGUAGE", "por")
+PDF_OCR_DPI = int(os.getenv("PDF_OCR_DPI", "200"))
+PDF_OCR_TIMEOUT = float(os.getenv("PDF_OCR_TIMEOUT", "120"))
+# Abaixo disto (em caracteres) a página é considerada sem camada de texto
+TEXT_LAYER_MIN_CHARS = 20
+
+# Títulos de secção habituais em sentenças e acórdãos
+SECTION_PATTERN = re.compile(
+    r"^(i+\s*[-–.)]\s*)?(relat[óo]rio|fundamenta[çc][ãa]o|dispositivo|decis[ãa]o|decido|voto|ementa|"
+    r"ac[óo]rd[ãa]o|senten[çc]a|conclus[ãa]o|d[oa]s? fatos?|do m[ée]rito|das? preliminar(es)?)\b[\s:.–-]*$",
+    re.IGNORECASE,
+)
+HEADING_MAX_CHARS = 80
+HEADING_SIZE_RATIO = 1.15
+BOLD_FLAG = 16
+
+
+class StageTimeoutError(Exception):
+    """Um estágio do pipeline excedeu o seu timeout."""
+
+
+def pdf_page_count(path: str) -> int:
+    with fitz.open(path) as doc:
+        return doc.page_count
+
+
+def page_order(page_count: int) -> List[int]:
+    """Páginas das pontas para o meio: 0, n-1, 1, n-2, ..."""
+    order = []
+    low, high = 0, page_count - 1
+    while low <= high:
+        order.append(low)
+        if high != low:
+            order.append(high)
+        low, high = low + 1, high - 1
+    return order
+
+
+def _is_heading(text: str, size: float, bold: bool, body_size: float) -> bool:
+    if len(text) > HEADING_MAX_CHARS or text.endswith((",", ";")):
+        return False
+    if SECTION_PATTERN.match(text):
+        return True
+    letters = [char for char in text if char.isalpha()]
+    return bold or size >= body_size * HEADING_SIZE_RATIO or (len(letters) >= 4 and text.isupper())
+
+
+def _page_text(page: "fitz.Page") -> Tuple[str, List[str]]:
+    """
+    Texto da página com os parágrafos (blocos do layout) e os títulos separados por
+    linhas em branco. Devolve também os títulos de secção reconhecidos.
+    """
+    blocks = []
+    for block in page.get_text("dict", flags=fitz.TEXTFLAGS_TEXT)["blocks"]:
+        lines = []
+        for line in block.get("lines", []):
+            spans = [span for span in line["spans"] if span["text"].strip()]
+            if spans:
+                text = " ".join("".join(span["text"] for span in line["spans"]).split())
+                lines.append((text, max(span["size"] for span in spans), all(span["flags"] & BOLD_FLAG for span in spans)))
+        if lines:
+            blocks.append(lines)
+    if not blocks:
+        return "", []
+    body_size = statistics.median(size for lines in blocks for _, size, _ in lines)
+
+    paragraphs: List[List[str]] = []
+    sections: List[str] = []
+    for lines in blocks:
+        paragraphs.append([])
+        for text, size, bold in lines:
+            if _is_heading(text, size, bold, body_size):
+                if SECTION_PATTERN.match(text):
+                    sections.append(text)
+                paragraphs.extend([[text], []])
+            else:
+                paragraphs[-1].append(text)
+    return "\n\n".join("\n".join(lines) for lines in paragraphs if lines), sections
+
+
+def extract_pages(path: str, page_numbers: List[int]) -> List[Dict[str, Any]]:
+    """Extrai as páginas pedidas (executado num processo separado)."""
+    pages = []
+    with fitz.open(path) as doc:
+        for number in page_numbers:
+            page = doc[number]
+            text, sections = _page_text(page)
+            has_text = len(text.strip()) >= TEXT_LAYER_MIN_CHARS
+            pages.append({
+                "page": number,
+                "text": text,
+                "sections": sections,
+                "needs_ocr": not has_text and bool(page.get_images()),
+            })
+    return pages
+
+
+def ocr_page(path: str, page_number: int, language: str = PDF_OCR_LANGUAGE, dpi: int = PDF_OCR_DPI) -> str:
+    """OCR de uma página digitalizada (requer o Tesseract instalado; executado num processo separado)."""
+    with fitz.open(path) as doc:
+        page = doc[page_number]
+        textpage = page.get_textpage_ocr(language=language, dpi=dpi, full=True)
+        return page.get_text(textpage=textpage)
+
+
+class RestartableProcessPool(Executor):
+    """
+    Pool de processos que pode ser substituído quando uma tarefa excede o timeout:
+    cancelar o future não pára o fitz/OCR no worker, que continuaria a ocupar a vaga.
+    Os workers são criados com 'spawn', porque o fork lazy do pool acontece com as
+    threads do carregamento do índice e do torch já a correr (risco de deadlock).
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.restarts = 0
+        self.pool = self._create()
+
+    def _create(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def submit(self, fn: Callable[..., Any], /, *args: Any, **kwargs: Any) -> Future:
+        with self.lock:
+            return self.pool.submit(fn, *args, **kwargs)
+
+    def restart(self, generation: int):
+        """Mata os workers e cria um pool novo (uma vez por geração, mesmo com vários timeouts)."""
+        with self.lock:
+            if generation != self.generation:
+                return
+            old = self.pool
+            self.pool = self._create()
+            self.generation += 1
+            self.restarts += 1
+        # As outras tarefas do pool antigo falham (BrokenProcessPool) em vez de esperarem pelo timeout.
+        for process in list((getattr(old, "_processes", None) or {}).values()):
+            process.kill()
+        old.shutdown(wait=False, cancel_futures=True)
+        print(f"Aviso: pool de processos do pipeline reiniciado após timeout ({self.restarts} reinício(s)).")
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        self.pool.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+
+class PipelineStage:
+    """Um estágio do pipeline ligado a um executor, com timeout e métricas próprias."""
+
+    def __init__(self, name: str, executor: Executor, workers: int, timeout: float):
+        self.name = name
+        self.executor = executor
+        self.workers = workers
+        self.timeout = timeout
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        # Só as execuções bem-sucedidas entram na média; falhas e timeouts têm tempos próprios.
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.failed_seconds = 0.0
+        self.timeout_seconds_total = 0.0
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        generation = getattr(self.executor, "generation", None)
+        self.in_flight += 1
+        started = time.perf_counter()
+        try:
+            with stage_timer(self.name):
+                result = await asyncio.wait_for(loop.run_in_executor(self.executor, func, *args), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self.timeout_seconds_total += time.perf_counter() - started
+            if isinstance(self.executor, RestartableProcessPool):
+                self.executor.restart(generation)
+            raise StageTimeoutError(f"O estágio '{self.name}' excedeu {self.timeout:.0f}s.")
+        except Exception:
+            self.failed += 1
+            self.failed_seconds += time.perf_counter() - started
+            raise
+        finally:
+            self.in_flight -= 1
+        elapsed = time.perf_counter() - started
+        self.completed += 1
+        self.total_seconds += elapsed
+        self.max_seconds = max(self.max_seconds, elapsed)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": max(0, self.in_flight - self.workers),
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "avg_seconds": round(self.total_seconds / self.completed, 4) if self.completed else 0.0,
+            "max_seconds": round(self.max_seconds, 4),
+            "failed_avg_seconds": round(self.failed_seconds / self.failed, 4) if self.failed else 0.0,
+            "timeouts_avg_seconds": round(self.timeout_seconds_total / self.timeouts, 4) if self.timeouts else 0.0,
+            "timeout_seconds": self.timeout,
+        }
+
+
+class AnalysisPipeline:
+    """Agrupa os executores partilhados pelos estágios da análise."""
+
+    def __init__(self):
+        self.process_pool = RestartableProcessPool(PDF_PROCESS_WORKERS)
+        self.thread_pool = ThreadPoolExecutor(max_workers=SEARCH_THREAD_WORKERS, thread_name_prefix="retrieval")
+        self.extraction = PipelineStage("pdf_extraction", self.process_pool, PDF_PROCESS_WORKERS, PDF_EXTRACTION_TIMEOUT)
+        self.ocr = PipelineStage("pdf_ocr", self.process_pool, PDF_PROCESS_WORKERS, PDF_OCR_TIMEOUT)
+        self.retrieval = PipelineStage("retrieval", self.thread_pool, SEARCH_THREAD_WORKERS, RETRIEVAL_TIMEOUT)
+
+    async def _ocr(self, path: str, page: Dict[str, Any]) -> bool:
+        try:
+            page["text"] = (await self.ocr.run(ocr_page, path, page["page"])).strip()
+            page["ocr"] = True
+            return True
+        except Exception as e:
+            print(f"Aviso: OCR da página {page['page'] + 1} de '{path}' falhou: {e}")
+            return False
+
+    async def extract_text(self, path: str, budget_chars: int = PDF_TEXT_BUDGET_CHARS) -> Tuple[str, Dict[str, Any]]:
+        """
+        Extrai o texto da decisão até ao orçamento de caracteres. As páginas vêm separadas
+        por '\\f', pela ordem do documento, com '[...]' no lugar das que não foram lidas.
+        """
+        with stage_timer("pdf_ingestion"):
+            page_count = await asyncio.to_thread(pdf_page_count, path)
+            order = page_order(page_count)
+            pages: Dict[int, Dict[str, Any]] = {}
+            chars = 0
+            position = 0
+            ocr_pages = 0
+            round_size = PDF_PAGE_BATCH * PDF_PROCESS_WORKERS
+            while position < len(order) and chars < budget_chars:
+                numbers = order[position:position + round_size]
+                position += len(numbers)
+                groups = [sorted(numbers[i:i + PDF_PAGE_BATCH]) for i in range(0, len(numbers), PDF_PAGE_BATCH)]
+                results = await asyncio.gather(*(self.extraction.run(extract_pages, path, group) for group in groups))
+                extracted = [page for result in results for page in result]
+                scanned = [page for page in extracted if page["needs_ocr"]]
+                if PDF_OCR and scanned:
+                    ocr_pages += sum(await asyncio.gather(*(self._ocr(path, page) for page in scanned)))
+                for page in extracted:
+                    pages[page["page"]] = page
+                    chars += len(page["text"])
+
+            parts: List[str] = []
+            previous = -1
+            for number in sorted(pages):
+                text = pages[number]["text"]
+                parts.append(f"{OMITTED_MARKER}\n{text}" if number != previous + 1 else text)
+                previous = number
+            if previous != page_count - 1 and parts:
+                parts.append(OMITTED_MARKER)
+        stats = {
+            "pages_total": page_count,
+            "pages_extracted": len(pages),
+            # Páginas digitalizadas que continuam sem texto depois do OCR (desligado ou falhado).
+            "pages_without_text": sum(1 for page in pages.values() if page["needs_ocr"] and not page.get("ocr")),
+            "ocr_pages": ocr_pages,
+            "extracted_chars": chars,
+            "sections": [f"{title} (p. {number + 1})" for number in sorted(pages) for title in pages[number]["sections"]],
+        }
+        return "\f".join(parts), stats
+
+    async def retrieve(self, vs, decision_text: str):
+        return await self.retrieval.run(multi_query_search, vs, decision_text)
+
+    def stats(self) -> Dict[str, Any]:
+        return {stage.name: stage.stats() for stage in (self.extraction, self.ocr, self.retrieval)}
+
+    def shutdown(self):
+        self.process_pool.shutdown(wait=False, cancel_futures=True)
+        self.thread_pool.shutdown(wait=False, cancel_futures=True)
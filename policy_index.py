@@ -0,0 +1,547 @@
+# policy_index.py
+# Índice vetorial da Política Recursal num formato nativo e seguro.
+#
+# Em vez de serializar com pickle o objeto FAISS do LangChain inteiro, o índice é
+# guardado como:
+#   index.faiss    índice FAISS nativo, carregado com mmap (páginas partilhadas entre workers)
+#   chunks.jsonl   texto e metadados (secção, anexo, páginas) de cada chunk, uma linha por vetor
+#   manifest.json  hash do PDF da política, modelo de embeddings e versão do formato
+# Cada versão (hash do PDF + modelo) tem a sua pasta, <raiz>/<política>/<versão>/, e o
+# ficheiro CURRENT de cada política aponta para a versão em uso; várias políticas e
+# as últimas POLICY_INDEX_KEEP_VERSIONS versões coexistem na mesma raiz.
+# Uma nova versão só vetoriza os chunks novos ou alterados: os restantes reaproveitam
+# os vetores de versões anteriores pelo hash do texto. O PolicyIndexLoader constrói-a
+# em segundo plano e troca a versão ativa sem reiniciar a API.
+#
+# As dependências pesadas (faiss, langchain, sentence-transformers/torch) só são
+# importadas quando o índice é efetivamente carregado, o que permite à API
+# arrancar de imediato e carregar o modelo em segundo plano (PolicyIndexLoader).
+
+import os
+import re
+import json
+import time
+import fcntl
+import shutil
+import asyncio
+import hashlib
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+if TYPE_CHECKING:
+    from langchain.docstore.document import Document
+    from langchain_community.vectorstores import FAISS
+
+INDEX_FORMAT_VERSION = 3
+INDEX_FILE = "index.faiss"
+CHUNKS_FILE = "chunks.jsonl"
+MANIFEST_FILE = "manifest.json"
+CURRENT_FILE = "CURRENT"
+LOCK_FILE = ".build.lock"
+
+# --- Versões e reconstrução incremental ---
+KEEP_VERSIONS = int(os.getenv("POLICY_INDEX_KEEP_VERSIONS", "3"))
+# Intervalo de verificação do PDF da política (0 = só reconstrói a pedido)
+WATCH_INTERVAL = float(os.getenv("POLICY_INDEX_WATCH_INTERVAL", "60"))
+EMBED_BATCH_SIZE = int(os.getenv("POLICY_EMBED_BATCH_SIZE", "32"))
+EMBED_WORKERS = int(os.getenv("POLICY_EMBED_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# --- Chunking por estrutura da Política ---
+CHUNK_MAX_CHARS = int(os.getenv("POLICY_CHUNK_MAX_CHARS", "1200"))
+# Títulos numerados: "13.1.3 Anexo I – Hipóteses de Autodispensa..."
+SECTION_PATTERN = re.compile(r"^\s*(\d{1,3}(?:\.\d{1,3})+)\.?\s+\S")
+ANNEX_PATTERN = re.compile(r"\bAnexo\s+([IVXLC]+)\b", re.IGNORECASE)
+# Incisos "IV) ..."/"IV. ..." e alíneas "a) ..."/"a. ..." delimitam as unidades dentro de uma secção
+ITEM_PATTERN = re.compile(r"^\s*(?:[IVXLC]+|[a-z])[).](?:\s+|$)")
+PAGE_NUMBER_PATTERN = re.compile(r"^\s*\d+\s*/\s*\d+\s*$")
+
+
+def _mmap_flags() -> int:
+    import faiss
+    # IO_FLAG_MMAP_IFC mapeia os códigos dos índices planos (IndexFlat*) em versões recentes do FAISS.
+    return faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def expected_manifest(policy_path: str, embedding_model: str) -> Dict[str, Any]:
+    policy_sha256 = file_sha256(policy_path)
+    version = hashlib.sha256(f"{INDEX_FORMAT_VERSION}:{policy_sha256}:{embedding_model}".encode()).hexdigest()[:16]
+    return {
+        "format_version": INDEX_FORMAT_VERSION,
+        "policy_sha256": policy_sha256,
+        "embedding_model": embedding_model,
+        "version": version,
+    }
+
+
+def read_manifest(index_dir: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(index_dir, MANIFEST_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _is_current(manifest: Optional[Dict[str, Any]], expected: Dict[str, Any]) -> bool:
+    return manifest is not None and all(manifest.get(key) == value for key, value in expected.items())
+
+
+def _policy_lines(policy_path: str) -> Iterator[Tuple[int, str]]:
+    """Linhas da política com o número da página, sem cabeçalhos/rodapés repetidos."""
+    import fitz  # PyMuPDF
+
+    with fitz.open(policy_path) as doc:
+        pages = [page.get_text().splitlines() for page in doc]
+    # Uma linha presente em mais de metade das páginas é um cabeçalho ou rodapé.
+    counts = Counter(line.strip() for lines in pages for line in set(lines) if line.strip())
+    banners = {line for line, count in counts.items() if len(pages) > 2 and count > len(pages) / 2}
+    for page_number, lines in enumerate(pages, start=1):
+        for line in lines:
+            stripped = line.strip()
+            if not stripped or stripped in banners or PAGE_NUMBER_PATTERN.match(stripped):
+                continue
+            yield page_number, line.rstrip()
+
+
+def _split_policy(policy_path: str) -> List["Document"]:
+    """
+    Divide a política pelas suas secções numeradas (13.1.3, 13.4.1...) e, dentro
+    de cada secção, pelos incisos/alíneas, juntando unidades até CHUNK_MAX_CHARS.
+    Cada chunk leva a secção, o anexo e o intervalo de páginas nos metadados.
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    from langchain.docstore.document import Document
+
+    sections: List[Dict[str, Any]] = []
+    current: Dict[str, Any] = {"section": None, "title": None, "annex": None, "units": [[]]}
+    sections.append(current)
+    for page, line in _policy_lines(policy_path):
+        match = SECTION_PATTERN.match(line)
+        if match:
+            annex = ANNEX_PATTERN.search(line)
+            current = {
+                "section": match.group(1),
+                "title": line.strip(),
+                "annex": f"Anexo {annex.group(1).upper()}" if annex else None,
+                "units": [[]],
+            }
+            sections.append(current)
+        elif ITEM_PATTERN.match(line) and current["units"][-1]:
+            current["units"].append([])
+        current["units"][-1].append((page, line))
+
+    oversized_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_MAX_CHARS, chunk_overlap=100)
+    chunks: List[Document] = []
+
+    def emit(section: Dict[str, Any], text: str, pages: List[int], starts_section: bool):
+        # Chunks a meio de uma secção levam o título dela, para a recuperação e a citação.
+        if not starts_section and section["title"]:
+            text = f"[{section['title']}]\n{text}"
+        chunks.append(Document(page_content=text, metadata={
+            "section": section["section"],
+            "annex": section["annex"],
+            "page_start": min(pages),
+            "page_end": max(pages),
+        }))
+
+    for section in sections:
+        buffer: List[str] = []
+        buffer_pages: List[int] = []
+        starts_section = True
+        for unit in section["units"]:
+            if not unit:
+                continue
+            unit_text = "\n".join(line for _, line in unit)
+            unit_pages = [page for page, _ in unit]
+            if buffer and len("\n".join(buffer)) + len(unit_text) > CHUNK_MAX_CHARS:
+                emit(section, "\n".join(buffer), buffer_pages, starts_section)
+                buffer, buffer_pages, starts_section = [], [], False
+            if len(unit_text) > CHUNK_MAX_CHARS:
+                for piece in oversized_splitter.split_text(unit_text):
+                    emit(section, piece, unit_pages, starts_section)
+                    starts_section = False
+                continue
+            buffer.append(unit_text)
+            buffer_pages.extend(unit_pages)
+        if buffer:
+            emit(section, "\n".join(buffer), buffer_pages, starts_section)
+    return chunks
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def chunk_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def policy_slug(policy_path: str) -> str:
+    """Nome da pasta da política dentro da raiz dos índices."""
+    stem = os.path.splitext(os.path.basename(policy_path))[0]
+    return re.sub(r"[^\w.-]+", "_", stem).strip("_") or "policy"
+
+
+def list_versions(policy_root: str) -> List[Dict[str, Any]]:
+    """Versões completas de uma política (com manifesto), da mais recente para a mais antiga."""
+    versions = []
+    try:
+        entries = list(os.scandir(policy_root))
+    except OSError:
+        return versions
+    for entry in entries:
+        if not entry.is_dir() or entry.name.startswith(".") or ".tmp-" in entry.name:
+            continue
+        manifest = read_manifest(entry.path)
+        if manifest:
+            versions.append({**manifest, "path": entry.path})
+    return sorted(versions, key=lambda manifest: manifest.get("built_at", 0), reverse=True)
+
+
+def read_current(policy_root: str) -> Optional[str]:
+    try:
+        with open(os.path.join(policy_root, CURRENT_FILE), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def prune_versions(policy_root: str, keep: int, protect: Set[Optional[str]]):
+    """Remove as versões mais antigas além de 'keep', exceto as protegidas (ativas noutros processos)."""
+    protect = protect | {read_current(policy_root)}
+    for manifest in list_versions(policy_root)[keep:]:
+        if manifest["version"] in protect:
+            continue
+        # Um processo que ainda tenha a versão mapeada (mmap) continua a lê-la depois do unlink.
+        shutil.rmtree(manifest["path"], ignore_errors=True)
+        print(f"Versão antiga do índice removida: {manifest['path']}")
+
+
+def _reusable_vectors(index_root: str, embedding_model: str, wanted: Set[str]) -> Dict[str, Any]:
+    """Vetores já calculados, em qualquer política/versão com o mesmo modelo, para os hashes pedidos."""
+    import faiss
+
+    found: Dict[str, Any] = {}
+    try:
+        policy_roots = [entry.path for entry in os.scandir(index_root) if entry.is_dir()]
+    except OSError:
+        return found
+    for policy_root in policy_roots:
+        for manifest in list_versions(policy_root):
+            if wanted <= found.keys():
+                return found
+            if manifest.get("embedding_model") != embedding_model or manifest.get("format_version") != INDEX_FORMAT_VERSION:
+                continue
+            try:
+                positions = {}
+                with open(os.path.join(manifest["path"], CHUNKS_FILE), encoding="utf-8") as f:
+                    for position, line in enumerate(f):
+                        digest = json.loads(line).get("hash")
+                        if digest in wanted and digest not in found:
+                            positions[digest] = position
+                if positions:
+                    index = faiss.read_index(os.path.join(manifest["path"], INDEX_FILE), _mmap_flags())
+                    for digest, position in positions.items():
+                        found[digest] = index.reconstruct(position)
+            except (OSError, ValueError, RuntimeError) as e:
+                print(f"Aviso: versão '{manifest['path']}' ignorada ao reaproveitar vetores: {e}")
+    return found
+
+
+def embed_in_batches(embeddings, texts: List[str], batch_size: int = EMBED_BATCH_SIZE,
+                     workers: int = EMBED_WORKERS) -> List[List[float]]:
+    """Vetoriza em lotes; com vários workers os lotes correm em paralelo (o torch liberta o GIL)."""
+    batches = [texts[start:start + batch_size] for start in range(0, len(texts), batch_size)]
+    if workers <= 1 or len(batches) <= 1:
+        return [vector for batch in batches for vector in embeddings.embed_documents(batch)]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="policy-embed") as pool:
+        return [vector for result in pool.map(embeddings.embed_documents, batches) for vector in result]
+
+
+def build_index(policy_path: str, embeddings, index_dir: str, manifest: Dict[str, Any], index_root: str) -> Dict[str, Any]:
+    """
+    Grava índice, sidecar e manifesto (este por último) numa pasta nova. Só os chunks
+    novos ou alterados são vetorizados; os restantes reaproveitam os vetores de versões
+    anteriores pelo hash do texto.
+    """
+    import faiss
+    import numpy as np
+
+    chunks = _split_policy(policy_path)
+    hashes = [chunk_hash(chunk.page_content) for chunk in chunks]
+    vectors_by_hash = _reusable_vectors(index_root, manifest["embedding_model"], set(hashes))
+    reused = sum(1 for digest in hashes if digest in vectors_by_hash)
+    missing = {digest: chunk.page_content for digest, chunk in zip(hashes, chunks) if digest not in vectors_by_hash}
+    vectors_by_hash.update(zip(missing, embed_in_batches(embeddings, list(missing.values()))))
+    vectors = np.asarray([vectors_by_hash[digest] for digest in hashes], dtype="float32")
+
+    index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+    faiss.write_index(index, os.path.join(index_dir, INDEX_FILE))
+
+    lines = [json.dumps({"text": chunk.page_content, "metadata": chunk.metadata, "hash": digest}, ensure_ascii=False)
+             for chunk, digest in zip(chunks, hashes)]
+    _write_atomic(os.path.join(index_dir, CHUNKS_FILE), ("\n".join(lines) + "\n").encode("utf-8"))
+
+    manifest = {**manifest, "chunks": len(chunks), "dimension": int(vectors.shape[1]),
+                "reused_chunks": reused, "embedded_chunks": len(chunks) - reused, "built_at": time.time()}
+    _write_atomic(os.path.join(index_dir, MANIFEST_FILE), json.dumps(manifest, indent=2).encode("utf-8"))
+    return manifest
+
+
+def load_index(index_dir: str, embeddings) -> "FAISS":
+    """Carrega o índice com mmap e monta o vector store do LangChain sobre ele."""
+    import faiss
+    from langchain.docstore.document import Document
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores import FAISS
+
+    index = faiss.read_index(os.path.join(index_dir, INDEX_FILE), _mmap_flags())
+    documents: Dict[str, "Document"] = {}
+    with open(os.path.join(index_dir, CHUNKS_FILE), encoding="utf-8") as f:
+        for position, line in enumerate(f):
+            entry = json.loads(line)
+            documents[str(position)] = Document(page_content=entry["text"], metadata=entry.get("metadata") or {})
+    if len(documents) != index.ntotal:
+        raise ValueError(f"Índice inconsistente: {index.ntotal} vetores para {len(documents)} chunks.")
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(documents),
+        index_to_docstore_id={position: str(position) for position in range(len(documents))},
+    )
+
+
+
+def ensure_index_version(policy_path: str, embeddings, embedding_model: str, index_root: str,
+                         progress: Optional[Callable[[str], None]] = None,
+                         protect: Optional[Set[Optional[str]]] = None) -> Tuple[Dict[str, Any], str]:
+    """
+    Garante que existe a versão do índice para o PDF e o modelo atuais e marca-a como
+    a versão corrente da política. Devolve (manifesto, pasta da versão).
+    """
+    report = progress or (lambda stage: None)
+    policy_root = os.path.join(index_root, policy_slug(policy_path))
+    os.makedirs(policy_root, exist_ok=True)
+    report("checking_index")
+    expected = expected_manifest(policy_path, embedding_model)
+    version_dir = os.path.join(policy_root, expected["version"])
+    if _is_current(read_manifest(version_dir), expected) and read_current(policy_root) == expected["version"]:
+        return read_manifest(version_dir), version_dir
+
+    # Vários workers podem arrancar ao mesmo tempo: apenas um constrói a versão.
+    with open(os.path.join(policy_root, LOCK_FILE), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not _is_current(read_manifest(version_dir), expected):
+                report("building_index")
+                print(f"A construir a versão {expected['version']} do índice da política em '{policy_root}' "
+                      f"(modelo {embedding_model})...")
+                started = time.time()
+                tmp_dir = f"{version_dir}.tmp-{os.getpid()}"
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                os.makedirs(tmp_dir)
+                try:
+                    manifest = build_index(policy_path, embeddings, tmp_dir, expected, index_root)
+                    shutil.rmtree(version_dir, ignore_errors=True)
+                    # A versão só fica visível (com o manifesto) depois de completa.
+                    os.rename(tmp_dir, version_dir)
+                except Exception:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    raise
+                print(f"Índice construído em {time.time() - started:.1f}s: {manifest['embedded_chunks']} chunk(s) "
+                      f"vetorizado(s), {manifest['reused_chunks']} reaproveitado(s).")
+            _write_atomic(os.path.join(policy_root, CURRENT_FILE), expected["version"].encode("utf-8"))
+            prune_versions(policy_root, KEEP_VERSIONS, (protect or set()) | {expected["version"]})
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return read_manifest(version_dir), version_dir
+
+
+def _file_signature(path: str) -> Tuple[float, int]:
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size
+
+
+class PolicyIndexVersion:
+    """Uma versão carregada do índice; os trabalhos guardam a referência durante toda a análise."""
+
+    def __init__(self, manifest: Dict[str, Any], vector_store: "FAISS"):
+        self.version: str = manifest["version"]
+        self.manifest = manifest
+        self.vector_store = vector_store
+        self.loaded_at = time.time()
+
+
+class PolicyIndexLoader:
+    """
+    Carrega o modelo de embeddings e o índice numa thread de fundo, expondo o estado
+    para os endpoints de readiness. Quando o PDF da política muda (vigiado a cada
+    POLICY_INDEX_WATCH_INTERVAL segundos, ou a pedido com rebuild()), a nova versão é
+    construída em segundo plano e trocada sem reinício; a anterior continua a servir
+    as análises em curso.
+    """
+
+    def __init__(self, policy_path: str, embedding_model: str, index_dir: str,
+                 watch_interval: float = WATCH_INTERVAL):
+        self.policy_path = policy_path
+        self.embedding_model = embedding_model
+        self.index_dir = index_dir
+        self.policy_root = os.path.join(index_dir, policy_slug(policy_path))
+        self.watch_interval = watch_interval
+        self.state = "pending"  # pending -> loading -> ready | failed
+        self.stage: Optional[str] = None
+        self.error: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.active: Optional[PolicyIndexVersion] = None
+        self.embeddings = None
+        self.rebuild_state = "idle"  # idle -> building -> idle | failed
+        self.rebuild_error: Optional[str] = None
+        self.swaps = 0
+        self._signature: Optional[Tuple[float, int]] = None
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._build_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    @property
+    def version(self) -> Optional[str]:
+        """Versão do índice ativo (muda com o PDF da política ou o modelo)."""
+        return self.active.version if self.active else None
+
+    @property
+    def manifest(self) -> Optional[Dict[str, Any]]:
+        return self.active.manifest if self.active else None
+
+    def start(self, background: bool = True):
+        if self.state != "pending":
+            return
+        self.state = "loading"
+        self.started_at = time.time()
+        if background:
+            self._thread = threading.Thread(target=self._load, daemon=True, name="policy-index-loader")
+            self._thread.start()
+        else:
+            self._load()
+
+    def stop(self):
+        self._stop.set()
+
+    def _set_stage(self, stage: str):
+        self.stage = stage
+
+    def _prepare(self, progress: Callable[[str], None]) -> Optional[PolicyIndexVersion]:
+        """Garante a versão do PDF atual e carrega-a, se for diferente da ativa."""
+        self._signature = _file_signature(self.policy_path)
+        manifest, version_dir = ensure_index_version(self.policy_path, self.embeddings, self.embedding_model,
+                                                     self.index_dir, progress=progress, protect={self.version})
+        if self.active and manifest["version"] == self.active.version:
+            return None
+        progress("loading_index")
+        return PolicyIndexVersion(manifest, load_index(version_dir, self.embeddings))
+
+    def _load(self):
+        try:
+            self._set_stage("loading_embedding_model")
+            from langchain_community.embeddings import HuggingFaceEmbeddings
+            self.embeddings = HuggingFaceEmbeddings(model_name=self.embedding_model)
+            self.active = self._prepare(self._set_stage)
+            self.state = "ready"
+            self.stage = "ready"
+            print(f"Índice da política pronto em {time.time() - self.started_at:.1f}s (versão {self.version}).")
+            if self.watch_interval > 0:
+                threading.Thread(target=self._watch, daemon=True, name="policy-index-watcher").start()
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            print(f"ERRO ao carregar o índice da política: {e}")
+        finally:
+            self.finished_at = time.time()
+            self._ready.set()
+
+    def refresh(self) -> bool:
+        """Constrói e ativa a versão do PDF atual (bloqueante). Devolve True se a versão ativa mudou."""
+        if not self.ready or not self._build_lock.acquire(blocking=False):
+            return False
+        try:
+            self.rebuild_state = "building"
+            self.rebuild_error = None
+            previous = self.version
+            candidate = self._prepare(lambda stage: None)
+            self.rebuild_state = "idle"
+            if candidate is None:
+                return False
+            # Troca atómica da referência: as análises em curso terminam com a versão anterior.
+            self.active = candidate
+            self.swaps += 1
+            print(f"Índice da política trocado sem reinício: {previous} -> {candidate.version}.")
+            return True
+        except Exception as e:
+            self.rebuild_state = "failed"
+            self.rebuild_error = str(e)
+            print(f"ERRO ao reconstruir o índice da política: {e}")
+            return False
+        finally:
+            self._build_lock.release()
+
+    def rebuild(self) -> bool:
+        """Inicia refresh() numa thread de fundo; False se o índice ainda não carregou ou já há uma em curso."""
+        if not self.ready or self._build_lock.locked():
+            return False
+        threading.Thread(target=self.refresh, daemon=True, name="policy-index-rebuild").start()
+        return True
+
+    def _watch(self):
+        while not self._stop.wait(self.watch_interval):
+            try:
+                changed = _file_signature(self.policy_path) != self._signature
+            except OSError:
+                continue
+            if changed:
+                self.refresh()
+
+    async def wait_ready(self, timeout: Optional[float] = None) -> PolicyIndexVersion:
+        """Aguarda (sem bloquear o event loop) até o índice estar disponível e devolve a versão ativa."""
+        if not self._ready.is_set():
+            await asyncio.to_thread(self._ready.wait, timeout)
+        if not self.ready:
+            raise RuntimeError(self.error or "O índice da política ainda não está disponível.")
+        return self.active
+
+    def status(self) -> Dict[str, Any]:
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = round((self.finished_at or time.time()) - self.started_at, 2)
+        return {
+            "state": self.state,
+            "stage": self.stage,
+            "error": self.error,
+            "elapsed_seconds": elapsed,
+            "version": self.version,
+            "manifest": self.manifest,
+            "rebuild": {"state": self.rebuild_state, "error": self.rebuild_error, "swaps": self.swaps},
+            "versions": [
+                {key: manifest.get(key) for key in ("version", "policy_sha256", "chunks", "reused_chunks",
+                                                    "embedded_chunks", "built_at")}
+                for manifest in list_versions(self.policy_root)
+            ],
+        }
@@ -0,0 +1,283 @@
+# prompt_builder.py
+# Montagem do prompt de análise com orçamento de tokens.
+#
+# As instruções fixas vão em 'systemInstruction' (um prefixo idêntico em todos os
+# pedidos, que o Gemini reaproveita por cache implícita) e, opcionalmente, numa
+# cache de contexto explícita ('cachedContents'). A parte variável (trechos da
+# política + decisão) cabe em PROMPT_TOKEN_BUDGET: a decisão é limpa de cabeçalhos,
+# rodapés, banners repetidos e blocos de assinatura, e, se ainda não couber, ficam
+# o preâmbulo, o dispositivo e os parágrafos com mais informação pedida no esquema.
+
+import os
+import re
+import math
+import time
+import asyncio
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+# Estimativa local (sem pedido à API): caracteres por token em texto jurídico em português.
+PROMPT_CHARS_PER_TOKEN = float(os.getenv("PROMPT_CHARS_PER_TOKEN", "3.5"))
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "0") == "1"
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+
+# Preâmbulo da decisão (partes, número do processo, tipo de ação) mantido sempre.
+HEAD_CHARS = 1500
+# Um bloco maior do que isto é partido pelas linhas, para a seleção ser mais fina.
+MAX_BLOCK_CHARS = 1200
+# Linhas do topo/fim da página presentes em pelo menos esta fração das páginas são banners.
+EDGE_LINES = 3
+BANNER_PAGE_RATIO = 0.5
+OMITTED_MARKER = "[...]"
+
+SYSTEM_INSTRUCTIONS = """Você é um assistente jurídico sênior, especialista na Política Recursal da instituição. Sua tarefa é preencher um formulário com precisão absoluta, seguindo um conjunto de regras não negociáveis.
+
+**ORDEM DE ANÁLISE OBRIGATÓRIA:**
+Você deve seguir os seguintes passos na ordem exata. Pare no primeiro passo que se aplicar.
+
+**PASSO 1: VERIFICAÇÃO DE EXCEÇÕES ABSOLUTAS (Prioridade Máxima)**
+* **Regra:** Verifique se a matéria da decisão se enquadra em alguma das exceções (PASEP, FIES, MCMV, Cédula Rural, Superendividamento, matérias residuais).
+* **Ação:** Se for uma exceção e o formulário for de 'autodispensa', preencha o campo 'fundamento_autodispensa' com: **"AVISO: VEDAÇÃO ABSOLUTA. A matéria ([nome da matéria]) não permite autodispensa."** e finalize a análise de fundamentação.
+
+**PASSO 2: ANÁLISE DA HIPÓTESE DE VALOR (Cenário Principal para Autodispensa)**
+* **Regra:** Se o formulário for de 'autodispensa' e o PASSO 1 não se aplicar, verifique se a **condenação patrimonial total** (excluindo juros e correção monetária) é inferior aos limites estabelecidos no "Anexo I – Hipóteses de Autodispensa Obrigatória".
+* **Ação:** Se o valor for inferior a R$5.000,00 (Juizados Especiais) ou R$10.000,00 (Justiça Comum), sua fundamentação no campo 'fundamento_autodispensa' DEVE ser: **"Conforme 13.1.3 Anexo I, inciso [I ou II], a condenação total de R$ [valor extraído] é inferior ao limite para a presente ação, sendo a autodispensa obrigatória."**
+
+**PASSO 3: ANÁLISE DAS DEMAIS HIPÓTESES (Apenas se os passos 1 e 2 não se aplicarem)**
+* **Regra da Hipótese Única:** Selecione **apenas UMA** outra hipótese do "Anexo I" que se aplique perfeitamente ao caso. Todas as justificativas para autodispensa devem, obrigatoriamente, originar-se deste anexo.
+* **Regra da Fundamentação Direta:** Se encontrar uma hipótese, inicie a fundamentação com a citação do item (ex: "Conforme 13.1.3 Anexo I, alínea 'x'...") e explique o enquadramento.
+* **Regra da Não-Conformação:** Se nenhuma hipótese do Anexo I se aplicar, retorne a frase exata: **"AVISO: A situação fática não se enquadra em nenhuma hipótese de autodispensa prevista no Anexo I da Política Recursal."**
+
+**REGRAS GERAIS ADICIONAIS:**
+* **Dados Ausentes:** Se uma informação factual não estiver na decisão, preencha o campo com **"Não consta na decisão"**. NÃO INVENTE DADOS.
+* **Trechos Omitidos:** A marca "[...]" indica partes da decisão sem relevância para o formulário que foram omitidas.
+
+**TAREFA FINAL:**
+Seguindo rigorosamente a ORDEM DE ANÁLISE OBRIGATÓRIA, analise os documentos enviados pelo utilizador e preencha o esquema JSON pedido."""
+
+USER_PROMPT_TEMPLATE = """**DOCUMENTOS PARA ANÁLISE:**
+
+**1. CONTEXTO DA POLÍTICA RECURSAL (Fonte da Verdade para Fundamentação):**
+---
+{policy_context}
+---
+
+**2. DECISÃO JUDICIAL (Fonte dos Fatos):**
+---
+{decision_text}
+---"""
+
+# Linhas que nunca têm informação para o formulário.
+BOILERPLATE_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in (
+    r"^\s*(p[áa]g(ina)?\.?|fls?\.?|folhas?)\s*\d+(\s*(de|/)\s*\d+)?\s*$",
+    r"^\s*\d{1,4}\s*(/\s*\d{1,4})?\s*$",
+    r"^\s*(https?://|www\.)\S+\s*$",
+    r"assinad[oa] (eletr[ôo]nica|digital)mente",
+    r"c[óo]digo (verificador|de valida[çc][ãa]o|de autenticidade)",
+    r"(confer[êe]ncia|autenticidade|validar?) .*(https?://|www\.|\.jus\.br)",
+    r"lei\s*(n[ºo°.]*\s*)?11\.419",
+    r"MP\s*(n[ºo°.]*\s*)?2\.200-2",
+    r"ICP-?Brasil",
+    r"^\s*(id\.?|num\.?)\s*[\w.-]+\s*-\s*p[áa]g\.?\s*\d+",
+)]
+
+# Início do dispositivo (a parte com condenação, valores, multa e liminar).
+DISPOSITIVE_PATTERN = re.compile(
+    r"(ante o exposto|diante do exposto|pelo exposto|isto posto|posto isso|em face do exposto|"
+    r"^\s*dispositivo\b|julgo (parcialmente )?(procedente|improcedente))",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+# Informação pedida pelo esquema do formulário.
+SCHEMA_KEYWORDS = re.compile(
+    r"R\$\s*[\d.,]+|valor da causa|condena|indeniza|danos? (morais|materiais)|multa|astreinte|"
+    r"liminar|tutela|antecipa|obriga[çc][ãa]o de fazer|coisa julgada|litispend|prazo|"
+    r"honor[áa]rios|custas|contrato|opera[çc][ãa]o|vencimento|subs[íi]dio|precedente|"
+    r"s[úu]mula|tema \d+|recurso|apela[çc][ãa]o|embargos|OAB",
+    re.IGNORECASE,
+)
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / PROMPT_CHARS_PER_TOKEN)
+
+
+def _shape(line: str) -> str:
+    return re.sub(r"\d+", "#", line.strip())
+
+
+def _edge_indexes(lines: List[str]) -> List[int]:
+    filled = [i for i, line in enumerate(lines) if line.strip()]
+    return filled[:EDGE_LINES] + filled[-EDGE_LINES:]
+
+
+def clean_decision_text(text: str) -> str:
+    """Remove números de página, banners repetidos em todas as páginas e blocos de assinatura."""
+    # Banners (cabeçalho/rodapé do tribunal) repetem-se no topo ou no fim de cada página,
+    # às vezes só com números diferentes. As páginas vêm separadas por '\f'.
+    pages = [page.splitlines() for page in text.split("\f") if page.strip()]
+    banners = set()
+    if len(pages) >= 2:
+        shapes = Counter(shape for lines in pages for shape in {_shape(lines[i]) for i in _edge_indexes(lines)})
+        banners = {shape for shape, count in shapes.items() if count >= max(2, len(pages) * BANNER_PAGE_RATIO)}
+
+    kept: List[str] = []
+    for lines in pages:
+        edges = set(_edge_indexes(lines)) if banners else set()
+        for i, line in enumerate(lines):
+            stripped = line.strip()
+            if i in edges and _shape(stripped) in banners:
+                continue
+            if any(pattern.search(stripped) for pattern in BOILERPLATE_PATTERNS):
+                continue
+            if not stripped and (not kept or not kept[-1]):
+                continue
+            kept.append(stripped)
+        if kept and kept[-1]:
+            kept.append("")
+    return "\n".join(kept).strip()
+
+
+def _blocks(text: str) -> List[str]:
+    blocks: List[str] = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        current: List[str] = []
+        size = 0
+        for line in paragraph.splitlines():
+            if current and size + len(line) > MAX_BLOCK_CHARS:
+                blocks.append("\n".join(current))
+                current, size = [], 0
+            current.append(line)
+            size += len(line) + 1
+        if current:
+            blocks.append("\n".join(current))
+    return blocks
+
+
+def select_decision_sections(text: str, budget_chars: int) -> str:
+    """
+    Reduz a decisão ao orçamento: mantém o preâmbulo e o dispositivo e preenche o resto com
+    os blocos com maior densidade de informação do esquema, pela ordem original.
+    """
+    if len(text) <= budget_chars:
+        return text
+    blocks = _blocks(text)
+    offsets, position = [], 0
+    for block in blocks:
+        start = text.find(block, position)
+        offsets.append(start)
+        position = start + len(block)
+
+    matches = list(DISPOSITIVE_PATTERN.finditer(text))
+    # O último marcador antes do fim costuma ser o dispositivo da própria decisão (e não citações).
+    dispositive_start = matches[-1].start() if matches and matches[-1].start() > len(text) // 3 else len(text)
+
+    chosen: Dict[int, str] = {}
+    used = 0
+    # 1. Preâmbulo e dispositivo, por esta ordem; um dispositivo longo é cortado no fim.
+    must_have = [i for i, start in enumerate(offsets) if start < HEAD_CHARS]
+    must_have += [i for i, start in enumerate(offsets) if start + len(blocks[i]) > dispositive_start and i not in must_have]
+    for i in must_have:
+        room = budget_chars - used
+        if room <= 0:
+            break
+        chosen[i] = blocks[i][:room]
+        used += len(chosen[i])
+
+    # 2. Restantes blocos pela densidade de palavras-chave do esquema (em empate, os primeiros).
+    def priority(i: int):
+        return -len(SCHEMA_KEYWORDS.findall(blocks[i])) / max(len(blocks[i]), 1), i
+
+    for i in sorted((i for i in range(len(blocks)) if i not in chosen), key=priority):
+        if used + len(blocks[i]) <= budget_chars:
+            chosen[i] = blocks[i]
+            used += len(blocks[i])
+
+    parts: List[str] = []
+    for i in range(len(blocks)):
+        if i in chosen:
+            parts.append(chosen[i])
+        elif not parts or parts[-1] != OMITTED_MARKER:
+            parts.append(OMITTED_MARKER)
+    return "\n\n".join(parts)
+
+
+def build_prompt(decision_text: str, policy_context: str, token_budget: int = PROMPT_TOKEN_BUDGET) -> Dict[str, Any]:
+    """
+    Devolve as instruções de sistema, o texto do utilizador dentro do orçamento e as
+    estimativas de tokens de cada parte.
+    """
+    # Uma decisão só com "boilerplate" (p. ex. uma única linha repetida) segue tal como veio.
+    cleaned = clean_decision_text(decision_text) or decision_text.strip()
+    fixed_tokens = estimate_tokens(USER_PROMPT_TEMPLATE.format(policy_context=policy_context, decision_text=""))
+    decision_budget_chars = max(int((token_budget - fixed_tokens) * PROMPT_CHARS_PER_TOKEN), HEAD_CHARS)
+    selected = select_decision_sections(cleaned, decision_budget_chars)
+    user_text = USER_PROMPT_TEMPLATE.format(policy_context=policy_context, decision_text=selected)
+    return {
+        "system_instruction": SYSTEM_INSTRUCTIONS,
+        "user_text": user_text,
+        "stats": {
+            "decision_chars": len(decision_text),
+            "cleaned_chars": len(cleaned),
+            "selected_chars": len(selected),
+            "estimated_system_tokens": estimate_tokens(SYSTEM_INSTRUCTIONS),
+            "estimated_user_tokens": estimate_tokens(user_text),
+        },
+    }
+
+
+class InstructionCache:
+    """
+    Cache de contexto explícita ('cachedContents') com as instruções de sistema, renovada
+    antes de expirar. Se a criação falhar (p. ex. abaixo do mínimo de tokens do modelo), os
+    pedidos continuam a enviar 'systemInstruction' e voltam a tentar após o TTL.
+    """
+
+    def __init__(self, api_base: str, api_key: str, model: str,
+                 enabled: bool = GEMINI_CONTEXT_CACHE, ttl_seconds: int = GEMINI_CONTEXT_CACHE_TTL):
+        self.url = f"{api_base}/v1beta/cachedContents?key={api_key}"
+        self.model = model
+        self.enabled = enabled
+        self.ttl_seconds = ttl_seconds
+        self.name: Optional[str] = None
+        self.expires_at = 0.0
+        self.retry_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def get(self, client) -> Optional[str]:
+        """Nome da cache em vigor, ou None para enviar as instruções no próprio pedido."""
+        if not self.enabled:
+            return None
+        # Renova com um minuto de margem para nenhum pedido usar uma cache já expirada.
+        if self.name and time.time() < self.expires_at - 60:
+            return self.name
+        if time.time() < self.retry_at:
+            return None
+        async with self.lock:
+            if self.name and time.time() < self.expires_at - 60:
+                return self.name
+            try:
+                result = await client.create_cached_content(self.url, {
+                    "model": f"models/{self.model}",
+                    "systemInstruction": {"parts": [{"text": SYSTEM_INSTRUCTIONS}]},
+                    "ttl": f"{self.ttl_seconds}s",
+                })
+                self.name = result["name"]
+                self.expires_at = time.time() + self.ttl_seconds
+            except Exception as e:
+                print(f"Cache de contexto indisponível, a enviar as instruções em cada pedido: {e}")
+                self.name = None
+                self.retry_at = time.time() + self.ttl_seconds
+        return self.name
+
+
+def usage_from_response(result: Dict[str, Any]) -> Dict[str, int]:
+    """Contagens de tokens reportadas pela API (usageMetadata)."""
+    usage = result.get("usageMetadata") or {}
+    return {
+        "prompt_tokens": usage.get("promptTokenCount", 0),
+        "response_tokens": usage.get("candidatesTokenCount", 0),
+        "cached_tokens": usage.get("cachedContentTokenCount", 0),
+        "total_tokens": usage.get("totalTokenCount", 0),
+    }
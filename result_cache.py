@@ -0,0 +1,138 @@
+# result_cache.py
+# Cache de resultados de análise endereçado pelo conteúdo.
+#
+# A chave combina o hash dos bytes do PDF, o form_type, a versão do prompt e a
+# versão do índice da política: um reenvio da mesma decisão devolve o resultado
+# guardado sem voltar a extrair, pesquisar ou chamar a API Gemini.
+# Dois níveis: LRU em memória (por processo) e SQLite persistente (partilhado).
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+CACHE_DB_FILE = os.getenv("ANALYSIS_CACHE_DB", "analysis_cache.db")
+CACHE_MEMORY_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MEMORY_ENTRIES", "256"))
+CACHE_MAX_AGE_SECONDS = float(os.getenv("ANALYSIS_CACHE_MAX_AGE", str(30 * 24 * 3600)))
+CACHE_MAX_BYTES = int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+
+def analysis_cache_key(content_sha256: bytes, form_type: str, prompt_version: str, index_version: str) -> str:
+    """Chave a partir do sha256 do PDF (calculado ao gravar o upload no spool, sem o reler)."""
+    digest = hashlib.sha256()
+    digest.update(content_sha256)
+    for part in (form_type, prompt_version, index_version):
+        digest.update(b"\0" + part.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class AnalysisCache:
+    """Resultados de análise (dados extraídos + contexto RAG) por chave de conteúdo."""
+
+    def __init__(self, db_path: str = CACHE_DB_FILE, memory_entries: int = CACHE_MEMORY_ENTRIES,
+                 max_age_seconds: float = CACHE_MAX_AGE_SECONDS, max_bytes: int = CACHE_MAX_BYTES):
+        self.db_path = db_path
+        self.memory_entries = memory_entries
+        self.max_age_seconds = max_age_seconds
+        self.max_bytes = max_bytes
+        # Guarda o JSON serializado para que quem lê não altere a entrada em cache.
+        self.memory: "OrderedDict[str, Tuple[str, Optional[str], float]]" = OrderedDict()
+        self.memory_lock = threading.Lock()
+        self._local = threading.local()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        conn = self._conn()
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS analysis_cache (
+            cache_key TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            rag_context TEXT,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_cache_last_access ON analysis_cache (last_access)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key: str, data_json: str, rag_context: Optional[str], created_at: float):
+        with self.memory_lock:
+            self.memory[key] = (data_json, rag_context, created_at)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Tuple[Dict[str, Any], Optional[str]]]:
+        now = time.time()
+        with self.memory_lock:
+            entry = self.memory.get(key)
+            if entry is not None and now - entry[2] <= self.max_age_seconds:
+                self.memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return json.loads(entry[0]), entry[1]
+            if entry is not None:
+                del self.memory[key]
+
+        row = self._conn().execute(
+            "SELECT data, rag_context, created_at FROM analysis_cache WHERE cache_key = ? AND created_at >= ?",
+            (key, now - self.max_age_seconds),
+        ).fetchone()
+        if row is None:
+            self.counters["misses"] += 1
+            return None
+        self._conn().execute("UPDATE analysis_cache SET last_access = ? WHERE cache_key = ?", (now, key))
+        self._remember(key, row[0], row[1], row[2])
+        self.counters["disk_hits"] += 1
+        return json.loads(row[0]), row[1]
+
+    def put(self, key: str, data: Dict[str, Any], rag_context: Optional[str]):
+        now = time.time()
+        data_json = json.dumps(data, ensure_ascii=False)
+        size = len(data_json.encode("utf-8")) + len((rag_context or "").encode("utf-8"))
+        self._conn().execute(
+            "INSERT OR REPLACE INTO analysis_cache (cache_key, data, rag_context, size, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, data_json, rag_context, size, now, now),
+        )
+        self._remember(key, data_json, rag_context, now)
+        self.counters["stores"] += 1
+
+    def evict(self) -> int:
+        """Remove entradas expiradas e, acima de max_bytes, as menos usadas recentemente."""
+        conn = self._conn()
+        evicted = conn.execute(
+            "DELETE FROM analysis_cache WHERE created_at < ?", (time.time() - self.max_age_seconds,)
+        ).rowcount
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM analysis_cache").fetchone()[0]
+        if total > self.max_bytes:
+            excess = total - self.max_bytes
+            rows = conn.execute("SELECT cache_key, size FROM analysis_cache ORDER BY last_access").fetchall()
+            to_delete = []
+            for cache_key, size in rows:
+                if excess <= 0:
+                    break
+                to_delete.append((cache_key,))
+                excess -= size
+            conn.executemany("DELETE FROM analysis_cache WHERE cache_key = ?", to_delete)
+            evicted += len(to_delete)
+        self.counters["evictions"] += evicted
+        return evicted
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+        hits = lookups - self.counters["misses"]
+        return {
+            "memory_entries": len(self.memory),
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+            **self.counters,
+        }
@@ -0,0 +1,79 @@
+# retrieval.py
+# Recuperação multi-consulta sobre o índice da Política Recursal.
+#
+# Em vez de usar apenas os primeiros 2000 caracteres da decisão como consulta,
+# várias janelas distribuídas pela decisão (relatório, fundamentação, dispositivo)
+# são vetorizadas num único forward pass em lote. Os candidatos de todas as janelas
+# são unidos sem duplicados e escolhidos por MMR (relevância vs. diversidade),
+# dentro de um orçamento de caracteres para o contexto do prompt.
+
+import os
+from typing import TYPE_CHECKING, List
+
+import numpy as np
+
+from metrics import stage_timer
+
+if TYPE_CHECKING:
+    from langchain.docstore.document import Document
+    from langchain_community.vectorstores import FAISS
+
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "4"))
+RETRIEVAL_FETCH_K = int(os.getenv("RETRIEVAL_FETCH_K", "20"))
+RETRIEVAL_QUERY_WINDOWS = int(os.getenv("RETRIEVAL_QUERY_WINDOWS", "4"))
+RETRIEVAL_WINDOW_CHARS = int(os.getenv("RETRIEVAL_WINDOW_CHARS", "1500"))
+RETRIEVAL_MMR_LAMBDA = float(os.getenv("RETRIEVAL_MMR_LAMBDA", "0.6"))
+RETRIEVAL_MAX_CONTEXT_CHARS = int(os.getenv("RETRIEVAL_MAX_CONTEXT_CHARS", "5000"))
+
+
+def query_windows(decision_text: str, count: int = RETRIEVAL_QUERY_WINDOWS,
+                  size: int = RETRIEVAL_WINDOW_CHARS) -> List[str]:
+    """Janelas de consulta igualmente espaçadas, do início ao fim da decisão."""
+    text = decision_text.strip()
+    if len(text) <= size or count <= 1:
+        return [text[:size]]
+    last_start = len(text) - size
+    starts = sorted({round(last_start * i / (count - 1)) for i in range(count)})
+    return [text[start:start + size] for start in starts]
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def multi_query_search(vs: "FAISS", decision_text: str, k: int = RETRIEVAL_K) -> List["Document"]:
+    """Devolve até k chunks da política, na ordem em que aparecem no documento."""
+    windows = query_windows(decision_text)
+    with stage_timer("embedding"):
+        query_vectors = np.asarray(vs.embedding_function.embed_documents(windows), dtype="float32")
+    fetch_k = min(RETRIEVAL_FETCH_K, vs.index.ntotal)
+    if fetch_k == 0:
+        return []
+    with stage_timer("faiss_search"):
+        _, ids = vs.index.search(query_vectors, fetch_k)
+    # União dos candidatos de todas as janelas, sem duplicados
+    candidates = list(dict.fromkeys(int(i) for i in ids.ravel() if i != -1))
+    candidate_vectors = _normalize(np.vstack([vs.index.reconstruct(i) for i in candidates]))
+
+    # Cada candidato vale pela janela da decisão mais próxima dele.
+    relevance = (candidate_vectors @ _normalize(query_vectors).T).max(axis=1)
+    similarity = candidate_vectors @ candidate_vectors.T
+
+    selected: List[int] = []
+    context_chars = 0
+    while len(selected) < min(k, len(candidates)):
+        remaining = [i for i in range(len(candidates)) if i not in selected]
+        if selected:
+            redundancy = similarity[np.ix_(remaining, selected)].max(axis=1)
+        else:
+            redundancy = np.zeros(len(remaining))
+        scores = RETRIEVAL_MMR_LAMBDA * relevance[remaining] - (1 - RETRIEVAL_MMR_LAMBDA) * redundancy
+        best = remaining[int(np.argmax(scores))]
+        chunk_chars = len(vs.docstore.search(vs.index_to_docstore_id[candidates[best]]).page_content)
+        if selected and context_chars + chunk_chars > RETRIEVAL_MAX_CONTEXT_CHARS:
+            break
+        selected.append(best)
+        context_chars += chunk_chars
+
+    return [vs.docstore.search(vs.index_to_docstore_id[i]) for i in sorted(candidates[j] for j in selected)]
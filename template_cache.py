@@ -0,0 +1,109 @@
+# template_cache.py
+# Cache em memória dos templates .docx das súmulas.
+#
+# Cada template é lido do disco uma única vez (e de novo apenas se o mtime mudar) e
+# as tags Jinja2 de cada parte do documento (corpo, cabeçalhos, rodapés) são
+# compiladas uma única vez por um Environment com memória. A renderização trabalha
+# sobre buffers em memória e devolve os bytes do DOCX final.
+
+import io
+import os
+import time
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from docxtpl import DocxTemplate
+from jinja2 import Environment
+
+
+class CachingEnvironment(Environment):
+    """Environment que guarda o template compilado de cada XML já visto."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compiled: Dict[str, Any] = {}
+
+    def from_string(self, source, globals=None, template_class=None):
+        if globals is not None or template_class is not None or not isinstance(source, str):
+            return super().from_string(source, globals=globals, template_class=template_class)
+        template = self.compiled.get(source)
+        if template is None:
+            template = super().from_string(source)
+            self.compiled[source] = template
+        return template
+
+
+class CompiledTemplate:
+    """Bytes de um template .docx, as suas partes compiladas e as métricas de renderização."""
+
+    def __init__(self, path: str, mtime: float, data: bytes):
+        self.path = path
+        self.mtime = mtime
+        self.data = data
+        self.jinja_env = CachingEnvironment()
+        self.renders = 0
+        self.total_ms = 0.0
+        self.last_ms = 0.0
+
+    def render(self, context: Dict[str, Any]) -> bytes:
+        doc = DocxTemplate(io.BytesIO(self.data))
+        doc.render(context, jinja_env=self.jinja_env)
+        output = io.BytesIO()
+        doc.save(output)
+        return output.getvalue()
+
+    def record(self, elapsed_ms: float):
+        self.renders += 1
+        self.total_ms += elapsed_ms
+        self.last_ms = elapsed_ms
+
+
+class TemplateCache:
+    """Templates por nome de ficheiro, invalidados quando o ficheiro é alterado."""
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.entries: Dict[str, CompiledTemplate] = {}
+        self.lock = threading.Lock()
+
+    def get(self, template_name: str) -> CompiledTemplate:
+        path = os.path.join(self.folder, template_name)
+        mtime = os.path.getmtime(path)
+        entry = self.entries.get(template_name)
+        if entry is not None and entry.mtime == mtime:
+            return entry
+        with self.lock:
+            entry = self.entries.get(template_name)
+            if entry is None or entry.mtime != mtime:
+                with open(path, "rb") as f:
+                    entry = CompiledTemplate(path, mtime, f.read())
+                self.entries[template_name] = entry
+        return entry
+
+    def render(self, template_name: str, context: Dict[str, Any]) -> Tuple[bytes, float]:
+        """Renderiza o template e devolve (bytes do DOCX, tempo de renderização em ms)."""
+        entry = self.get(template_name)
+        started = time.perf_counter()
+        docx_bytes = entry.render(context)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        entry.record(elapsed_ms)
+        return docx_bytes, elapsed_ms
+
+    def warm(self, template_names) -> None:
+        """Lê e compila os templates antecipadamente (o XML compilado não depende do contexto)."""
+        for template_name in template_names:
+            try:
+                self.get(template_name).render({})
+            except Exception as e:
+                print(f"Não foi possível pré-compilar o template '{template_name}': {e}")
+
+    def stats(self) -> Dict[str, Dict[str, Optional[float]]]:
+        return {
+            name: {
+                "renders": entry.renders,
+                "avg_render_ms": round(entry.total_ms / entry.renders, 2) if entry.renders else None,
+                "last_render_ms": round(entry.last_ms, 2) if entry.renders else None,
+                "compiled_parts": len(entry.jinja_env.compiled),
+            }
+            for name, entry in self.entries.items()
+        }
@@ -1,18 +1,23 @@
 # training_service.py
-# Versão 1.0 - Serviço para preparar dados para Fine-Tuning do Gemini
+# Versão 1.1 - Serviço para preparar dados para Fine-Tuning do Gemini
 
+import os
 import sqlite3
 import json
+import zlib
+from typing import Optional
 from fastapi import FastAPI, HTTPException
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-import io
+
+from feedback_store import FeedbackStore, parse_timestamp
+from metrics import instrument_app, stage_timer
 
 # --- Inicialização da Aplicação FastAPI ---
 app = FastAPI(
     title="recANALYSIS Training Service",
     description="Serviço para extrair e formatar dados de feedback para fine-tuning de modelos de IA.",
-    version="1.0.0"
+    version="1.1.0"
 )
 
 # --- Configuração de CORS ---
@@ -24,56 +29,106 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- Métricas (/metrics) e trace ids opcionais (TRACE_IDS=1) ---
+instrument_app(app)
+
 # --- Constantes ---
 DB_FILE = "feedback.db"
+# Linhas lidas por página do cursor (paginação por chave: WHERE id > último id).
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+
+# --- Armazenamento de Feedback ---
+# Aberto no primeiro pedido (aplica as migrações de esquema em falta).
+feedback_store: Optional[FeedbackStore] = None
 
 # --- Endpoints da API ---
 @app.get("/")
 def read_root():
     return {"message": "Serviço de Treinamento está ativo e pronto para preparar os dados."}
 
-@app.get("/api/v1/training-data")
-def get_training_data():
-    """
-    Extrai os dados de feedback e os formata no padrão JSONL para fine-tuning.
-    Cada linha do JSONL será um par de 'prompt' e 'completion'.
-    """
+def get_feedback_store() -> FeedbackStore:
+    global feedback_store
+    if feedback_store is None:
+        feedback_store = FeedbackStore(DB_FILE)
+    return feedback_store
+
+def build_export_filters(since_id: Optional[int], since: Optional[str], form_type: Optional[str],
+                         start_date: Optional[str], end_date: Optional[str]):
+    """Cláusulas WHERE e parâmetros comuns a todas as páginas da exportação."""
+    clauses, params = [], []
     try:
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT rag_context, original_response, corrected_response FROM feedback")
-        feedback_entries = cursor.fetchall()
-        conn.close()
-
-        if not feedback_entries:
-            raise HTTPException(status_code=404, detail="Nenhum dado de feedback encontrado para gerar o arquivo de treinamento.")
-
-        # Usa um buffer de texto em memória para criar o arquivo JSONL
-        string_io = io.StringIO()
-        for entry in feedback_entries:
+        if since_id is not None:
+            clauses.append("id > ?")
+            params.append(since_id)
+        if since:
+            clauses.append("timestamp > ?")
+            params.append(parse_timestamp(since))
+        if form_type:
+            clauses.append("form_type = ?")
+            params.append(form_type)
+        if start_date:
+            clauses.append("timestamp >= ?")
+            params.append(parse_timestamp(start_date))
+        if end_date:
+            # Uma data sem hora inclui o dia inteiro.
+            clauses.append("timestamp < ?" if len(end_date) == 10 else "timestamp <= ?")
+            params.append(parse_timestamp(end_date, end_of_day=True))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Data inválida (use AAAA-MM-DD ou data/hora ISO).")
+    return clauses, params
+
+def iter_training_lines(pages):
+    for rows in pages:
+        lines = []
+        for entry in rows:
             # O 'prompt' é o contexto do RAG que a IA usou.
             # A 'completion' (ou 'output') é a resposta corrigida pelo humano.
             # O fine-tuning ensinará o modelo: "Quando ver um contexto como este, gere uma resposta como esta".
-            prompt_text = entry['rag_context']
-            corrected_data = json.loads(entry['corrected_response'])
-
-            # Formata a saída como um único objeto JSON por linha
             training_example = {
-                "input": prompt_text,
-                "output": json.dumps(corrected_data, ensure_ascii=False)
+                "input": entry['rag_context'],
+                "output": json.dumps(entry['corrected_response'], ensure_ascii=False)
             }
-            string_io.write(json.dumps(training_example, ensure_ascii=False) + '\n')
+            lines.append(json.dumps(training_example, ensure_ascii=False) + '\n')
+        yield "".join(lines).encode("utf-8")
 
-        # Retorna o conteúdo do buffer como um arquivo para download
-        string_io.seek(0)
-        return StreamingResponse(
-            string_io,
-            media_type="application/jsonl",
-            headers={"Content-Disposition": "attachment; filename=training_data.jsonl"}
-        )
+def timed_export(chunks):
+    """Mede a exportação completa (até ao último byte enviado)."""
+    with stage_timer("training_export"):
+        yield from chunks
 
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: formato gzip
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.get("/api/v1/training-data")
+def get_training_data(since_id: Optional[int] = None, since: Optional[str] = None, form_type: Optional[str] = None,
+                      start_date: Optional[str] = None, end_date: Optional[str] = None, compress: bool = True):
+    """
+    Extrai os dados de feedback e os formata no padrão JSONL para fine-tuning.
+    Cada linha do JSONL será um par de 'prompt' e 'completion'.
+
+    A exportação é feita em streaming (gzip por padrão), página a página. Para exportações
+    incrementais, use o cabeçalho 'X-Export-Last-Id' da resposta como 'since_id' seguinte.
+    """
+    clauses, params = build_export_filters(since_id, since, form_type, start_date, end_date)
+    try:
+        store = get_feedback_store()
+        # Fixa o limite superior no início: linhas inseridas durante a exportação ficam para a próxima.
+        max_id = store.max_id(clauses, params)
     except sqlite3.OperationalError:
-         raise HTTPException(status_code=500, detail=f"Erro ao aceder à base de dados '{DB_FILE}'. Verifique se o arquivo existe e se o serviço tem permissão de leitura.")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Ocorreu um erro inesperado: {e}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Erro ao aceder à base de dados '{DB_FILE}'. Verifique se o arquivo existe e se o serviço tem permissão de leitura.")
+
+    if max_id is None:
+        raise HTTPException(status_code=404, detail="Nenhum dado de feedback encontrado para gerar o arquivo de treinamento.")
+
+    chunks = timed_export(iter_training_lines(store.iter_pages(clauses, params, max_id, EXPORT_PAGE_SIZE)))
+    headers = {"X-Export-Last-Id": str(max_id)}
+    if compress:
+        headers["Content-Disposition"] = "attachment; filename=training_data.jsonl.gz"
+        return StreamingResponse(gzip_stream(chunks), media_type="application/gzip", headers=headers)
+    headers["Content-Disposition"] = "attachment; filename=training_data.jsonl"
+    return StreamingResponse(chunks, media_type="application/jsonl", headers=headers)